@@ -0,0 +1,113 @@
+import os
+
+from backends import local_capacity
+from model_stats import get_model_stats
+from token_count import estimate_tokens
+
+
+# Picks which advisors the King consults for a problem of a known category, from how often each
+# advisor was right on graded problems of that category (benchmark.py in record or live mode
+# keeps that history) and how long and how much it took. No model is asked to do the routing.
+DEFAULT_TARGET_ACCURACY = 0.9
+DEFAULT_MIN_ADVISORS = 3
+MIN_GRADED = 5  # graded answers in a category before an advisor's record is used
+
+
+def outcome_key(category, advisor):
+    return f"category/{category}/{advisor}"
+
+
+def router_settings_from_env():
+    latency_budget = os.getenv("MOM_ROUTER_LATENCY_BUDGET")
+    cost_budget = os.getenv("MOM_ROUTER_COST_BUDGET")
+    return {
+        "target_accuracy": float(os.getenv("MOM_ROUTER_TARGET_ACCURACY", DEFAULT_TARGET_ACCURACY)),
+        "latency_budget": float(latency_budget) if latency_budget else None,
+        "cost_budget": float(cost_budget) if cost_budget else None,
+        "min_advisors": int(os.getenv("MOM_ROUTER_MIN_ADVISORS", DEFAULT_MIN_ADVISORS)),
+    }
+
+
+# Chance that at least one of the advisors is right, which is what the King needs to find the answer
+def expected_accuracy(accuracies):
+    all_wrong = 1.0
+    for accuracy in accuracies:
+        all_wrong *= 1.0 - accuracy
+    return 1.0 - all_wrong
+
+
+# Remote advisors answer side by side, local ones take turns on the models the Ollama nodes can keep loaded
+def estimated_latency(advisors, latencies, max_loaded_models=1):
+    remote = [latencies[advisor.name] for advisor in advisors if not advisor.local]
+    local = [latencies[advisor.name] for advisor in advisors if advisor.local]
+    return max(max(remote, default=0.0), sum(local) / max(1, max_loaded_models))
+
+
+def estimated_cost(advisor, prompt_tokens, completion_tokens):
+    return (prompt_tokens * advisor.input_price + completion_tokens * advisor.output_price) / 1000
+
+
+# Function to pick the smallest set of advisors whose expected accuracy reaches the target, most
+# accurate first, leaving out advisors that would break the latency or cost budget. Advisors
+# without MIN_GRADED graded answers in the category yet are always consulted as well, so they
+# build up the history they would otherwise never get. Returns the advisors in their original
+# order and the plan, or every advisor and None while there isn't enough history for the category.
+def route(advisors, category, prompt_tokens=0, target_accuracy=DEFAULT_TARGET_ACCURACY, latency_budget=None,
+          cost_budget=None, min_advisors=DEFAULT_MIN_ADVISORS, stats=None):
+    stats = stats or get_model_stats()
+    records = {}
+    for advisor in advisors:
+        record = stats.outcome(outcome_key(category, advisor.name))
+        if record["graded"] >= MIN_GRADED and record["median_seconds"] is not None:
+            records[advisor.name] = record
+    if len(records) < min_advisors:
+        return advisors, None
+
+    # Laplace smoothing so an advisor with a short perfect record isn't taken as certain
+    accuracy = {name: (record["correct"] + 1) / (record["graded"] + 2) for name, record in records.items()}
+    latency = {name: record["median_seconds"] for name, record in records.items()}
+    cost = {advisor.name: estimated_cost(advisor, prompt_tokens, records[advisor.name]["median_tokens"] or 0)
+            for advisor in advisors if advisor.name in records}
+    max_loaded_models = local_capacity()
+
+    candidates = sorted((advisor for advisor in advisors if advisor.name in records),
+                        key=lambda advisor: (-accuracy[advisor.name], latency[advisor.name], cost[advisor.name]))
+    chosen = []
+    for advisor in candidates:
+        if len(chosen) >= min_advisors and expected_accuracy(accuracy[a.name] for a in chosen) >= target_accuracy:
+            break
+        trial = chosen + [advisor]
+        if chosen and latency_budget is not None and estimated_latency(trial, latency, max_loaded_models) > latency_budget:
+            continue
+        if chosen and cost_budget is not None and sum(cost[a.name] for a in trial) > cost_budget:
+            continue
+        chosen.append(advisor)
+
+    exploring = [advisor for advisor in advisors if advisor.name not in records]
+    plan = {
+        "category": category,
+        "advisors": [advisor.name for advisor in chosen],
+        "exploring": [advisor.name for advisor in exploring],
+        "expected_accuracy": round(expected_accuracy(accuracy[a.name] for a in chosen), 3),
+        "seconds": round(estimated_latency(chosen, latency, max_loaded_models), 1),
+        "cost": round(sum(cost[a.name] for a in chosen), 4),
+        "left_out": [advisor.name for advisor in advisors if advisor not in chosen and advisor not in exploring],
+    }
+    return [advisor for advisor in advisors if advisor in chosen or advisor in exploring], plan
+
+
+def describe_plan(plan, total):
+    description = (f"Router picked {len(plan['advisors'])} of {total} advisors for {plan['category']} problems: "
+                   f"{', '.join(plan['advisors'])} (expected accuracy {plan['expected_accuracy']:.0%}, "
+                   f"about {plan['seconds']}s, ${plan['cost']})")
+    if plan.get("exploring"):
+        description += f", also asking {', '.join(plan['exploring'])} until they have {MIN_GRADED} graded answers"
+    return description
+
+
+# Function for graded runs: remember which advisors of the run were right on a problem of the category
+def record_advisor_outcomes(category, advisors, grade_answer, stats=None):
+    stats = stats or get_model_stats()
+    for name, advisor in advisors.items():
+        stats.record_outcome(outcome_key(category, name), grade_answer(advisor["answer"]), advisor["seconds"],
+                             estimate_tokens(advisor["answer"]))
@@ -0,0 +1,132 @@
+import re
+
+
+# Answers whose wording overlaps at least this much are treated as the same answer
+SIMILARITY_THRESHOLD = 0.8
+
+# A number, with thousands separators ("1,000,000") and a decimal point or comma ("3.5", "3,5")
+_NUMBER_TEXT = r"-?\d+(?:,\d{3}(?!\d))*(?:[.,]\d+)?"
+_MARKED_NUMBER = re.compile(
+    rf"\b(?:final answer|the answer is|answer:)[^0-9\-\n]{{0,40}}({_NUMBER_TEXT})",
+    re.IGNORECASE,
+)
+_BOLD = re.compile(r"\*\*([^*]+)\*\*")
+_NUMBER = re.compile(_NUMBER_TEXT)
+_CODE_BLOCK = re.compile(r"```[^\n]*\n(.*?)```", re.DOTALL)
+_PARAGRAPH_BREAK = re.compile(r"\n\s*\n")
+_ENDS_WITH_NUMBER = re.compile(rf"({_NUMBER_TEXT})\W*$")
+_THOUSANDS_SEPARATOR = re.compile(r",(?=\d{3}(?!\d))")
+_WORD = re.compile(r"\w+")
+
+
+# A comma followed by exactly three digits separates thousands, any other comma is a decimal point
+def normalize_number(number):
+    value = float(_THOUSANDS_SEPARATOR.sub("", number).replace(",", "."))
+    return f"number:{value:.15g}"
+
+
+def _normalize_code(code):
+    lines = []
+    for line in code.splitlines():
+        line = line.split("#", 1)[0].strip()
+        if line:
+            lines.append(" ".join(line.split()))
+    return "code:" + "\n".join(lines)
+
+
+# Function to pull the final result out of an answer. Only the prose after the last code block
+# is read for a number: the last one stated as the answer ("Final answer: 42"), else one in bold
+# in the last paragraph, else a last line that ends with it. An answer with code and no stated
+# answer is compared by its last code block, since numbers in the prose around code are usually
+# examples. Returns None when there is none.
+def extract_final_answer(answer):
+    code_blocks = list(_CODE_BLOCK.finditer(answer))
+    prose = answer[code_blocks[-1].end():] if code_blocks else answer
+    paragraphs = [paragraph for paragraph in _PARAGRAPH_BREAK.split(prose.strip()) if paragraph.strip()]
+    last_paragraph = paragraphs[-1] if paragraphs else ""
+
+    marked = _MARKED_NUMBER.findall(prose)
+    if marked:
+        return normalize_number(marked[-1])
+
+    if code_blocks and code_blocks[-1].group(1).strip():
+        return _normalize_code(code_blocks[-1].group(1))
+
+    for bold in reversed(_BOLD.findall(last_paragraph)):
+        numbers = _NUMBER.findall(bold)
+        if numbers:
+            return normalize_number(numbers[-1])
+
+    lines = [line for line in last_paragraph.splitlines() if line.strip()]
+    if lines:
+        number = _ENDS_WITH_NUMBER.search(lines[-1].strip())
+        if number:
+            return normalize_number(number.group(1))
+    return None
+
+
+def _shingles(answer):
+    words = _WORD.findall(answer.lower())
+    if len(words) < 3:
+        return set(words)
+    return {tuple(words[i:i + 3]) for i in range(len(words) - 2)}
+
+
+def similarity(shingles_a, shingles_b):
+    if not shingles_a and not shingles_b:
+        return 1.0
+    return len(shingles_a & shingles_b) / len(shingles_a | shingles_b)
+
+
+# Function to group answers that reach the same result. Answers with the same extracted final
+# result share a cluster; answers without one join the cluster they are nearly identical to.
+# Returns a list of clusters in the order their first member appears in `answers`, each a dict
+# with the representative advisor's name, its answer and the names of every member.
+def cluster_answers(answers, threshold=SIMILARITY_THRESHOLD):
+    shingles = {name: _shingles(answer) for name, answer in answers.items()}
+    clusters = []
+    by_result = {}
+    for name, answer in answers.items():
+        result = extract_final_answer(answer)
+        if result is not None and result in by_result:
+            by_result[result]["members"].append(name)
+            continue
+        if result is None:
+            match = next(
+                (cluster for cluster in clusters
+                 if any(similarity(shingles[name], shingles[member]) >= threshold for member in cluster["members"])),
+                None,
+            )
+            if match is not None:
+                match["members"].append(name)
+                continue
+        cluster = {"result": result, "members": [name]}
+        clusters.append(cluster)
+        if result is not None:
+            by_result[result] = cluster
+
+    # The representative is the member whose wording is closest to the rest of its cluster
+    for cluster in clusters:
+        members = cluster["members"]
+        cluster["representative"] = max(
+            members,
+            key=lambda name: sum(similarity(shingles[name], shingles[other]) for other in members if other != name),
+        )
+        cluster["answer"] = answers[cluster["representative"]]
+    return clusters
+
+
+# The answers as clusters of one each, for a stage that passes every answer on by itself
+def singleton_clusters(answers):
+    return [{"result": None, "members": [name], "representative": name, "answer": answer} for name, answer in answers.items()]
+
+
+# Function to write one line per cluster: the representative answer and how many advisors gave it
+def format_clusters(clusters, numbered=False):
+    lines = []
+    for number, cluster in enumerate(clusters, 1):
+        members = cluster["members"]
+        support = f"given by {len(members)} advisor{'s' if len(members) > 1 else ''}: {', '.join(members)}"
+        prefix = f"Option {number} - " if numbered else ""
+        lines.append(f"{prefix}{cluster['representative']}'s advice ({support}): {cluster['answer']}")
+    return "\n\n".join(lines)
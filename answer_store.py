@@ -0,0 +1,142 @@
+import hashlib
+import mmap
+import os
+import sys
+import threading
+from array import array
+
+
+# Keeps the answers of many runs in little memory. Every text is stored once, as UTF-8, in an
+# append-only string table, in memory or spilled to a file that is read back through mmap, and
+# a call becomes a row of a few arrays found by the digest of its key. replay.py and the
+# benchmark recordings keep their responses this way, so a log of thousands of problems isn't
+# held as one dict per call with its system message, prompt and response.
+NO_TEXT = -1
+UNKNOWN = float("nan")
+
+
+class StringTable:
+    # With spill_path the texts go to that file (created empty, removed by close) instead of memory
+    def __init__(self, spill_path=None):
+        self.spill_path = spill_path
+        self._ids = {}  # digest of the text -> id
+        self._offsets = array('Q')
+        self._lengths = array('Q')
+        self._size = 0
+        self._data = bytearray()
+        self._file = open(spill_path, 'w+b') if spill_path else None
+        self._map = None
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._offsets)
+
+    # Bytes of text stored, each distinct text counted once
+    def nbytes(self):
+        return self._size
+
+    def intern(self, text):
+        data = text.encode("utf-8")
+        digest = hashlib.blake2b(data, digest_size=16).digest()
+        with self._lock:
+            string_id = self._ids.get(digest)
+            if string_id is None:
+                string_id = len(self._offsets)
+                self._ids[digest] = string_id
+                self._offsets.append(self._size)
+                self._lengths.append(len(data))
+                self._size += len(data)
+                if self._file is not None:
+                    self._file.write(data)
+                else:
+                    self._data += data
+            return string_id
+
+    def text(self, string_id):
+        with self._lock:
+            start = self._offsets[string_id]
+            end = start + self._lengths[string_id]
+            if self._file is None:
+                return self._data[start:end].decode("utf-8")
+            if start == end:
+                return ""
+            # The file is mapped again once it has grown past what was mapped
+            if self._map is None or len(self._map) < end:
+                self._file.flush()
+                if self._map is not None:
+                    self._map.close()
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            return self._map[start:end].decode("utf-8")
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.close()
+                self._map = None
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                os.remove(self.spill_path)
+
+
+def _digest(key):
+    try:
+        return bytes.fromhex(key)
+    except ValueError:
+        return key.encode("utf-8")
+
+
+# The answers of logged or recorded calls by key (the sha256 of the request), and by run for a
+# key that several runs logged. A record comes back as a dict of its response, its error and
+# its timings and token counts; what isn't known is None.
+class AnswerStore:
+    FIELDS = ("seconds", "ttft_seconds", "prompt_tokens", "completion_tokens")
+
+    def __init__(self, spill_path=None):
+        self.strings = StringTable(spill_path)
+        self._rows = {}  # (run, key digest) -> row
+        self._latest = {}  # key digest -> row it was last given
+        self._responses = array('q')
+        self._errors = array('q')
+        self._numbers = array('d')  # FIELDS of every row, one after the other
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._responses)
+
+    def add(self, key, record, run=None):
+        response = record.get("response")
+        error = record.get("error")
+        response_id = self.strings.intern(response) if response is not None else NO_TEXT
+        error_id = self.strings.intern(error) if error else NO_TEXT
+        digest = _digest(key)
+        with self._lock:
+            row = len(self._responses)
+            self._responses.append(response_id)
+            self._errors.append(error_id)
+            self._numbers.extend(UNKNOWN if record.get(field) is None else float(record[field]) for field in self.FIELDS)
+            if run is not None:
+                self._rows[sys.intern(run), digest] = row
+            self._latest[digest] = row
+
+    def get(self, key, run=None):
+        digest = _digest(key)
+        row = self._rows.get((run, digest)) if run is not None else None
+        if row is None:
+            row = self._latest.get(digest)
+        return self._record(row) if row is not None else None
+
+    def _record(self, row):
+        response_id = self._responses[row]
+        error_id = self._errors[row]
+        record = {
+            "response": self.strings.text(response_id) if response_id != NO_TEXT else None,
+            "error": self.strings.text(error_id) if error_id != NO_TEXT else None,
+        }
+        for index, field in enumerate(self.FIELDS):
+            value = self._numbers[row * len(self.FIELDS) + index]
+            record[field] = None if value != value else (int(value) if field.endswith("tokens") else value)
+        return record
+
+    def close(self):
+        self.strings.close()
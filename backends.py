@@ -0,0 +1,531 @@
+import importlib
+import json
+import os
+import threading
+from collections import namedtuple
+
+from ollama_pool import OllamaNode, OllamaPool
+from ollama_scheduler import max_loaded_models_from_env
+from rate_limits import (Attempts, RateLimiter, DEFAULT_BACKOFF_SECONDS, DEFAULT_MAX_RETRIES, call_with_retries,
+                         stream_with_retries, acall_with_retries, astream_with_retries)
+from response_cache import cached, cached_stream, cached_async, cached_stream_async
+from run_metrics import report_response_usage, report_timings, report_usage
+from structured_output import parse_reply, repair_prompt, schema_instruction, structured_retries_from_env
+from token_count import DEFAULT_CHARS_PER_TOKEN, Tokenizer
+
+
+# Every model the architectures call is declared in models.json: the backends (SDK type, base
+# url, API key, connection pool and timeouts), the models with their settings and which models
+# each architecture uses for which role. The registry builds one provider per backend on first
+# use, and each provider keeps a single pooled keep-alive HTTP client (and an async one) that all
+# calls share, so connections are reused instead of opened for every advisor. A backend's SDK is
+# only imported when that backend is first called, so a run that never reaches a backend (or
+# has no key for it) doesn't pay for loading it. Calls are paced by the backend's
+# requests_per_minute and tokens_per_minute and retried by rate_limits, not by the SDKs.
+DEFAULT_CONFIG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "models.json")
+DEFAULT_MAX_CONNECTIONS = 16
+DEFAULT_MAX_KEEPALIVE_CONNECTIONS = 8
+DEFAULT_KEEPALIVE_SECONDS = 30
+DEFAULT_TIMEOUT = 300
+DEFAULT_OLLAMA_URL = "http://localhost:11434"
+DEFAULT_KEEP_ALIVE = "30m"
+
+# One declared model. `local` models run on the Ollama server and go through its scheduler,
+# the prices are in USD per 1000 prompt (input) and completion (output) tokens.
+ModelSpec = namedtuple("ModelSpec", "name backend model system_message temperature max_tokens local input_price output_price context_window",
+                       defaults=(None,))
+
+
+class Provider:
+    sdk_name = None  # the SDK package whose client the provider drives
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = settings
+        self.local = settings.get("local", False)
+        self._client = None
+        self._async_client = None
+        self._lock = threading.Lock()
+        self.limiter = RateLimiter(settings.get("requests_per_minute"), settings.get("tokens_per_minute"))
+        self.tokenizer = Tokenizer(settings.get("tokenizer"), settings.get("chars_per_token", DEFAULT_CHARS_PER_TOKEN))
+
+    @property
+    def sdk(self):
+        return importlib.import_module(self.sdk_name)
+
+    def api_key(self):
+        if "api_key_env" in self.settings:
+            return os.getenv(self.settings["api_key_env"])
+        return self.settings.get("api_key")
+
+    def timeout(self):
+        return float(self.settings.get("timeout", DEFAULT_TIMEOUT))
+
+    # A call takes its prompt and the longest answer it may get from the tokens-per-minute budget,
+    # which is how the providers count it. Local calls that time out aren't tried again.
+    def attempts(self, spec, system_message, messages):
+        tokens = self.tokenizer.count_prompt(system_message, messages) + (spec.max_tokens or 0)
+        return Attempts(self.limiter, tokens, self.settings.get("max_retries", DEFAULT_MAX_RETRIES),
+                        self.settings.get("backoff_seconds", DEFAULT_BACKOFF_SECONDS), retry_timeouts=not self.local)
+
+    # The pooled HTTP client is built with the SDK's own client class and limits type, so it
+    # matches the httpx version that SDK was built against
+    def _http_client(self, asynchronous=False):
+        client_class = self.sdk.DefaultAsyncHttpxClient if asynchronous else self.sdk.DefaultHttpxClient
+        limits = type(self.sdk.DEFAULT_CONNECTION_LIMITS)(
+            max_connections=self.settings.get("max_connections", DEFAULT_MAX_CONNECTIONS),
+            max_keepalive_connections=self.settings.get("max_keepalive_connections", DEFAULT_MAX_KEEPALIVE_CONNECTIONS),
+            keepalive_expiry=self.settings.get("keepalive_seconds", DEFAULT_KEEPALIVE_SECONDS),
+        )
+        return client_class(limits=limits, timeout=self.timeout())
+
+    # The SDK clients are built on first use; they can also be replaced (stub_backend does)
+    @property
+    def client(self):
+        with self._lock:
+            if self._client is None:
+                self._client = self.build_client(self._http_client())
+            return self._client
+
+    @client.setter
+    def client(self, client):
+        self._client = client
+
+    @property
+    def async_client(self):
+        with self._lock:
+            if self._async_client is None:
+                self._async_client = self.build_async_client(self._http_client(asynchronous=True))
+            return self._async_client
+
+    @async_client.setter
+    def async_client(self, client):
+        self._async_client = client
+
+    def build_client(self, http_client):
+        raise NotImplementedError
+
+    def build_async_client(self, http_client):
+        raise NotImplementedError
+
+    # complete() returns the whole answer, stream() yields it in chunks, acomplete() and
+    # astream() are the same for asyncio. With a `schema` the backend is asked for a JSON reply.
+    def complete(self, spec, system_message, messages, schema=None):
+        raise NotImplementedError
+
+    def stream(self, spec, system_message, messages):
+        raise NotImplementedError
+
+    async def acomplete(self, spec, system_message, messages, schema=None):
+        raise NotImplementedError
+
+    def astream(self, spec, system_message, messages):
+        raise NotImplementedError
+
+    def close(self):
+        if self._client is not None and hasattr(self._client, "close"):
+            self._client.close()
+
+
+# OpenAI and everything that speaks its chat completions API (Ollama's /v1 endpoint)
+class OpenAIProvider(Provider):
+    sdk_name = "openai"
+    # A stream ends with a chunk that carries the usage only when it is asked for
+    stream_options = {"stream_options": {"include_usage": True}}
+
+    def build_client(self, http_client):
+        return self.sdk.OpenAI(api_key=self.api_key(), base_url=self.settings.get("base_url"), timeout=self.timeout(),
+                               max_retries=0, http_client=http_client)
+
+    def build_async_client(self, http_client):
+        return self.sdk.AsyncOpenAI(api_key=self.api_key(), base_url=self.settings.get("base_url"), timeout=self.timeout(),
+                                    max_retries=0, http_client=http_client)
+
+    # JSON mode rather than a strict json_schema format, which older models such as gpt-4-turbo
+    # and Groq's don't take; the schema is in the prompt and the reply is checked locally
+    def request(self, spec, system_message, messages, schema=None):
+        request = dict(
+            model=spec.model,
+            messages=[{"role": "system", "content": system_message}] + messages,
+            temperature=spec.temperature,
+        )
+        if spec.max_tokens is not None:
+            request["max_tokens"] = spec.max_tokens
+        if schema is not None:
+            request["response_format"] = {"type": "json_object"}
+        return request
+
+    def complete(self, spec, system_message, messages, schema=None):
+        response = self.client.chat.completions.create(**self.request(spec, system_message, messages, schema))
+        report_response_usage(response.usage)
+        return response.choices[0].message.content.strip()
+
+    def stream(self, spec, system_message, messages):
+        for chunk in self.client.chat.completions.create(**self.request(spec, system_message, messages), stream=True, **self.stream_options):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            report_response_usage(getattr(chunk, "usage", None))
+
+    async def acomplete(self, spec, system_message, messages, schema=None):
+        response = await self.async_client.chat.completions.create(**self.request(spec, system_message, messages, schema))
+        report_response_usage(response.usage)
+        return response.choices[0].message.content.strip()
+
+    async def astream(self, spec, system_message, messages):
+        async for chunk in await self.async_client.chat.completions.create(**self.request(spec, system_message, messages), stream=True,
+                                                                            **self.stream_options):
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            report_response_usage(getattr(chunk, "usage", None))
+
+
+class GroqProvider(OpenAIProvider):
+    sdk_name = "groq"
+    stream_options = {}
+
+    def build_client(self, http_client):
+        return self.sdk.Groq(api_key=self.api_key(), base_url=self.settings.get("base_url"), timeout=self.timeout(),
+                             max_retries=0, http_client=http_client)
+
+    def build_async_client(self, http_client):
+        return self.sdk.AsyncGroq(api_key=self.api_key(), base_url=self.settings.get("base_url"), timeout=self.timeout(),
+                                  max_retries=0, http_client=http_client)
+
+
+class AnthropicProvider(Provider):
+    sdk_name = "anthropic"
+
+    def build_client(self, http_client):
+        return self.sdk.Anthropic(api_key=self.api_key(), base_url=self.settings.get("base_url"), timeout=self.timeout(),
+                                  max_retries=0, http_client=http_client)
+
+    def build_async_client(self, http_client):
+        return self.sdk.AsyncAnthropic(api_key=self.api_key(), base_url=self.settings.get("base_url"), timeout=self.timeout(),
+                                       max_retries=0, http_client=http_client)
+
+    # The messages API has no JSON mode, a JSON reply is asked for as the input of a tool the
+    # model has to call, with the schema as the tool's input schema
+    def request(self, spec, system_message, messages, schema=None):
+        request = dict(
+            model=spec.model,
+            messages=messages,
+            max_tokens=spec.max_tokens or 1024,  # required by the messages API
+            system=system_message,
+            temperature=spec.temperature,
+        )
+        if schema is not None:
+            request["tools"] = [{"name": schema["title"], "description": schema.get("description", ""), "input_schema": schema}]
+            request["tool_choice"] = {"type": "tool", "name": schema["title"]}
+        return request
+
+    @staticmethod
+    def _text(response):
+        for block in response.content:
+            if getattr(block, "type", None) == "tool_use":
+                return json.dumps(block.input, ensure_ascii=False)
+        return response.content[0].text.strip()
+
+    def complete(self, spec, system_message, messages, schema=None):
+        response = self.client.messages.create(**self.request(spec, system_message, messages, schema))
+        report_response_usage(response.usage)
+        return self._text(response)
+
+    def stream(self, spec, system_message, messages):
+        with self.client.messages.stream(**self.request(spec, system_message, messages)) as response:
+            yield from response.text_stream
+            report_response_usage(response.get_final_message().usage)
+
+    async def acomplete(self, spec, system_message, messages, schema=None):
+        response = await self.async_client.messages.create(**self.request(spec, system_message, messages, schema))
+        report_response_usage(response.usage)
+        return self._text(response)
+
+    async def astream(self, spec, system_message, messages):
+        async with self.async_client.messages.stream(**self.request(spec, system_message, messages)) as response:
+            async for text in response.text_stream:
+                yield text
+            report_response_usage((await response.get_final_message()).usage)
+
+
+# Ollama's own chat API rather than its OpenAI-compatible one, because only this one takes
+# `keep_alive` and reports its timings. Kept alive, a model holds the KV cache of its last prompt
+# between the stages of a run, so a prompt that starts the same way (the system message and the
+# problem) only has its new part evaluated. Every request to a model sends the same options,
+# since a different num_ctx makes Ollama load the model again.
+# The calls go to the nodes of the backend's pool (see ollama_pool), or to its base_url alone.
+# The client has no base url, every request names its node.
+class OllamaProvider(Provider):
+    sdk_name = "httpx"
+
+    def __init__(self, name, settings):
+        super().__init__(name, settings)
+        nodes = settings.get("nodes") or [{"url": settings.get("base_url", DEFAULT_OLLAMA_URL)}]
+        self.pool = OllamaPool(
+            [OllamaNode(node["url"], node.get("models"), node.get("max_loaded_models", max_loaded_models_from_env())) for node in nodes],
+            lambda url, timeout: self.client.get(url, timeout=timeout),
+        )
+
+    def _http_client(self, asynchronous=False):
+        httpx = self.sdk
+        limits = httpx.Limits(
+            max_connections=self.settings.get("max_connections", DEFAULT_MAX_CONNECTIONS),
+            max_keepalive_connections=self.settings.get("max_keepalive_connections", DEFAULT_MAX_KEEPALIVE_CONNECTIONS),
+            keepalive_expiry=self.settings.get("keepalive_seconds", DEFAULT_KEEPALIVE_SECONDS),
+        )
+        client_class = httpx.AsyncClient if asynchronous else httpx.Client
+        return client_class(limits=limits, timeout=self.timeout())
+
+    def build_client(self, http_client):
+        return http_client
+
+    def build_async_client(self, http_client):
+        return http_client
+
+    # With a schema Ollama constrains the model's output to it
+    def request(self, spec, system_message, messages, stream=False, schema=None):
+        options = {"temperature": spec.temperature}
+        if spec.max_tokens is not None:
+            options["num_predict"] = spec.max_tokens
+        if "num_ctx" in self.settings:
+            options["num_ctx"] = self.settings["num_ctx"]
+        request = dict(
+            model=spec.model,
+            messages=[{"role": "system", "content": system_message}] + messages,
+            stream=stream,
+            keep_alive=self.settings.get("keep_alive", DEFAULT_KEEP_ALIVE),
+            options=options,
+        )
+        if schema is not None:
+            request["format"] = schema
+        return request
+
+    # The last message of an answer carries the token counts and timings (in nanoseconds)
+    @staticmethod
+    def _report(data):
+        if data.get("error"):
+            raise RuntimeError(f"Ollama: {data['error']}")
+        if "prompt_eval_count" in data or "eval_count" in data:
+            report_usage(data.get("prompt_eval_count", 0), data.get("eval_count", 0))
+        report_timings(
+            load_seconds=data.get("load_duration", 0) / 1e9,
+            prompt_eval_seconds=data.get("prompt_eval_duration", 0) / 1e9,
+            prompt_eval_tokens=data.get("prompt_eval_count", 0),
+        )
+
+    def complete(self, spec, system_message, messages, schema=None):
+        with self.pool.slot(spec.model) as node:
+            response = self.client.post(f"{node.url}/api/chat", json=self.request(spec, system_message, messages, schema=schema))
+            response.raise_for_status()
+        data = response.json()
+        self._report(data)
+        return data["message"]["content"].strip()
+
+    # A stream keeps its node's slot until the last token has been read
+    def stream(self, spec, system_message, messages):
+        with self.pool.slot(spec.model) as node:
+            with self.client.stream("POST", f"{node.url}/api/chat", json=self.request(spec, system_message, messages, stream=True)) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    content = data.get("message", {}).get("content")
+                    if content:
+                        yield content
+                    if data.get("done") or data.get("error"):
+                        self._report(data)
+
+    async def acomplete(self, spec, system_message, messages, schema=None):
+        async with self.pool.aslot(spec.model) as node:
+            response = await self.async_client.post(f"{node.url}/api/chat", json=self.request(spec, system_message, messages, schema=schema))
+            response.raise_for_status()
+        data = response.json()
+        self._report(data)
+        return data["message"]["content"].strip()
+
+    async def astream(self, spec, system_message, messages):
+        async with self.pool.aslot(spec.model) as node:
+            async with self.async_client.stream("POST", f"{node.url}/api/chat", json=self.request(spec, system_message, messages, stream=True)) as response:
+                response.raise_for_status()
+                async for line in response.aiter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    content = data.get("message", {}).get("content")
+                    if content:
+                        yield content
+                    if data.get("done") or data.get("error"):
+                        self._report(data)
+
+
+# The `type` of a backend in models.json picks its provider class
+PROVIDER_TYPES = {
+    "ollama": OllamaProvider,
+    "openai": OpenAIProvider,
+    "groq": GroqProvider,
+    "anthropic": AnthropicProvider,
+}
+
+
+# Decorator to plug in a provider class for another API
+def register_provider(type_name):
+    def register(cls):
+        PROVIDER_TYPES[type_name] = cls
+        return cls
+
+    return register
+
+
+class BackendRegistry:
+    def __init__(self, config):
+        self.config = config
+        self._providers = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_file(cls, path):
+        with open(path, 'r', encoding='utf-8') as infile:
+            return cls(json.load(infile))
+
+    def provider(self, backend):
+        with self._lock:
+            if backend not in self._providers:
+                settings = self.config["backends"][backend]
+                self._providers[backend] = PROVIDER_TYPES[settings["type"]](backend, settings)
+            return self._providers[backend]
+
+    def providers(self):
+        return [self.provider(backend) for backend in self.config["backends"]]
+
+    # Put another provider in place of a backend's, e.g. the replay provider of replay.py
+    def replace_provider(self, provider):
+        with self._lock:
+            self._providers[provider.name] = provider
+
+    def model(self, name):
+        settings = self.config["models"][name]
+        backend = settings["backend"]
+        return ModelSpec(
+            name=name,
+            backend=backend,
+            model=settings["model"],
+            system_message=settings.get("system_message", self.config.get("system_message")),
+            temperature=settings.get("temperature", self.config.get("temperature")),
+            max_tokens=settings.get("max_tokens"),
+            local=self.config["backends"][backend].get("local", False),
+            input_price=settings.get("input_price", 0.0),
+            output_price=settings.get("output_price", 0.0),
+            # An Ollama model sees as much as the backend's num_ctx
+            context_window=settings.get("context_window", self.config["backends"][backend].get("num_ctx")),
+        )
+
+    # The models of an architecture by role, a role lists one model or several. The backup model
+    # answers in place of the advisors, so it can't be one of them as well.
+    def architecture(self, name):
+        roles = {}
+        for role, models in self.config["architectures"][name].items():
+            if isinstance(models, list):
+                roles[role] = [self.model(model) for model in models]
+            else:
+                roles[role] = self.model(models)
+        if "hedge" in roles and roles["hedge"] in roles.get("advisors", []):
+            raise ValueError(f"The hedge model of the {name} architecture, {roles['hedge'].name}, is also one of its advisors; "
+                             "pick a backup model in models.json that isn't")
+        return roles
+
+    def close(self):
+        for provider in self._providers.values():
+            provider.close()
+
+
+registry = None
+_registry_lock = threading.Lock()
+
+
+# The registry is loaded on first use so the scripts' load_dotenv() has already run
+def get_registry():
+    global registry
+    with _registry_lock:
+        if registry is None:
+            registry = BackendRegistry.from_file(os.getenv("MOM_MODELS_CONFIG", DEFAULT_CONFIG_PATH))
+        return registry
+
+
+def architecture_models(name):
+    return get_registry().architecture(name)
+
+
+# How many local models can run at the same time over all the Ollama nodes that are up
+def local_capacity():
+    return sum(provider.pool.capacity() for provider in get_registry().providers() if isinstance(provider, OllamaProvider)) or 1
+
+
+def _as_messages(prompt, schema=None):
+    if isinstance(prompt, list):
+        messages = [{"role": "user", "content": message} if not isinstance(message, dict) else message for message in prompt]
+    else:
+        messages = [{"role": "user", "content": prompt}]
+    # The reply format goes after the prompt, so the prompt still starts the same way
+    if schema is not None:
+        messages[-1] = {**messages[-1], "content": f"{messages[-1]['content']}\n\n{schema_instruction(schema)}"}
+    return messages
+
+
+# Function to ask a declared model, through the response cache. `system_message` defaults to the model's own. With a JSON `schema` (not for
+# streaming) the reply format is added to the prompt and the backend's JSON mode is switched on.
+def ask(spec, prompt, system_message=None, stream=False, schema=None):
+    system_message = system_message or spec.system_message
+    messages = _as_messages(prompt, schema)
+    provider = get_registry().provider(spec.backend)
+    if stream:
+        tokens = cached_stream(spec.backend, spec.model, system_message, messages, spec.temperature, spec.max_tokens,
+                               lambda: stream_with_retries(lambda: provider.stream(spec, system_message, messages),
+                                                           provider.attempts(spec, system_message, messages)))
+        return tokens
+
+    def call():
+        return call_with_retries(lambda: provider.complete(spec, system_message, messages, schema),
+                                 provider.attempts(spec, system_message, messages))
+
+    return cached(spec.backend, spec.model, system_message, messages, spec.temperature, spec.max_tokens, call)
+
+
+# Function to ask for a reply in the `schema` format (see structured_output). A reply that
+# doesn't fit is sent back with what is wrong with it, up to `retries` times (default
+# MOM_STRUCTURED_RETRIES); the conversation up to then is unchanged, so a backend that caches
+# prompts only evaluates the correction. Returns the value, or None when no reply fit, and the
+# last reply.
+def ask_structured(spec, prompt, schema, system_message=None, retries=None):
+    if retries is None:
+        retries = structured_retries_from_env()
+    messages = _as_messages(prompt)
+    reply = ask(spec, messages, system_message, schema=schema)
+    value, errors = parse_reply(reply, schema)
+    for _ in range(retries):
+        if not errors:
+            break
+        messages = _as_messages(prompt, schema) + [{"role": "assistant", "content": reply}, {"role": "user", "content": repair_prompt(errors)}]
+        reply = ask(spec, messages, system_message, schema=schema)
+        value, errors = parse_reply(reply, schema)
+    return value, reply
+
+
+# Same as ask() for asyncio; with stream=True it returns an async iterator of chunks
+def ask_async(spec, prompt, system_message=None, stream=False, schema=None):
+    system_message = system_message or spec.system_message
+    messages = _as_messages(prompt, schema)
+    provider = get_registry().provider(spec.backend)
+    if stream:
+        tokens = cached_stream_async(spec.backend, spec.model, system_message, messages, spec.temperature, spec.max_tokens,
+                                     lambda: astream_with_retries(lambda: provider.astream(spec, system_message, messages),
+                                                                  provider.attempts(spec, system_message, messages)))
+        return tokens
+    return _ask_async(spec, provider, system_message, messages, schema)
+
+
+async def _ask_async(spec, provider, system_message, messages, schema=None):
+    def acall():
+        return acall_with_retries(lambda: provider.acomplete(spec, system_message, messages, schema),
+                                  provider.attempts(spec, system_message, messages))
+
+    return await cached_async(spec.backend, spec.model, system_message, messages, spec.temperature, spec.max_tokens, acall)
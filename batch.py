@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+import traceback
+
+from fanout import set_global_concurrency
+from run_log import log_run
+from run_metrics import collect_metrics
+from tracing import write_trace
+
+
+ARCHITECTURES = ("king", "duopoly", "democracy")
+
+
+# Function to import the architecture only when it is used
+def load_architecture(name):
+    if name == "king":
+        from theking2 import the_king
+        return the_king
+    if name == "duopoly":
+        from duop import duopoly
+        return duopoly
+    if name == "democracy":
+        from democracy import the_democracy
+        return the_democracy
+    raise ValueError(f"Unknown architecture {name!r}, pick one of {', '.join(ARCHITECTURES)}")
+
+
+# Function to read problems from a JSONL file ({"id": ..., "problem": ...} per line)
+# or from a directory of .txt files (the file name is the id)
+def load_problems(path):
+    problems = []
+    if os.path.isdir(path):
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith(".txt"):
+                with open(os.path.join(path, filename), 'r', encoding='utf-8') as infile:
+                    problems.append({"id": filename[:-4], "problem": infile.read()})
+        return problems
+
+    with open(path, 'r', encoding='utf-8') as infile:
+        for line_number, line in enumerate(infile, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            problems.append({**record, "id": str(record.get("id", line_number))})
+    return problems
+
+
+# Function to read the results written so far, the output file doubles as the checkpoint
+def load_finished(output_path):
+    finished = set()
+    if not os.path.exists(output_path):
+        return finished
+    with open(output_path, 'r', encoding='utf-8', errors='replace') as infile:
+        for line in infile:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue  # a line cut short by a crash, that problem runs again
+            if "error" not in record:
+                finished.add(record["id"])
+    return finished
+
+
+class ResultWriter:
+    def __init__(self, output_path):
+        # Start on a fresh line if the last run crashed halfway through writing one
+        cut_short = False
+        if os.path.exists(output_path) and os.path.getsize(output_path):
+            with open(output_path, 'rb') as existing:
+                existing.seek(-1, os.SEEK_END)
+                cut_short = existing.read(1) != b"\n"
+        self._file = open(output_path, 'a', encoding='utf-8')
+        if cut_short:
+            self._file.write("\n")
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        line = json.dumps(record, ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+def run_batch(problems, architecture, output_path, workers=2, max_calls=None, trace_dir=None, route=False):
+    solve = load_architecture(architecture)
+    set_global_concurrency(max_calls)
+
+    finished = load_finished(output_path)
+    work = queue.Queue()
+    for problem in problems:
+        if problem["id"] not in finished:
+            work.put(problem)
+    print(f"{len(problems)} problems, {len(finished)} already done, {work.qsize()} to run")
+
+    writer = ResultWriter(output_path)
+
+    def worker():
+        while True:
+            try:
+                problem = work.get_nowait()
+            except queue.Empty:
+                return
+            start = time.monotonic()
+            record = {"id": problem["id"], "architecture": architecture, "problem": problem["problem"]}
+            with collect_metrics() as metrics:
+                try:
+                    # The King can leave out advisors that do poorly on the problem's category
+                    if route and architecture == "king" and problem.get("category"):
+                        record["answer"] = solve(problem["problem"], category=problem["category"])
+                    else:
+                        record["answer"] = solve(problem["problem"])
+                except Exception as error:
+                    record["error"] = f"{type(error).__name__}: {error}"
+                    traceback.print_exc()
+            record["seconds"] = round(time.monotonic() - start, 3)
+            record["metrics"] = metrics.summary()
+            if trace_dir:
+                write_trace(metrics, os.path.join(trace_dir, f"{problem['id']}.json"), run_name=f"{architecture} {problem['id']}")
+            writer.write(record)
+            log_run(architecture, problem["problem"], record.get("answer"), metrics, record.get("error"))
+            work.task_done()
+
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, workers))]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    finally:
+        writer.close()
+        set_global_concurrency(None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run an architecture over a set of problems.")
+    parser.add_argument("problems", help="JSONL file with one {\"id\", \"problem\"} per line, or a directory of .txt files")
+    parser.add_argument("--arch", choices=ARCHITECTURES, default="king")
+    parser.add_argument("--output", default="results.jsonl", help="results are appended here, rerun with the same file to resume")
+    parser.add_argument("--workers", type=int, default=2, help="problems solved at the same time")
+    parser.add_argument("--max-calls", type=int, default=None, help="advisor calls in flight across all problems")
+    parser.add_argument("--trace-dir", default=None, help="write an OpenTelemetry (OTLP/JSON) trace of every problem here")
+    parser.add_argument("--route", action="store_true", help="king only: pick the advisors by the problems' \"category\" with the advisor router")
+    args = parser.parse_args()
+    if args.route and args.arch != "king":
+        parser.error("--route only applies to --arch king")
+
+    run_batch(load_problems(args.problems), args.arch, args.output, workers=args.workers, max_calls=args.max_calls, trace_dir=args.trace_dir, route=args.route)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import argparse
+import importlib
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+import model_stats
+import response_cache
+from advisor_router import record_advisor_outcomes
+from batch import load_problems
+from graders import grade
+from model_stats import ModelStats
+from run_log import log_run
+from run_metrics import collect_metrics
+from stub_backend import Recordings, install_recorders, install_stubs
+
+
+# Module and function of each architecture
+ARCHITECTURES = {
+    "king": ("theking2", "the_king"),
+    "duopoly": ("duop", "duopoly"),
+    "democracy": ("democracy", "the_democracy"),
+}
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+# Function to run one architecture over every problem and grade each answer. With `learn` the
+# answers of each advisor are graded too and kept for the advisor router; with `route` the King
+# is told each problem's category so the router picks its advisors.
+def run_architecture(name, problems, learn=False, route=False):
+    module_name, function_name = ARCHITECTURES[name]
+    module = importlib.import_module(module_name)
+    solve = getattr(module, function_name)
+
+    results = []
+    for problem in problems:
+        with collect_metrics() as metrics:
+            start = time.monotonic()
+            error = None
+            try:
+                if route and name == "king" and problem.get("category"):
+                    answer = solve(problem["problem"], category=problem["category"])
+                else:
+                    answer = solve(problem["problem"])
+            except Exception as exception:
+                answer = ""
+                error = f"{type(exception).__name__}: {exception}"
+            seconds = time.monotonic() - start
+        log_run(name, problem["problem"], answer, metrics, error)
+        result = {
+            "id": problem["id"],
+            "category": problem.get("category"),
+            "grader": problem.get("grader", "exact"),
+            "correct": error is None and grade(answer, problem),
+            "seconds": round(seconds, 3),
+            **metrics.summary(),
+        }
+        if error:
+            result["error"] = error
+        if learn and problem.get("category"):
+            record_advisor_outcomes(problem["category"], metrics.advisors, lambda advice: grade(advice, problem))
+        results.append(result)
+        print(f"{name} {problem['id']}: {'correct' if result['correct'] else 'wrong'} in {seconds:.1f}s")
+    return results
+
+
+# Function to add up the per-problem results of one architecture
+def summarize(results):
+    latencies = [result["seconds"] for result in results]
+    stages = {}
+    backends = {}
+    calls = hits = 0
+    for result in results:
+        for stage, seconds in result["stages"].items():
+            stages[stage] = round(stages.get(stage, 0.0) + seconds, 3)
+        for backend, usage in result["backends"].items():
+            total = backends.setdefault(backend, {"calls": 0, "cached": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0,
+                                                  "prompt_eval_seconds": 0.0, "retries": 0, "throttle_seconds": 0.0})
+            for key, value in usage.items():
+                total[key] += value
+            calls += usage["calls"]
+            hits += usage["cached"]
+    for total in backends.values():
+        total["seconds"] = round(total["seconds"], 3)
+        total["prompt_eval_seconds"] = round(total["prompt_eval_seconds"], 3)
+        total["throttle_seconds"] = round(total["throttle_seconds"], 3)
+    return {
+        "problems": len(results),
+        "accuracy": sum(result["correct"] for result in results) / len(results) if results else 0.0,
+        "latency": {
+            "total": round(sum(latencies), 3),
+            "mean": round(statistics.mean(latencies), 3) if latencies else 0.0,
+            "p50": percentile(latencies, 0.5) if latencies else 0.0,
+            "p95": percentile(latencies, 0.95) if latencies else 0.0,
+            "max": max(latencies, default=0.0),
+        },
+        "stage_seconds": stages,
+        "backends": backends,
+        "cache_hit_rate": hits / calls if calls else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure accuracy, latency, tokens and cache use of each architecture.")
+    parser.add_argument("problems", nargs="?", default=os.path.join("benchmarks", "problems.jsonl"), help="labeled problems (JSONL or a directory)")
+    parser.add_argument("--arch", nargs="+", choices=list(ARCHITECTURES), default=list(ARCHITECTURES))
+    parser.add_argument("--mode", choices=("replay", "record", "live"), default="replay",
+                        help="replay answers recorded earlier (offline), record the answers of the real models, or just call the real models")
+    parser.add_argument("--recordings", default=os.path.join("benchmarks", "recordings.jsonl"))
+    parser.add_argument("--replay-speed", type=float, default=0.0, help="1 replays the recorded latency of every call, 0 answers at once")
+    parser.add_argument("--missing", choices=("error", "placeholder"), default="error",
+                        help="fail calls that weren't recorded, so their problems count as failed, or answer them with a placeholder")
+    parser.add_argument("--cache", default=None, help="response cache to use, by default a fresh one so runs are comparable")
+    parser.add_argument("--report", default="benchmark_report.json")
+    parser.add_argument("--route", action="store_true", help="let the advisor router pick the King's advisors by problem category")
+    args = parser.parse_args()
+
+    problems = load_problems(args.problems)
+    if args.mode == "replay" and not os.path.exists(args.recordings):
+        parser.error(f"{args.recordings} doesn't exist, record the models' answers with --mode record first")
+    recordings = Recordings(args.recordings)
+    # Every architecture calls its models through the backend registry, so its clients are swapped once
+    if args.mode == "replay":
+        install_stubs(recordings, speed=args.replay_speed, missing=args.missing)
+        # The stubs answer at once, so their latencies are kept out of the advisors' stats
+        model_stats.model_stats = ModelStats(None)
+    elif args.mode == "record":
+        install_recorders(recordings)
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        response_cache.response_cache = response_cache.ResponseCache(args.cache or os.path.join(cache_dir, "cache.sqlite3"))
+
+        report = {
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "mode": args.mode,
+            "problems": args.problems,
+            "architectures": {},
+        }
+        for name in args.arch:
+            # Only real runs add to the advisors' graded history
+            results = run_architecture(name, problems, learn=args.mode != "replay", route=args.route)
+            report["architectures"][name] = {"summary": summarize(results), "results": results}
+        report["missing_recordings"] = recordings.missing
+        response_cache.response_cache._connection.close()
+
+    with open(args.report, 'w', encoding='utf-8') as outfile:
+        json.dump(report, outfile, indent=2)
+
+    for name, architecture in report["architectures"].items():
+        summary = architecture["summary"]
+        print(f"{name}: accuracy {summary['accuracy']:.0%}, mean latency {summary['latency']['mean']}s, "
+              f"cache hit rate {summary['cache_hit_rate']:.0%}")
+    print(f"Report written to {args.report}")
+    # A replay that didn't find every call in the recordings isn't the benchmark it was recorded as
+    if args.mode == "replay" and recordings.missing:
+        print(f"{recordings.missing} calls had no recording, run with --mode record first")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+import os
+
+from token_count import estimate_tokens
+
+
+DEFAULT_DEBATE_TURNS = 6
+DEFAULT_CONTEXT_BUDGET = 6000  # tokens
+DEFAULT_INSIGHT_TOKENS = 300  # tokens kept per advisor insight
+DEFAULT_RECENT_TURNS = 2  # latest turns that are always kept in full
+DEFAULT_SUMMARY_TOKENS = 120  # tokens kept per older turn
+
+
+def debate_turns_from_env():
+    return int(os.getenv("MOM_DEBATE_TURNS", DEFAULT_DEBATE_TURNS))
+
+
+def context_budget_from_env():
+    return int(os.getenv("MOM_DEBATE_TOKEN_BUDGET", DEFAULT_CONTEXT_BUDGET))
+
+
+# Function to shorten a text to about max_tokens, keeping its start and its end
+# (the end is usually where the final answer is)
+def compact_text(text, max_tokens):
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    keep = max_tokens * 4
+    head = text[: keep * 2 // 3].rstrip()
+    tail = text[-(keep // 3):].lstrip()
+    return f"{head}\n[...]\n{tail}"
+
+
+# Keeps the duopoly conversation under a token budget: the opening prompt with the advisor insights,
+# and the insights of advisors that answered after the debate began, always go first, the latest
+# turns are kept in full and older turns are cut down to their start and end. When that is still
+# too long the oldest turns are dropped.
+class DebateContext:
+    # `count` counts tokens the way the models the conversation goes to do
+    def __init__(self, opening, token_budget=None, recent_turns=DEFAULT_RECENT_TURNS, summary_tokens=DEFAULT_SUMMARY_TOKENS, count=estimate_tokens):
+        self.opening = opening
+        self.count = count
+        self.token_budget = context_budget_from_env() if token_budget is None else token_budget
+        self.recent_turns = recent_turns
+        self.summary_tokens = summary_tokens
+        self.turns = []
+        self.insights = []  # late advisors' insights, in the order they came
+        self.turn_stats = []  # one entry per turn: tokens sent, tokens answered
+
+    def add_turn(self, message, context_tokens):
+        self.turns.append(message)
+        self.turn_stats.append({
+            "turn": len(self.turns),
+            "context_tokens": context_tokens,
+            "message_tokens": self.count(message),
+        })
+
+    def render(self):
+        older = self.turns[:-self.recent_turns] if self.recent_turns else self.turns
+        recent = self.turns[len(older):]
+        older = [compact_text(turn, self.summary_tokens) for turn in older]
+
+        def build(older):
+            dropped = len(self.turns) - len(recent) - len(older)
+            parts = [self.opening] + self.insights
+            if dropped:
+                parts.append(f"[{dropped} earlier turn{'s' if dropped > 1 else ''} left out]\n")
+            return "\n".join(parts + older + recent)
+
+        context = build(older)
+        while older and self.count(context) > self.token_budget:
+            older = older[1:]
+            context = build(older)
+        return context
+
+    # Insights of advisors that answered after the debate began go in after the opening
+    def add_insights(self, insights):
+        self.insights.append(f"{{LATE ADVISORS' INSIGHTS}}:{insights}\n")
@@ -1,31 +1,19 @@
-import anthropic
-from openai import OpenAI
-import os
 from dotenv import load_dotenv
 import re
-import requests
-import markdown
-import webbrowser
-import tempfile
 from tqdm import tqdm
-import time
-from groq import Groq
+from fanout import AnswerFeed, fan_out, fan_out_iter, advisor_notes, advisor_deadline_from_env, advisor_stage, pipeline_first_from_env
+from backends import ask, ask_structured, architecture_models
+from live_html import stream_to_html
+from answer_clusters import cluster_answers, format_clusters, singleton_clusters
+from run_metrics import stage, staged_stream, collect_metrics, record_advisors
+from structured_output import schema_instruction, vote_schema, structured_stages_from_env
+from token_budget import fit_clusters, fit_to_budget, stage_budget
+from tracing import report_run
+from run_log import log_run
 
 
 load_dotenv()
 
-# API keys
-openai_api_key = os.getenv("OPENAI_API_KEY")
-anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
-groq_api_key = os.getenv("GROQ_API_KEY")
-
-# Clients
-anthropic_client = anthropic.Anthropic(api_key=anthropic_api_key)
-ollama_client = OpenAI(base_url='http://localhost:11434/v1', api_key='llama3')
-openai_client = OpenAI(api_key=openai_api_key)
-groq_client = client = Groq(api_key=groq_api_key)
-client = Groq()
-
 PINK = '\033[95m'
 CYAN = '\033[96m'
 YELLOW = '\033[93m'
@@ -36,192 +24,189 @@ def open_file(filepath):
     with open(filepath, 'r', encoding='utf-8') as infile:
         return infile.read()
 
-def groq_llama70B(messages):
-    system_message3="You are a coder and problem solver expert"
-    response = groq_client.chat.completions.create(
-        messages=[
-            {"role": "system", "content": system_message3},
-            {"role": "user", "content": messages}
-        ],
-        model="llama3-70b-8192",
-        temperature=0.3,
-        max_tokens=1024,
-    )
-    message_content = response.choices[0].message.content.strip()
-    return message_content
-
-def ollamacpp(model, messages):
-    system_message = {"role": "system", "content": "You are a coder and problem solver expert"}
-
-    if not isinstance(messages, list):
-        messages = [{"role": "user", "content": messages}]
-    else:
-        messages = [{"role": "user", "content": msg} if not isinstance(msg, dict) else msg for msg in messages]
-    messages.insert(0, system_message)
-
-    response = ollama_client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=0.3
-    )
-
-    message_content = response.choices[0].message.content.strip()
-    return message_content  
-
-
-def claude3(messages):
-    response = anthropic_client.messages.create(
-        model="claude-3-sonnet-20240229",
-        messages=[{"role": "user", "content": messages}],
-        max_tokens=700,
-        system="You are a coder and problem solver expert",
-        temperature=0.3
-    )
-
-    message_content = response.content
-    message_content = message_content[0].text.strip()
-    return message_content
-
-def openai(messages, system_message):
-    response = openai_client.chat.completions.create(
-        model="gpt-4-turbo",
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": messages}
-        ],
-        temperature=0.3
-    )
-    message_content = response.choices[0].message.content.strip()
-    return message_content
-
-def generate_html_response(full_response):
-    html_content = f'''
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Interactive AI Response</title>
-        <style>
-            body {{
-                font-family: 'Arial', sans-serif;
-                background-color: #f4f4f4;
-                margin: 40px;
-                color: #333;
-            }}
-            .container {{
-                background-color: white;
-                border: 1px solid #ccc;
-                border-radius: 8px;
-                padding: 20px;
-                box-shadow: 0 4px 8px rgba(0,0,0,0.1);
-            }}
-            pre {{
-                background-color: #282a36;
-                color: #f8f8f2;
-                border-radius: 5px;
-                border: 1px solid #ccc;
-                padding: 10px;
-                font-family: 'Consolas', 'Courier New', Courier, monospace;
-                overflow: auto;
-                white-space: pre-wrap;
-            }}
-            h1 {{
-                color: #2c3e50;
-            }}
-            p, ol {{
-                line-height: 1.6;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>Response from AI Advisors</h1>
-            <p>This section contains dynamically generated responses from various AI models processed by the <code>the_king</code> function.</p>
-            <pre>{full_response}</pre>
-        </div>
-    </body>
-    </html>
-    '''
-
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.html') as temp_file:
-        temp_file.write(html_content)
-        webbrowser.open('file://' + temp_file.name)
-
-def the_democracy(user_message):
+# The ballot starts with the problem exactly as the advisors were asked it, so a local model that
+# is still loaded only evaluates what comes after it (the options and the instructions).
+# A structured ballot leaves the reply format to ask_structured.
+def voting_prompt(model_answers, user_message, structured=False):
+    prompt = f"{user_message}\n\nVoting Options = {model_answers}\n\nGive your vote to the answer above that you think will have the best chance of solving the problem at the top."
+    if structured:
+        return prompt
+    return f"{prompt}\n\nEnd your reply with one line of the form VOTE: <option number>"
+
+
+# Function to read which option a voter picked from the "VOTE: <option number>" line
+def parse_vote(vote, option_names):
+    match = re.search(r"VOTE:\W*(?:option\W*)?(\d+)", vote, re.IGNORECASE)
+    if match and 1 <= int(match.group(1)) <= len(option_names):
+        return option_names[int(match.group(1)) - 1]
+    return None
+
+# Function to read a vote: the option of a structured vote, else the "VOTE:" line of its text
+def read_vote(vote, option_names):
+    value, reply = vote if isinstance(vote, tuple) else (None, vote)
+    if value is not None:
+        return option_names[value["choice_id"] - 1], value["confidence"]
+    return parse_vote(reply, option_names), None
+
+# The leader has won once the runner-up can't catch up even with every vote still outstanding
+def decisive_winner(tally, votes_left):
+    ranked = sorted(tally.values(), reverse=True)
+    if not ranked:
+        return None
+    runner_up = ranked[1] if len(ranked) > 1 else 0
+    if ranked[0] > runner_up + votes_left:
+        return max(tally, key=tally.get)
+    return None
+
+# Every vote is in: the most votes win, a tie goes to the option its voters were surer of and
+# then to the one more advisors gave
+def plurality_winner(tally, confidence, support):
+    if not tally:
+        return None
+    return max(tally, key=lambda option: (tally[option], sum(confidence.get(option, [])), support[option]))
+
+def the_democracy(user_message, stream=False, early_quorum=True, cluster=True, structured=None, pipeline_first=None):
     system_message3 = "You have the authority to count all votes and find the soulution to the problem that got the most votes. Return the highest voted soultion"
-    system_message2 = "You are a coder and problem solver expert"
     
-    models = {
-        "wizardlm2:7b": "Wizardlm2",
-        "llama3": "Llama3 8B",
-        "mistral": "Mistral 7B",
-        "qwen:14b": "Qwen 14B",
-        "phi3": "Phi3",
-        "openchat": "OpenChat",
-        "gemma:7b": "Gemma 7B",
-        "magicoder": "Magicoder",
-        "codeqwen": "CodeQwen"
-    }
-    answers = {}
-    tasks = [f"Consulting {name}" for name in models.values()]
-    progress_bar = tqdm(tasks, desc="Gathering insights", unit="task")
-
-    for model, name in models.items():
-        progress_bar.set_description(f"Consulting {name}")
-        answers[name] = ollamacpp(model, user_message)
-        progress_bar.update()
-
-    progress_bar.set_description("Consulting Llama3 70B")
-    answers["Llama3 70B"] = groq_llama70B(user_message)
-    progress_bar.update()
+    # The advisors (who are also the voters), the backup model and the counter are declared in models.json
+    models = architecture_models("democracy")
+    voters = {advisor.name: advisor for advisor in models["advisors"]}
+    # Send every advisor request at once, the answers come back in the order of `calls`
+    calls, policy = advisor_stage("democracy", user_message, models)
+    report = policy["report"]
+
+    progress_bar = tqdm(total=len(calls), desc="Gathering insights", unit="task")
+    if structured is None:
+        structured = "votes" in structured_stages_from_env()
+    if pipeline_first is None:
+        pipeline_first = pipeline_first_from_env()
+
+    # Number the options so each vote can be read as a choice instead of free text.
+    # Advisors that reached the same result share one option that shows how many gave it.
+    # The ballot goes to every voter, so the options are cut down until it fits the smallest context window.
+    def ballot(answers, notes=""):
+        clusters = cluster_answers(answers) if cluster else singleton_clusters(answers)
+        fixed = voting_prompt(notes, user_message, structured)
+        if structured:
+            fixed += f"\n\n{schema_instruction(vote_schema(len(clusters)))}"
+        system_message = max((voter.system_message or "" for voter in voters.values()), key=len)
+        fit_clusters(clusters, *stage_budget("votes", list(voters.values()), system_message, fixed), "votes")
+        model_answers = format_clusters(clusters, numbered=True)
+        if notes:
+            model_answers += f"\n\n{notes}"
+        return clusters, voting_prompt(model_answers, user_message, structured)
+
+    # Structured votes ({choice_id, confidence}) are counted here, the counter model is only
+    # asked when no vote could be read
+    def vote_calls(names, clusters, voting):
+        if structured:
+            schema = vote_schema(len(clusters))
+            return {name: (ask_structured, voters[name], voting, schema) for name in names}
+        return {name: (ask, voters[name], voting) for name in names}
 
-    progress_bar.set_description("Consulting Claude3")
-    answers["Claude3"] = claude3(user_message)
-    progress_bar.update()
-
-    progress_bar.set_description("Consulting OpenAI")
-    answers["OpenAI"] = openai(user_message, system_message2)
-    progress_bar.update()
-
-    model_answers = "\n\n".join(f"{name}'s advice: {advice}" for name, advice in answers.items())
-
-    progress_bar.set_description("Gathering Answers")
-    
     votes = {}
-    task2 = [f"Consulting {name}" for name in models.values()]
-    progress_bar = tqdm(task2, desc="Gathering votes", unit="task")
-    
-    voting = (f"Voting Options = {model_answers}\n\nGive your vote to the answer above that you think will have the best chance of solving the following problem: {user_message}")
+    choices = {}  # voter -> (the representative it voted for, how sure it was)
+    if pipeline_first:
+        # The advisors among the first answers vote on a ballot of those answers while the others
+        # are still answering, the others vote on the whole ballot. A vote counts for the option
+        # its answer ends up in, so a later answer with the same result adds to it.
+        feed = AnswerFeed(calls, progress_bar, **policy)
+        answers = feed.take(pipeline_first)
+        clusters, voting = ballot(answers)
+        option_names = [option["representative"] for option in clusters]
+        with stage("votes"):
+            for name, vote in fan_out_iter(vote_calls([name for name in voters if name in answers], clusters, voting),
+                                           deadline=advisor_deadline_from_env(), skip_failures=True):
+                votes[name] = vote[1] if structured else vote
+                choices[name] = read_vote(vote, option_names)
+        answers.update(feed.rest())
+        answers = {name: answers[name] for name in calls if name in answers}
+    else:
+        with stage("advisors"):
+            answers = fan_out(calls, progress_bar, **policy)
+    record_advisors(answers, report)
+    notes = advisor_notes(report)
+    if notes:
+        print(notes)
+
+    clusters, voting = ballot(answers, notes)
+    option_names = [option["representative"] for option in clusters]
+    support = {option["representative"]: len(option["members"]) for option in clusters}
+    option_of = {member: option["representative"] for option in clusters for member in option["members"]}
+    calls = vote_calls([name for name in voters if name not in votes], clusters, voting)
 
-    for model, name in models.items():
-        progress_bar.set_description(f"Consulting {name}")
-        votes[name] = ollamacpp(model, voting)
+    progress_bar.close()
+    progress_bar = tqdm(total=len(calls) + 1, desc="Gathering votes", unit="task")
+
+    # Count the votes as they come in and stop as soon as the result can't change anymore
+    tally = {}
+    confidence = {}
+
+    def count(choice, sureness):
+        choice = option_of.get(choice)
+        if choice is not None:
+            tally[choice] = tally.get(choice, 0) + 1
+        if sureness is not None:
+            confidence.setdefault(choice, []).append(sureness)
+
+    for choice, sureness in choices.values():
+        count(choice, sureness)
+    winner = None
+    with stage("votes"):
+        votes_stream = fan_out_iter(calls, progress_bar, deadline=advisor_deadline_from_env(), skip_failures=True)
+        for name, vote in votes_stream:
+            votes[name] = vote[1] if structured else vote
+            count(*read_vote(vote, option_names))
+            if early_quorum:
+                winner = decisive_winner(tally, len(voters) - len(votes))
+                if winner is not None:
+                    break
+        votes_stream.close()  # Cancels the votes that are no longer needed
+    decided_early = winner is not None
+    if winner is None and (structured or pipeline_first):
+        winner = plurality_winner(tally, confidence, support)
+
+    if winner is not None:
+        progress_bar.set_description(f"{winner} won the vote")
+        final_answer = f"Winning solution: {winner}'s advice (given by {support[winner]} advisors) with {tally[winner]} of {len(voters)} votes"
+        if confidence.get(winner):
+            final_answer += f", average confidence {sum(confidence[winner]) / len(confidence[winner]):.2f}"
+        if decided_early:
+            final_answer += f" (decided after {len(votes)} votes)"
+        final_answer += f"\n\n{answers[winner]}"
         progress_bar.update()
-
-    progress_bar.set_description("Consulting Llama3 70B")
-    votes["Llama3 70B"] = groq_llama70B(voting)
-    progress_bar.update()
-
-    progress_bar.set_description("Consulting Claude3")
-    votes["Claude3"] = claude3(voting)
-    progress_bar.update()
-
-    progress_bar.set_description("Consulting OpenAI")
-    votes["OpenAI"] = openai(voting, system_message2)
-    progress_bar.update()
-
-    all_votes = "\n\n".join(f"{name}'s advice: {advice}" for name, advice in votes.items())
+        progress_bar.close()
+        if stream:
+            return iter([final_answer])
+        return final_answer
+
+    # In the order of the voters rather than of their answers, so the prompt doesn't depend on timing
+    budget, count_tokens = stage_budget("count", [models["counter"]], system_message3,
+                                        "Count all the following votes: \n\nPrint the winning soulution with most votes and the numbers of votes:")
+    votes = fit_to_budget({name: votes[name] for name in voters if name in votes}, budget, count_tokens, "count")
+    all_votes = "\n\n".join(f"{name}'s advice: {vote}" for name, vote in votes.items())
     
     # Final processing and output
     progress_bar.set_description("Counting Votes")
     final_count = (f"Count all the following votes: {all_votes}\n\nPrint the winning soulution with most votes and the numbers of votes:")
-    final_answer = openai(final_count, system_message3)
+    if stream:
+        progress_bar.update()
+        progress_bar.close()
+        return staged_stream("count", ask(models["counter"], final_count, system_message3, stream=True))
+    with stage("count"):
+        final_answer = ask(models["counter"], final_count, system_message3)
     progress_bar.update()
 
     progress_bar.close()
     return final_answer
 
-question = open_file("problem.txt")
-html_response1 = the_democracy(question)
-generate_html_response(html_response1)
+if __name__ == "__main__":
+    question = open_file("problem.txt")
+    with collect_metrics() as metrics:
+        html_response1 = stream_to_html(
+            the_democracy(question, stream=True),
+            "Response from AI Advisors",
+            "This section contains dynamically generated responses from various AI models processed by the <code>the_democracy</code> function.",
+        )
+    report_run(metrics, "democracy")
+    log_run("democracy", question, html_response1, metrics)
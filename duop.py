@@ -1,31 +1,20 @@
-import anthropic
-from openai import OpenAI
-import os
 from dotenv import load_dotenv
-import re
-import requests
-import markdown
-import webbrowser
-import tempfile
 from tqdm import tqdm
 import time
-from groq import Groq
+from fanout import AnswerFeed, fan_out, advisor_notes, advisor_stage, pipeline_first_from_env
+from backends import ask, ask_structured, architecture_models
+from live_html import stream_to_html
+from answer_clusters import cluster_answers, format_clusters, extract_final_answer, singleton_clusters
+from debate_context import DebateContext, compact_text, context_budget_from_env, debate_turns_from_env, DEFAULT_INSIGHT_TOKENS
+from token_budget import fit_clusters, stage_budget
+from run_metrics import stage, staged_stream, collect_metrics, record_advisors
+from structured_output import ANSWER_SCHEMA, format_answer, structured_stages_from_env
+from tracing import report_run
+from run_log import log_run
 
 
 load_dotenv()
 
-# API keys
-openai_api_key = os.getenv("OPENAI_API_KEY")
-anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
-groq_api_key = os.getenv("GROQ_API_KEY")
-
-# Clients
-anthropic_client = anthropic.Anthropic(api_key=anthropic_api_key)
-ollama_client = OpenAI(base_url='http://localhost:11434/v1', api_key='llama3')
-openai_client = OpenAI(api_key=openai_api_key)
-groq_client = client = Groq(api_key=groq_api_key)
-
-client = Groq()
 
 # Colors (unused in HTML output, kept for possible console outputs or further expansions)
 PINK = '\033[95m'
@@ -39,180 +28,160 @@ def open_file(filepath):
     with open(filepath, 'r', encoding='utf-8') as infile:
         return infile.read()
 
-def groq_llama70B(messages):
-    system_message3="You are a coder and problem solver expert"
-    response = groq_client.chat.completions.create(
-        messages=[
-            {"role": "system", "content": system_message3},
-            {"role": "user", "content": messages}
-        ],
-        model="llama3-70b-8192",
-        temperature=0.3,
-        max_tokens=1024,
-    )
-    message_content = response.choices[0].message.content.strip()
-    return message_content
-
-def ollamacpp(model, messages):
-    system_message = {"role": "system", "content": "You are a coder and problem solver expert"}
-
-    # Ensure messages is a list and each element is properly formatted
-    if not isinstance(messages, list):
-        messages = [{"role": "user", "content": messages}]
-    else:
-        messages = [{"role": "user", "content": msg} if not isinstance(msg, dict) else msg for msg in messages]
-    messages.insert(0, system_message)
-
-    response = ollama_client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=0.3
-    )
-
-    message_content = response.choices[0].message.content.strip()
-    return message_content   
-
-
-def claude3(messages, system_message):
-    response = anthropic_client.messages.create(
-        model="claude-3-opus-20240229",
-        messages=[{"role": "user", "content": messages}],
-        max_tokens=700,
-        system=system_message,
-        temperature=0.3,
-        stream=False
-    )
-
-    message_content = response.content
-    message_content = message_content[0].text.strip()
-    return message_content
-
-def openai(messages, system_message):
-    response = openai_client.chat.completions.create(
-        model="gpt-4-turbo",
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": messages}
-        ],
-        temperature=0.3
-    )
-
-    message_content = response.choices[0].message.content.strip()
-    return message_content
-
-def duopoly(user_message):
+# Advisors that reached the same result are passed on once with their support count,
+# and every insight is cut down so it doesn't get resent in full on every turn. With a budget
+# (tokens, count) they are cut down further until they all fit in it.
+def format_insights(answers, cluster=True, budget=None):
+    insights = cluster_answers(answers) if cluster else singleton_clusters(answers)
+    for insight in insights:
+        insight["answer"] = compact_text(insight["answer"], DEFAULT_INSIGHT_TOKENS)
+    if budget is not None:
+        fit_clusters(insights, *budget, "debate")
+    return format_clusters(insights)
+
+def duopoly(user_message, stream=False, cluster=True, turns=None, context_budget=None, stop_on_agreement=True, structured=None, pipeline_first=None):
     system_message_oi = (f"You are a wise and knowledgeable openai coder and problem solver expert who provides thoughtful answers to questions. Discuss and push back at Claude3 Oracle, challenge his suggestions and evaluate the best solutions based on the context from other advisors answers to solve the problem {user_message}")
     system_message_c3 = (f"You are a wise and knowledgeable claude3 coder and problem solver expert who provides thoughtful answers to questions. Discuss and push back at OpenAI Oracle, challenge his suggestions and evaluate the best solutions based on the context from other advisors answers to solve the problem {user_message}")
     system_message5 = ("You are an expert at looking at a conversation between two smart oracles and extracting the best answer to a problem from the conversation.")
     
-    conversation_history = []  # This will store the conversation history
-    
-    models = {
-        "wizardlm2:7b": "Wizardlm2",
-        "llama3": "Llama3 8B",
-        "mistral": "Mistral 7B",
-        "qwen:14b": "Qwen 14B",
-        "phi3": "Phi3",
-        "gemma:7b": "Gemma 7B",
-        "codeqwen": "CodeQwen",
-        "openchat": "OpenChat",
-        "magicoder": "Magicoder"
-    }
-    answers = {}
-    tasks = [f"Consulting {name}" for name in models.values()]
-    progress_bar = tqdm(tasks, desc="Gathering insights", unit="task")
-
-    for model, name in models.items():
-        progress_bar.set_description(f"Consulting {name}")
-        answers[name] = ollamacpp(model, user_message)
-        progress_bar.update()  
-        
-    peasant_answers = "\n\n".join(f"{name}'s advice: {advice}" for name, advice in answers.items())
-    
-    oracle_prompt = (f"{{ADVISORS' INSIGHTS}}:{peasant_answers}\n\nHello Oracle OpenAI, this is Oracle Claude3. Let's discuss and find a solution to the {{PROBLEM}} while challenging and taking the {{ADVISORS' INSIGHTS}} into consideration. Solve the {{PROBLEM}}: {user_message}")
-
-    conversation_history.append(oracle_prompt)  # Start the conversation
-
-    for i in range(6):  # Six turns of discussion
-        current_context = "\n".join(conversation_history)
+    # The advisors, the backup model and the oracles are declared in models.json
+    models = architecture_models("duopoly")
+    calls, policy = advisor_stage("duopoly", user_message, models, system_message=max(system_message_oi, system_message_c3, system_message5, key=len))
+    report = policy["report"]
+    progress_bar = tqdm(total=len(calls) + 1, desc="Gathering insights", unit="task")
+    if pipeline_first is None:
+        pipeline_first = pipeline_first_from_env()
+    if pipeline_first:
+        # The debate opens with the first answers, the later ones are added before the next turn
+        feed = AnswerFeed(calls, progress_bar, **policy)
+        answers = feed.take(pipeline_first)
+        notes = ""
+    else:
+        feed = None
+        with stage("advisors"):
+            answers = fan_out(calls, progress_bar, **policy)
+        record_advisors(answers, report)
+        notes = advisor_notes(report)
+        if notes:
+            print(notes)
+
+    # The greeting and the problem come before the insights, and every turn is added after them,
+    # so each turn's prompt starts with the previous one's opening
+    oracle_opening = (f"Hello Oracle OpenAI, this is Oracle Claude3. Let's discuss and find a solution to the {{PROBLEM}} while challenging and taking the {{ADVISORS' INSIGHTS}} into consideration. Solve the {{PROBLEM}}: {user_message}\n\n{{ADVISORS' INSIGHTS}}:")
+    summary_instructions = f"Summarize the conversation and conclude with a final answer to the {user_message}:\n"
+
+    # The conversation goes to both oracles and then to the summary, so it is kept under the
+    # smallest of their context windows as well as the token budget, counted the way that model counts.
+    # The insights may take up to half of it, the turns get the rest. When the debate opens on the
+    # first answers, those only get their share of it and the rest is kept for the later ones.
+    debate_models = [models["claude_oracle"], models["openai_oracle"], models["summary"]]
+    window_budget, count = stage_budget("debate", debate_models, max(system_message_oi, system_message_c3, system_message5, key=len), summary_instructions)
+    if context_budget is None:
+        context_budget = context_budget_from_env()
+    context_budget = min(context_budget, window_budget)
+    insights_left = context_budget // 2 - count(oracle_opening)
+    first_share = insights_left * len(answers) // len(calls) if feed is not None else insights_left
+    peasant_answers = format_insights(answers, cluster, (first_share, count))
+    insights_left -= count(peasant_answers)
+    if notes:
+        peasant_answers += f"\n\n{notes}"
+    oracle_prompt = f"{oracle_opening}{peasant_answers}"
+
+    # The debate context keeps the conversation under the token budget
+    debate = DebateContext(oracle_prompt, token_budget=context_budget, count=count)
+    if turns is None:
+        turns = debate_turns_from_env()
+
+    def add_late_insights():
+        nonlocal insights_left
+        late = feed.take()
+        if late:
+            insights = format_insights(late, cluster, (insights_left, count))
+            insights_left -= count(insights)
+            debate.add_insights(insights)
+
+    # The debate ends early once both oracles give the same final answer
+    final_answers = {}
+    turns_run = 0
+    debate_start = time.monotonic()
+    for i in range(turns):
+        turns_run += 1
+        if feed is not None:
+            add_late_insights()
+        current_context = debate.render()
+        context_tokens = count(current_context)
         if i % 2 == 0:  # OpenAI's turn to speak
-            claude_message = claude3(current_context, system_message_c3)
+            with stage(f"debate turn {i + 1}"):
+                claude_message = ask(models["claude_oracle"], current_context, system_message_c3)
             openai_message = f"Oracle Claude3 said: {claude_message}\n"
             print(YELLOW + openai_message + RESET_COLOR)
-            conversation_history.append(openai_message)
+            debate.add_turn(openai_message, context_tokens)
+            final_answers["Claude3"] = extract_final_answer(claude_message)
         else:  # Claude3's turn to speak
-            openai_message = openai(current_context, system_message_oi)
+            with stage(f"debate turn {i + 1}"):
+                openai_message = ask(models["openai_oracle"], current_context, system_message_oi)
             claude_message = f"Oracle OpenAI responded: {openai_message}\n"
             print(CYAN + claude_message + RESET_COLOR)
-            conversation_history.append(claude_message)
-
-        time.sleep(1)  # Simulate processing time
+            debate.add_turn(claude_message, context_tokens)
+            final_answers["OpenAI"] = extract_final_answer(openai_message)
+
+        if stop_on_agreement and len(final_answers) == 2 and None not in final_answers.values() \
+                and final_answers["Claude3"] == final_answers["OpenAI"]:
+            break
+
+    # The fixed one-second pause that used to follow each turn is gone, and the turns that
+    # were not needed would have taken about as long as the average turn plus that pause
+    debate_seconds = time.monotonic() - debate_start
+    turns_saved = turns - turns_run
+    seconds_saved = turns_run * 1 + turns_saved * (debate_seconds / turns_run + 1) if turns_run else 0
+    print(f"Debate finished after {turns_run} of {turns} turns in {debate_seconds:.1f}s, "
+          f"saved {turns_saved} turns and about {seconds_saved:.1f}s")
+
+    for stats in debate.turn_stats:
+        print(f"Turn {stats['turn']}: {stats['context_tokens']} tokens sent, {stats['message_tokens']} tokens answered")
+
+    # Answers that came during the last turn are still added, the advisors that haven't answered
+    # by now are left out
+    if feed is not None:
+        add_late_insights()
+        feed.close()
+        record_advisors(feed.taken(), report)
+        notes = advisor_notes(report)
+        if notes:
+            print(notes)
 
     # Combine the conversation history for final response
-    full_conversation = "\n".join(conversation_history)
-    final_response = openai(f"Summarize the conversation and conclude with a final answer to the {user_message}:\n{full_conversation}", system_message5)
+    full_conversation = debate.render()
+    summary_prompt = f"{summary_instructions}{full_conversation}"
+    if structured is None:
+        structured = "answers" in structured_stages_from_env()
+    if structured:
+        with stage("summary"):
+            answer, reply = ask_structured(models["summary"], summary_prompt, ANSWER_SCHEMA, system_message5)
+        final_response = format_answer(answer) if answer is not None else reply
+        progress_bar.update()
+        progress_bar.close()
+        return iter([final_response]) if stream else final_response
+    if stream:
+        progress_bar.update()
+        progress_bar.close()
+        return staged_stream("summary", ask(models["summary"], summary_prompt, system_message5, stream=True))
+    with stage("summary"):
+        final_response = ask(models["summary"], summary_prompt, system_message5)
     progress_bar.update()
 
     progress_bar.close()  # Close the progress bar
     return final_response
 
 
-# The HTML generator function remains the same
-def generate_html_response(full_response):
-    html_content = f'''
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Interactive AI Response</title>
-        <style>
-            body {{
-                font-family: 'Arial', sans-serif;
-                background-color: #f4f4f4;
-                margin: 40px;
-                color: #333;
-            }}
-            .container {{
-                background-color: white;
-                border: 1px solid #ccc;
-                border-radius: 8px;
-                padding: 20px;
-                box-shadow: 0 4px 8px rgba(0,0,0,0.1);
-            }}
-            pre {{
-                background-color: #282a36;
-                color: #f8f8f2;
-                border-radius: 5px;
-                border: 1px solid #ccc;
-                padding: 10px;
-                font-family: 'Consolas', 'Courier New', Courier, monospace;
-                overflow: auto;
-                white-space: pre-wrap;
-            }}
-            h1 {{
-                color: #2c3e50;
-            }}
-            p, ol {{
-                line-height: 1.6;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>Response from AI Oracles</h1>
-            <p>This section contains dynamically generated responses from a discussion between Oracle AI models, processed and finalized for the user.</p>
-            <pre>{full_response}</pre>
-        </div>
-    </body>
-    </html>
-    '''
-
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.html') as temp_file:
-        temp_file.write(html_content)
-        webbrowser.open('file://' + temp_file.name)
-
-# Example usage
-question = open_file("problem.txt")
-final_response = duopoly(question)
-generate_html_response(final_response)
+if __name__ == "__main__":
+    # Example usage
+    question = open_file("problem.txt")
+    with collect_metrics() as metrics:
+        final_response = stream_to_html(
+            duopoly(question, stream=True),
+            "Response from AI Oracles",
+            "This section contains dynamically generated responses from a discussion between Oracle AI models, processed and finalized for the user.",
+        )
+    report_run(metrics, "duopoly")
+    log_run("duopoly", question, final_response, metrics)
@@ -0,0 +1,318 @@
+import contextvars
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+
+from backends import ask
+from model_stats import get_model_stats
+from run_metrics import current_stage_name, mark_queued, stage, track_call_outcome
+from token_budget import check_run
+
+
+# Default number of model calls in flight at once (override with MOM_MAX_CONCURRENCY in .env)
+DEFAULT_MAX_CONCURRENCY = 12
+
+
+def max_concurrency_from_env():
+    return int(os.getenv("MOM_MAX_CONCURRENCY", DEFAULT_MAX_CONCURRENCY))
+
+
+# Optional limit on model calls in flight across every fan-out in the process, used when
+# several problems are solved at the same time (see batch.py)
+_global_slots = None
+
+
+def set_global_concurrency(limit):
+    global _global_slots
+    _global_slots = threading.BoundedSemaphore(limit) if limit else None
+
+
+def _call_with_global_slot(func, *args):
+    slots = _global_slots
+    if slots is None:
+        return func(*args)
+    with slots:
+        return func(*args)
+
+
+# Remote calls go first so they never wait behind local calls queued in the Ollama scheduler,
+# then local calls grouped by model so each model is loaded once
+def submission_order(calls):
+    def key(name):
+        func, *args = calls[name]
+        spec = args[0] if args else None
+        if getattr(spec, "local", False):
+            return (1, spec.model)
+        return (0, "")
+
+    return sorted(calls, key=key)
+
+
+# Optional straggler cutoff for the advisor stage (set in .env): start once MOM_ADVISOR_QUORUM
+# advisors have answered and/or drop the ones that haven't answered after MOM_ADVISOR_DEADLINE seconds
+def advisor_quorum_from_env():
+    quorum = os.getenv("MOM_ADVISOR_QUORUM")
+    return int(quorum) if quorum else None
+
+
+def advisor_deadline_from_env():
+    deadline = os.getenv("MOM_ADVISOR_DEADLINE")
+    return float(deadline) if deadline else None
+
+
+# Optional pipelining of the advisor stage (MOM_PIPELINE_FIRST in .env): the next stage starts
+# once that many advisors have answered and takes the later answers as they come in
+def pipeline_first_from_env():
+    first = os.getenv("MOM_PIPELINE_FIRST")
+    return int(first) if first else None
+
+
+def _timed_call(func, *args):
+    outcome = track_call_outcome()
+    start = time.monotonic()
+    result = _call_with_global_slot(func, *args)
+    return result, time.monotonic() - start, outcome.get("cached", False)
+
+
+# Function to send all calls at once and yield (name, answer) pairs as each call completes.
+# `calls` maps a display name to a tuple of (function, *args). When the caller stops reading
+# early, the calls that haven't started yet are cancelled and the running ones are abandoned,
+# and the same happens once `stop`, a Future another thread may set, is done.
+#
+# Straggler policy, all optional:
+#   quorum   - stop once this many calls have answered
+#   deadline - stop after this many seconds
+#   hedges   - name -> (function, *args) of a backup call, sent when the call takes longer than
+#              its usual p95 latency (or fails); whichever of the two answers first is used. A
+#              backup answer to the same call as one already given is a copy and isn't yielded
+#   report   - dict that receives "late" (names dropped by the quorum or deadline),
+#              "hedged" (names answered by their backup call), "copies" (name -> the name whose
+#              backup answer it repeats) and "failed" (name -> error)
+#   skip_failures - leave out a call that failed (after its retries and backup call) instead of
+#              raising, so the answers of the others are kept; raises when every call failed
+def fan_out_iter(calls, progress_bar=None, max_concurrency=None, quorum=None, deadline=None, hedges=None, report=None, skip_failures=False,
+                 stop=None):
+    if max_concurrency is None:
+        max_concurrency = max_concurrency_from_env()
+    hedges = hedges or {}
+    stats = get_model_stats()
+    stage = current_stage_name() or ""
+
+    # Backup calls get their own threads so they never wait behind the calls they replace
+    executor = ThreadPoolExecutor(max_workers=max(1, max_concurrency) + len(hedges))
+    futures = {}  # future -> (name, is backup call)
+    answered = set()
+    hedged_names = set()  # names whose backup call was sent
+    backups = []  # names answered by their backup call
+    copies = {}
+    failed = {}
+    start = time.monotonic()
+
+    def submit(name, call, hedged):
+        func, *args = call
+        # Each call runs in a copy of the caller's context so run metrics and stages follow it,
+        # and its span can tell how long it waited before it started
+        context = contextvars.copy_context()
+        context.run(mark_queued, time.time())
+        future = executor.submit(context.run, _timed_call, func, *args)
+        futures[future] = (name, hedged)
+        return future
+
+    def hedge(name):
+        hedge_after.pop(name, None)
+        hedged_names.add(name)
+        if progress_bar is not None:
+            progress_bar.set_description(f"{name} is slow, asking {getattr(hedges[name][1], 'name', 'a backup model')}")
+        return submit(name, hedges[name], True)
+
+    try:
+        for name in submission_order(calls):
+            submit(name, calls[name], False)
+        hedge_after = {}
+        for name in hedges:
+            p95 = stats.p95(f"{stage}/{name}")
+            if name in calls and p95 is not None:
+                hedge_after[name] = p95
+
+        pending = set(futures)
+        while pending and len(answered) + len(failed) < len(calls):
+            elapsed = time.monotonic() - start
+            timeouts = [after - elapsed for name, after in hedge_after.items() if name not in answered]
+            if deadline is not None:
+                timeouts.append(deadline - elapsed)
+            done, pending = wait(pending if stop is None else pending | {stop}, timeout=max(0, min(timeouts)) if timeouts else None,
+                                 return_when=FIRST_COMPLETED)
+            pending.discard(stop)
+
+            for future in done:
+                if future is stop:
+                    continue
+                name, hedged = futures[future]
+                if name in answered:
+                    continue  # the other call of a hedged pair already answered
+                try:
+                    result, seconds, cached = future.result()
+                except Exception as error:
+                    if any(futures[other][0] == name for other in pending):
+                        continue  # its twin may still answer
+                    # A failed call gets its backup whether or not it has a p95 to hedge on yet
+                    if name in hedges and name not in hedged_names:
+                        pending.add(hedge(name))
+                        continue
+                    if not skip_failures or (not answered and len(failed) + 1 == len(calls)):
+                        raise
+                    failed[name] = f"{type(error).__name__}: {error}"
+                    if progress_bar is not None:
+                        progress_bar.set_description(f"{name} failed")
+                        progress_bar.update()
+                    continue
+                answered.add(name)
+                if hedged:
+                    first = next((other for other in backups if hedges[other] == hedges[name]), None)
+                    if first is not None:
+                        copies[name] = first
+                        if progress_bar is not None:
+                            progress_bar.set_description(f"{name} got the same backup answer as {first}")
+                            progress_bar.update()
+                        continue
+                    backups.append(name)
+                if not cached and not hedged:
+                    stats.record_latency(f"{stage}/{name}", seconds)
+                if report is not None and not cached:
+                    report.setdefault("seconds", {})[name] = round(seconds, 3)
+                if hedged and report is not None:
+                    report.setdefault("hedged", []).append(name)
+                if progress_bar is not None:
+                    progress_bar.set_description(f"{name} answered after {time.monotonic() - start:.1f}s")
+                    progress_bar.update()
+                yield name, result
+                if quorum is not None and len(answered) >= quorum:
+                    return
+
+            if stop is not None and stop.done():
+                return
+            elapsed = time.monotonic() - start
+            for name, after in list(hedge_after.items()):
+                if name not in answered and elapsed >= after:
+                    pending.add(hedge(name))
+            if deadline is not None and elapsed >= deadline:
+                return
+    finally:
+        if report is not None:
+            report["late"] = [name for name in calls if name not in answered and name not in failed]
+            report.setdefault("hedged", [])
+            report["copies"] = copies
+            report["failed"] = failed
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+# Function to send all calls at once and return the answers in the order the calls were given.
+# Calls dropped by the straggler policy (see fan_out_iter) are left out.
+def fan_out(calls, progress_bar=None, max_concurrency=None, **policy):
+    results = dict(fan_out_iter(calls, progress_bar, max_concurrency, **policy))
+
+    # Keep the original order so the joined prompts are deterministic
+    return {name: results[name] for name in calls if name in results}
+
+
+# The answers of a fan-out as they come in, for a stage that starts before the last one is in.
+# fan_out_iter runs in its own thread, in the caller's context and inside stage `stage_name`, and
+# the stage takes the answers it hasn't seen yet with take() and rest(). `report` ends up as
+# fan_out_iter leaves it once the feed is finished, and once it is closed the advisors whose
+# answers the stage didn't take are reported late.
+class AnswerFeed:
+    def __init__(self, calls, progress_bar=None, max_concurrency=None, stage_name="advisors", **policy):
+        self.calls = calls
+        self.report = policy.setdefault("report", {})
+        self.answers = {}  # in the order they came in
+        self.finished = False
+        self.error = None
+        self._taken = set()
+        self._closed = False
+        self._stop = Future()
+        self._condition = threading.Condition()
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(self._run, progress_bar, max_concurrency, stage_name, policy), daemon=True)
+        self._thread.start()
+
+    def _run(self, progress_bar, max_concurrency, stage_name, policy):
+        try:
+            with stage(stage_name):
+                answers = fan_out_iter(self.calls, progress_bar, max_concurrency, stop=self._stop, **policy)
+                for name, answer in answers:
+                    with self._condition:
+                        self.answers[name] = answer
+                        self._condition.notify_all()
+                    if self._closed:
+                        break
+                answers.close()
+        except Exception as error:
+            self.error = error
+        finally:
+            with self._condition:
+                self.finished = True
+                self._condition.notify_all()
+
+    # Function to wait until `count` answers the caller hasn't taken yet are in (or every call is
+    # done) and return them, in the order of the calls
+    def take(self, count=0):
+        with self._condition:
+            while not self.finished and len(self.answers) - len(self._taken) < count:
+                self._condition.wait()
+            if self.error is not None:
+                raise self.error
+            new = {name: self.answers[name] for name in self.calls if name in self.answers and name not in self._taken}
+            self._taken.update(new)
+            return new
+
+    # Function to wait for the calls still out and return the answers not taken yet
+    def rest(self):
+        return self.take(len(self.calls))
+
+    # The answers taken so far, in the order of the calls
+    def taken(self):
+        with self._condition:
+            return {name: self.answers[name] for name in self.calls if name in self._taken}
+
+    # Stops waiting for the calls still out, they are cancelled or abandoned as in fan_out_iter.
+    # Returns once fan_out_iter has written its report, with every advisor whose answer wasn't
+    # taken (and didn't fail or repeat a backup answer) reported as late.
+    def close(self):
+        with self._condition:
+            self._closed = True
+        if not self._stop.done():
+            self._stop.set_result(None)
+        self._thread.join()
+        with self._condition:
+            left_out = set(self.report.get("failed", {})) | set(self.report.get("copies", {}))
+            self.report["late"] = [name for name in self.calls if name not in self._taken and name not in left_out]
+
+
+# Function to set up the advisor stage of an architecture. The run fails before any call when
+# check_run (given `check`) says so. Returns the advisors' calls and the straggler policy for
+# fan_out or AnswerFeed, whose report is policy["report"]: slow or failing local advisors are
+# re-asked to the architecture's backup model, and the ones past the deadline or quorum are left out.
+def advisor_stage(architecture, user_message, models, advisors=None, **check):
+    advisors = models["advisors"] if advisors is None else advisors
+    check_run(architecture, user_message, models, advisors, **check)
+    calls = {advisor.name: (ask, advisor, user_message) for advisor in advisors}
+    hedges = {advisor.name: (ask, models["hedge"], user_message) for advisor in advisors if advisor.local}
+    report = {"backup": models["hedge"].name}
+    policy = dict(quorum=advisor_quorum_from_env(), deadline=advisor_deadline_from_env(), hedges=hedges, report=report, skip_failures=True)
+    return calls, policy
+
+
+# Function to describe which advisors were answered by a backup model and which were left out
+def advisor_notes(report):
+    notes = []
+    if report.get("hedged"):
+        notes.append(f"Answered by {report.get('backup', 'a backup model')} because the advisor was too slow: {', '.join(report['hedged'])}")
+    if report.get("copies"):
+        notes.append("Given the same backup answer as an advisor above, counted once: "
+                     + ", ".join(f"{name} (as {first})" for name, first in report["copies"].items()))
+    if report.get("late"):
+        notes.append(f"No answer in time, left out: {', '.join(report['late'])}")
+    if report.get("failed"):
+        notes.append(f"Failed to answer, left out: {', '.join(report['failed'])}")
+    return "\n".join(notes)
@@ -0,0 +1,72 @@
+import os
+import re
+import subprocess
+import sys
+import tempfile
+
+from answer_clusters import extract_final_answer, normalize_number
+
+
+_CODE_BLOCK = re.compile(r"```[^\n]*\n(.*?)```", re.DOTALL)
+_LIST_ITEM = re.compile(r"^\s*(?:\d+[.)]|[-*•])\s+(.*)$")
+_WORD = re.compile(r"\w+")
+
+
+# Exact answer: a number must match the extracted final result, a word or phrase must appear
+# in the last paragraph of the answer
+def grade_exact(answer, problem):
+    expected = str(problem["expected"]).strip()
+    try:
+        return extract_final_answer(answer) == normalize_number(expected)
+    except ValueError:
+        pass
+    paragraphs = [paragraph for paragraph in re.split(r"\n\s*\n", answer.strip()) if paragraph.strip()]
+    if not paragraphs:
+        return False
+    return re.search(rf"\b{re.escape(expected.lower())}\b", paragraphs[-1].lower()) is not None
+
+
+# Code execution: the last code block plus the problem's test code must run without an error.
+# The code comes from the models, so it runs in a separate Python process with a time limit.
+def grade_code(answer, problem, timeout=10):
+    blocks = _CODE_BLOCK.findall(answer)
+    if not blocks:
+        return False
+    source = blocks[-1] + "\n\n" + problem.get("tests", "")
+    with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.py', encoding='utf-8') as code_file:
+        code_file.write(source)
+    try:
+        result = subprocess.run([sys.executable, code_file.name], capture_output=True, timeout=timeout)
+        return result.returncode == 0
+    except subprocess.TimeoutExpired:
+        return False
+    finally:
+        os.unlink(code_file.name)
+
+
+def _last_word(text):
+    words = _WORD.findall(text)
+    return words[-1].lower() if words else None
+
+
+# Sentences ending with "apples": every sentence asked for must end with the word itself, not
+# one that ends with it such as "pineapples"
+def grade_apples(answer, problem):
+    count = int(problem.get("count", 10))
+    items = [match.group(1) for match in map(_LIST_ITEM.match, answer.splitlines()) if match]
+    if not items:
+        items = re.findall(r"[^.!?\n]+[.!?]", answer)
+    word = problem.get("word", "apples").lower()
+    ending = [item for item in items if _last_word(item) == word]
+    return len(items) >= count and len(ending) == len(items)
+
+
+GRADERS = {
+    "exact": grade_exact,
+    "code": grade_code,
+    "apples": grade_apples,
+}
+
+
+def grade(answer, problem):
+    return GRADERS[problem.get("grader", "exact")](answer, problem)
@@ -0,0 +1,71 @@
+import os
+
+from answer_clusters import cluster_answers, extract_final_answer, format_clusters
+from debate_context import compact_text
+
+
+# The King can go over the problem again (MOM_KING_ROUNDS, 1 by default): after each of its
+# answers only the advisors whose result differs from the King's are asked again, with their own
+# latest answer and the King's answer cut down to MOM_KING_REVIEW_TOKENS, and the King is then
+# shown only the answers that changed. Everything else carries over from the round before, and
+# both conversations start the way the first round's did, so a backend that caches prompts only
+# evaluates the new part. The rounds stop early once no advisor disagrees or none changes its mind.
+DEFAULT_KING_ROUNDS = 1
+DEFAULT_REVIEW_TOKENS = 600  # tokens of the King's answer shown to an advisor that disagrees
+
+
+def king_rounds_from_env():
+    return int(os.getenv("MOM_KING_ROUNDS", DEFAULT_KING_ROUNDS))
+
+
+def review_tokens_from_env():
+    return int(os.getenv("MOM_KING_REVIEW_TOKENS", DEFAULT_REVIEW_TOKENS))
+
+
+# An advisor disagrees when both answers state a result and the results differ; an answer
+# without a result can't be compared and is left as it is
+def disagrees(answer, king_answer):
+    result = extract_final_answer(answer)
+    king_result = extract_final_answer(king_answer)
+    return result is not None and king_result is not None and result != king_result
+
+
+# Function to build the conversation that asks an advisor to check its answer against the King's.
+# `answer` is the advisor's latest, so an answer it already corrected in an earlier round is the
+# one it is shown again.
+def review_messages(user_message, answer, king_answer, review_tokens=None):
+    if review_tokens is None:
+        review_tokens = review_tokens_from_env()
+    review = (f"The King's answer to this problem comes to a different result than yours:\n\n{compact_text(king_answer, review_tokens)}\n\n"
+              "Check your answer against it and reply with your complete answer again, corrected if it was wrong "
+              "or unchanged if you still think it is right.")
+    return [
+        {"role": "user", "content": user_message},
+        {"role": "assistant", "content": answer},
+        {"role": "user", "content": review},
+    ]
+
+
+def _insights(answers, review_tokens):
+    insights = cluster_answers(answers)
+    for insight in insights:
+        insight["answer"] = compact_text(insight["answer"], review_tokens)
+    return format_clusters(insights)
+
+
+# Function to tell the King which advisors changed their answer, which answered after it started
+# (when the advisor stage is pipelined) and how many now share its result
+def king_update_prompt(changed, answers, king_answer, late=None, review_tokens=None):
+    if review_tokens is None:
+        review_tokens = review_tokens_from_env()
+    sections = []
+    if late:
+        sections.append(f"These advisors answered after you started:\n\n{_insights(late, review_tokens)}")
+    if changed:
+        sections.append(f"The advisors that disagreed with you were shown your answer and asked again. These changed their answer:\n\n"
+                        f"{_insights(changed, review_tokens)}")
+    king_result = extract_final_answer(king_answer)
+    agreeing = sum(extract_final_answer(answer) == king_result for answer in answers.values()) if king_result is not None else 0
+    sections.append(f"{agreeing} of {len(answers)} advisors now come to your result. "
+                    "Reconsider the problem with this in mind and give your complete answer again, corrected if needed.")
+    return "\n\n".join(sections)
@@ -0,0 +1,94 @@
+import html
+import tempfile
+import time
+
+
+# Seconds between rewrites of the HTML page while the answer is streaming in
+REFRESH_INTERVAL = 0.5
+
+
+def render_html(full_response, heading, description, live=False):
+    # While the answer is still streaming the page reloads itself every second
+    refresh = '<meta http-equiv="refresh" content="1">' if live else ''
+    status = '<p><em>The answer is still being written...</em></p>' if live else ''
+    return f'''
+    <!DOCTYPE html>
+    <html lang="en">
+    <head>
+        <meta charset="UTF-8">
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        {refresh}
+        <title>Interactive AI Response</title>
+        <style>
+            body {{
+                font-family: 'Arial', sans-serif;
+                background-color: #f4f4f4;
+                margin: 40px;
+                color: #333;
+            }}
+            .container {{
+                background-color: white;
+                border: 1px solid #ccc;
+                border-radius: 8px;
+                padding: 20px;
+                box-shadow: 0 4px 8px rgba(0,0,0,0.1);
+            }}
+            pre {{
+                background-color: #282a36;
+                color: #f8f8f2;
+                border-radius: 5px;
+                border: 1px solid #ccc;
+                padding: 10px;
+                font-family: 'Consolas', 'Courier New', Courier, monospace;
+                overflow: auto;
+                white-space: pre-wrap;
+            }}
+            h1 {{
+                color: #2c3e50;
+            }}
+            p, ol {{
+                line-height: 1.6;
+            }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <h1>{heading}</h1>
+            <p>{description}</p>
+            {status}
+            <pre>{html.escape(full_response)}</pre>
+        </div>
+    </body>
+    </html>
+    '''
+
+
+def write_html(path, content):
+    with open(path, 'w', encoding='utf-8') as html_file:
+        html_file.write(content)
+
+
+# Function to show a streamed answer as it is written: the tokens are printed to the console
+# and a temp HTML page is opened right away and rewritten while the tokens come in.
+# Returns the full answer once the stream is done.
+def stream_to_html(tokens, heading, description, open_browser=True):
+    with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.html') as temp_file:
+        path = temp_file.name
+    write_html(path, render_html("", heading, description, live=True))
+    if open_browser:
+        import webbrowser  # only needed here, keeps it out of the import of every script
+        webbrowser.open('file://' + path)
+
+    parts = []
+    last_write = time.monotonic()
+    for token in tokens:
+        parts.append(token)
+        print(token, end='', flush=True)
+        if time.monotonic() - last_write >= REFRESH_INTERVAL:
+            write_html(path, render_html("".join(parts), heading, description, live=True))
+            last_write = time.monotonic()
+    print()
+
+    full_response = "".join(parts).strip()
+    write_html(path, render_html(full_response, heading, description))
+    return full_response
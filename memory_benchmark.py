@@ -0,0 +1,137 @@
+import argparse
+import gc
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+from replay import LoggedResponses
+from response_cache import cache_key
+from run_log import read_log
+
+
+# Memory a replay needs for a large run log, with the logged calls kept the old way (every record
+# read into a list and indexed as dicts with its system message, prompt and response) and in an
+# AnswerStore, in memory and spilled to a memory-mapped file. The log is made up: every problem
+# gets a democracy-sized run, each advisor answering and then voting on a ballot of every answer,
+# so most of the text is the same answers sent again in every ballot.
+DEFAULT_PROBLEMS = 1000
+DEFAULT_ADVISORS = 12
+DEFAULT_ANSWER_CHARS = 1200
+WORDS = ("the", "answer", "is", "because", "we", "sum", "each", "term", "so", "value", "loop", "returns", "list", "count", "first", "then")
+
+
+def _text(rng, chars):
+    words = []
+    size = 0
+    while size < chars:
+        word = rng.choice(WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)
+
+
+def _call(run, backend, model, system_message, prompt, response):
+    messages = [{"role": "user", "content": prompt}]
+    return {
+        "type": "call", "run": run, "key": cache_key(backend, model, system_message, messages, 0.3, None),
+        "backend": backend, "model": model, "stage": None, "system": system_message, "messages": messages,
+        "temperature": 0.3, "max_tokens": None, "response": response, "error": None, "cached": False,
+        "start": 0.0, "queue_seconds": 0.0, "ttft_seconds": 0.2, "seconds": 1.5, "prompt_tokens": len(prompt) // 4,
+        "completion_tokens": len(response) // 4, "retries": 0,
+    }
+
+
+# Function to write the made-up log, returns the keys of its calls
+def write_log(path, problems, advisors, answer_chars, seed=0):
+    rng = random.Random(seed)
+    system_message = "You are a coder and problem solver expert"
+    keys = []
+    with open(path, 'w', encoding='utf-8') as outfile:
+        for number in range(problems):
+            run = f"{number:032x}"
+            problem = f"Problem {number}: " + _text(rng, answer_chars)
+            answers = {f"advisor {index}": _text(rng, answer_chars) + f"\nFinal answer: {rng.randint(1, 4)}" for index in range(advisors)}
+            ballot = "\n\n".join(f"Option {index} - {name}'s advice: {answer}" for index, (name, answer) in enumerate(answers.items(), 1))
+            calls = [_call(run, "ollama", name, system_message, problem, answer) for name, answer in answers.items()]
+            calls += [_call(run, "ollama", name, system_message, f"{problem}\n\nVoting Options = {ballot}", f"VOTE: {rng.randint(1, advisors)}")
+                      for name in answers]
+            for call in calls:
+                keys.append((run, call["key"]))
+                outfile.write(json.dumps(call) + "\n")
+            outfile.write(json.dumps({"type": "run", "run": run, "architecture": "democracy", "problem": problem, "answer": ballot[:200]}) + "\n")
+    return keys
+
+
+# The calls of a log the way replay.py used to keep them
+def load_records(path):
+    records = list(read_log(path))
+    responses = {}
+    latest = {}
+    for record in records:
+        if record.get("type") == "call":
+            responses[record.get("run"), record["key"]] = record
+            latest[record["key"]] = record
+    return records, responses, latest
+
+
+def measure(load, lookup, keys):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    index = load()
+    load_seconds = time.perf_counter() - start
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    start = time.perf_counter()
+    for run, key in keys:
+        lookup(index, run, key)
+    lookup_seconds = time.perf_counter() - start
+    return index, {
+        "retained_mb": round(retained / 2 ** 20, 1),
+        "peak_mb": round(peak / 2 ** 20, 1),
+        "load_seconds": round(load_seconds, 2),
+        "lookup_us": round(lookup_seconds / len(keys) * 1e6, 2),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the memory a replay keeps for a large run log, old records against the answer store.")
+    parser.add_argument("--problems", type=int, default=DEFAULT_PROBLEMS)
+    parser.add_argument("--advisors", type=int, default=DEFAULT_ADVISORS)
+    parser.add_argument("--answer-chars", type=int, default=DEFAULT_ANSWER_CHARS)
+    parser.add_argument("--lookups", type=int, default=20000, help="logged calls looked up to time a lookup")
+    parser.add_argument("--report", default=None, help="also write the results as JSON here")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        log_path = os.path.join(directory, "runs.jsonl")
+        keys = write_log(log_path, args.problems, args.advisors, args.answer_chars)
+        sample = random.Random(1).choices(keys, k=args.lookups)
+        print(f"{args.problems} problems, {len(keys)} logged calls, {os.path.getsize(log_path) / 2 ** 20:.1f} MB of log")
+
+        results = {}
+        index, results["records"] = measure(lambda: load_records(log_path), lambda index, run, key: index[1].get((run, key)) or index[2].get(key), sample)
+        del index
+        for name, spill_path in (("store", None), ("store, spilled", os.path.join(directory, "answers.bin"))):
+            responses, results[name] = measure(lambda: LoggedResponses(read_log(log_path), spill_path),
+                                               lambda responses, run, key: responses.store.get(key, run), sample)
+            results[name]["text_mb"] = round(responses.store.strings.nbytes() / 2 ** 20, 1)
+            results[name]["texts"] = len(responses.store.strings)
+            responses.store.close()
+
+    print(f"{'':<16}{'retained MB':>12}{'peak MB':>10}{'load s':>8}{'lookup us':>11}")
+    for name, result in results.items():
+        print(f"{name:<16}{result['retained_mb']:>12}{result['peak_mb']:>10}{result['load_seconds']:>8}{result['lookup_us']:>11}")
+    store = results["store"]
+    print(f"The store keeps {store['texts']} distinct texts, {store['text_mb']} MB, "
+          f"{results['records']['retained_mb'] / max(store['retained_mb'], 0.1):.0f}x less than the records")
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as outfile:
+            json.dump({"problems": args.problems, "calls": len(keys), "results": results}, outfile, indent=2)
+
+
+if __name__ == "__main__":
+    main()
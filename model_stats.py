@@ -0,0 +1,85 @@
+import atexit
+import json
+import os
+import threading
+
+
+# Recent latencies of every advisor, kept between runs in a small JSON file so a slow call can
+# be recognised (and hedged) as soon as it passes what is normal for that advisor. Graded runs
+# also keep how often each advisor was right, which the advisor router picks advisors by.
+DEFAULT_WINDOW = 200  # latencies kept per advisor
+MIN_SAMPLES = 20  # below this there is no reliable p95 yet
+
+
+class ModelStats:
+    def __init__(self, path, window=DEFAULT_WINDOW):
+        self.path = path
+        self.window = window
+        self._lock = threading.Lock()
+        self._data = {}
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as infile:
+                self._data = json.load(infile)
+
+    def record_latency(self, key, seconds):
+        with self._lock:
+            entry = self._data.setdefault(key, {})
+            latencies = entry.setdefault("latencies", [])
+            latencies.append(round(seconds, 3))
+            del latencies[:-self.window]
+
+    def percentile(self, key, fraction, min_samples=MIN_SAMPLES, field="latencies"):
+        with self._lock:
+            values = sorted(self._data.get(key, {}).get(field, []))
+        if not values or len(values) < min_samples:
+            return None
+        return values[min(len(values) - 1, int(fraction * len(values)))]
+
+    def p95(self, key, min_samples=MIN_SAMPLES):
+        return self.percentile(key, 0.95, min_samples)
+
+    # A graded answer: whether it was right, how long it took and how many tokens it had
+    def record_outcome(self, key, correct, seconds=None, tokens=None):
+        with self._lock:
+            entry = self._data.setdefault(key, {})
+            entry["graded"] = entry.get("graded", 0) + 1
+            entry["correct"] = entry.get("correct", 0) + int(bool(correct))
+            for field, value in (("latencies", seconds), ("tokens", tokens)):
+                if value is not None:
+                    values = entry.setdefault(field, [])
+                    values.append(round(value, 3))
+                    del values[:-self.window]
+
+    def outcome(self, key):
+        with self._lock:
+            entry = self._data.get(key, {})
+            graded, correct = entry.get("graded", 0), entry.get("correct", 0)
+        return {
+            "graded": graded,
+            "correct": correct,
+            "median_seconds": self.percentile(key, 0.5, min_samples=1),
+            "median_tokens": self.percentile(key, 0.5, min_samples=1, field="tokens"),
+        }
+
+    def save(self):
+        if not self.path:
+            return
+        with self._lock:
+            data = json.dumps(self._data)
+        with open(self.path, 'w', encoding='utf-8') as outfile:
+            outfile.write(data)
+
+
+model_stats = None
+_stats_lock = threading.Lock()
+
+
+# The stats are loaded on first use so the scripts' load_dotenv() has already run,
+# and written back when the process exits
+def get_model_stats():
+    global model_stats
+    with _stats_lock:
+        if model_stats is None:
+            model_stats = ModelStats(os.getenv("MOM_STATS_PATH", "mom_stats.json"))
+            atexit.register(model_stats.save)
+        return model_stats
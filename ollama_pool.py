@@ -0,0 +1,220 @@
+import argparse
+import threading
+import time
+from contextlib import asynccontextmanager, contextmanager
+
+from ollama_scheduler import OllamaScheduler
+from rate_limits import status_code
+from run_metrics import report_call_started
+
+
+# The local advisors can be spread over several Ollama servers: the `nodes` of the ollama backend
+# in models.json, each with its url, the models it has pulled (when it doesn't say, the ones it
+# lists at its first health check) and how many models it can keep loaded. Every node has its own scheduler, since every server
+# swaps its own models. A call goes to a node that has its model loaded or already has calls for
+# it, unless that node is busier than another one by more than AFFINITY calls per loaded model,
+# and otherwise to the least busy node. A node that can't be reached is taken out of rotation and
+# only gets calls again once a health check (GET /api/tags) answers, tried after
+# HEALTH_CHECK_SECONDS and then twice as long after each failed check.
+AFFINITY = 1.0
+HEALTH_CHECK_SECONDS = 10.0
+MAX_HEALTH_CHECK_SECONDS = 300.0
+HEALTH_CHECK_TIMEOUT = 3.0
+# httpx errors of a server that is down, went away or hangs: the backend's timeout leaves room for
+# the slowest model, so an answer that doesn't come within it is a server that stopped working
+UNREACHABLE_ERRORS = {"NetworkError", "ConnectTimeout", "ReadTimeout", "RemoteProtocolError"}
+
+
+def _tagged(model):
+    return model if ":" in model else f"{model}:latest"
+
+
+class OllamaNode:
+    def __init__(self, url, models=None, max_loaded_models=1):
+        self.url = url.rstrip("/")
+        self.models = {_tagged(model) for model in models} if models else None  # None: the pulled ones
+        self.missing = set()  # models the server said it doesn't have
+        self.pulled = None  # the models it listed at its last health check
+        self.scheduler = OllamaScheduler(max_loaded_models)
+        self.in_flight = 0  # calls sent or waiting for a slot
+        self.up = True
+        self.failures = 0
+        self.check_at = 0.0
+        self.checking = False
+
+    def serves(self, model):
+        model = _tagged(model)
+        known = self.models if self.models is not None else self.pulled
+        return model not in self.missing and (known is None or model in known)
+
+    def load(self, model):
+        busy = self.in_flight / self.scheduler.max_loaded_models
+        return busy - AFFINITY if self.scheduler.holds(model) else busy
+
+    def status(self):
+        return {
+            "url": self.url,
+            "up": self.up,
+            "in_flight": self.in_flight,
+            "loaded": self.scheduler.loaded(),
+            "models": sorted(self.models) if self.models is not None else None,
+            "missing": sorted(self.missing),
+            "pulled": sorted(self.pulled) if self.pulled is not None else None,
+        }
+
+
+class OllamaPool:
+    # `get(url, timeout)` sends the health checks
+    def __init__(self, nodes, get):
+        self.nodes = nodes
+        self.get = get
+        self._lock = threading.Lock()
+        self._discovery_lock = threading.Lock()
+
+    # How many models the nodes that are up can run at the same time
+    def capacity(self):
+        return sum(node.scheduler.max_loaded_models for node in self.nodes if node.up) or 1
+
+    def choose(self, model):
+        self._discover()
+        for node in self._due_for_check():
+            self.check(node)
+        with self._lock:
+            serving = [node for node in self.nodes if node.serves(model)]
+            if not serving:
+                raise LookupError(f"No Ollama node has {model}, pull it on a node and list it in that node's models in models.json")
+            up = [node for node in serving if node.up]
+            if not up:
+                raise ConnectionError(f"Every Ollama node with {model} is down: {', '.join(node.url for node in serving)}")
+            node = min(up, key=lambda node: node.load(model))
+            node.in_flight += 1
+            return node
+
+    # Picks a node and waits for a slot on it; the wait counts as the call's queueing time
+    def acquire(self, model):
+        node = self.choose(model)
+        try:
+            node.scheduler.acquire(model)
+        except BaseException:
+            with self._lock:
+                node.in_flight -= 1
+            raise
+        report_call_started()
+        return node
+
+    def release(self, node, model):
+        node.scheduler.release(model)
+        with self._lock:
+            node.in_flight -= 1
+
+    # A node that can't be reached leaves the rotation, a model it doesn't have isn't sent to it again
+    def failed(self, node, model, error):
+        with self._lock:
+            if status_code(error) == 404:
+                node.missing.add(_tagged(model))
+            elif any(cls.__name__ in UNREACHABLE_ERRORS for cls in type(error).__mro__) and node.up:
+                self._take_down(node)
+
+    @contextmanager
+    def slot(self, model):
+        node = self.acquire(model)
+        try:
+            yield node
+        except Exception as error:
+            self.failed(node, model, error)
+            raise
+        finally:
+            self.release(node, model)
+
+    # The slot is waited for in a thread. When the caller is cancelled meanwhile the slot is
+    # handed back as soon as that thread gets it.
+    @asynccontextmanager
+    async def aslot(self, model):
+        import asyncio  # only the async path needs it
+
+        waiting = asyncio.ensure_future(asyncio.to_thread(self.acquire, model))
+        try:
+            node = await asyncio.shield(waiting)
+        except asyncio.CancelledError:
+            waiting.add_done_callback(lambda future: self.release(future.result(), model) if not future.cancelled() and future.exception() is None else None)
+            raise
+        try:
+            yield node
+        except Exception as error:
+            self.failed(node, model, error)
+            raise
+        finally:
+            self.release(node, model)
+
+    # Function to ask a node whether it is up; the models it reports clear the ones it was missing
+    def check(self, node):
+        try:
+            response = self.get(f"{node.url}/api/tags", HEALTH_CHECK_TIMEOUT)
+            response.raise_for_status()
+            pulled = {_tagged(model["name"]) for model in response.json().get("models", [])}
+        except Exception:
+            pulled = None
+        with self._lock:
+            node.checking = False
+            if pulled is None:
+                self._take_down(node)
+                return False
+            node.up = True
+            node.failures = 0
+            node.pulled = pulled
+            node.missing -= pulled
+            return True
+
+    def check_all(self):
+        with self._lock:
+            for node in self.nodes:
+                node.checking = True
+        return {node.url: self.check(node) for node in self.nodes}
+
+    # Nodes that don't list their models are asked for them before their first call, the calls
+    # that come meanwhile wait for the answer
+    def _discover(self):
+        with self._discovery_lock:
+            for node in self.nodes:
+                if node.up and node.models is None and node.pulled is None:
+                    self.check(node)
+
+    def _due_for_check(self):
+        now = time.monotonic()
+        with self._lock:
+            due = [node for node in self.nodes if not node.up and not node.checking and node.check_at <= now]
+            for node in due:
+                node.checking = True
+        return due
+
+    def _take_down(self, node):
+        node.up = False
+        node.failures += 1
+        node.check_at = time.monotonic() + min(MAX_HEALTH_CHECK_SECONDS, HEALTH_CHECK_SECONDS * 2 ** (node.failures - 1))
+
+
+def main():
+    from dotenv import load_dotenv
+
+    from backends import OllamaProvider, get_registry
+
+    parser = argparse.ArgumentParser(description="Check the Ollama nodes of models.json and list the models each one has.")
+    parser.parse_args()
+    load_dotenv()
+
+    for provider in get_registry().providers():
+        if not isinstance(provider, OllamaProvider):
+            continue
+        provider.pool.check_all()
+        for node in provider.pool.nodes:
+            status = node.status()
+            models = ", ".join(status["models"] if status["models"] is not None else status["pulled"] or ["nothing it listed"])
+            print(f"{provider.name} {status['url']}: {'up' if status['up'] else 'down'}, "
+                  f"{node.scheduler.max_loaded_models} loaded at a time, serves {models}")
+            not_pulled = sorted(set(status["models"] or []) - set(status["pulled"] or [])) if status["up"] else []
+            if not_pulled:
+                print(f"  listed but not pulled: {', '.join(not_pulled)}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+import argparse
+import json
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from backends import ModelSpec, OllamaProvider
+from ollama_pool import _tagged
+
+
+# Checks the balancing of the Ollama pool against stub Ollama servers on local ports: each one
+# lists its models at /api/tags and answers /api/chat for them (404 for the others). The calls go
+# through the ollama backend's own client and pool, so what is checked is what a run does:
+# affinity, the least busy node, a model a node doesn't have, taking a node that went away out of
+# rotation and bringing it back once its health check answers.
+
+
+class StubOllama:
+    def __init__(self, models, port=0):
+        self.models = models
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def _reply(self, status, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._reply(200, {"models": [{"name": model} for model in stub.models]})
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if _tagged(request["model"]) not in stub.models:  # as Ollama, "m1" is "m1:latest"
+                    self._reply(404, {"error": f"model '{request['model']}' not found"})
+                    return
+                self._reply(200, {"message": {"content": f"{stub.url} answered"}, "done": True})
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", port), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def _spec(model):
+    return ModelSpec(name=model, backend="ollama", model=model, system_message=None, temperature=0.3, max_tokens=None,
+                     local=True, input_price=0.0, output_price=0.0)
+
+
+def _ask(provider, model):
+    try:
+        return provider.complete(_spec(model), None, [{"role": "user", "content": "ping"}])
+    except Exception as error:
+        return f"{type(error).__name__}"
+
+
+def run_checks():
+    # Node a says which models it has and is wrong about m2, node b lists its models when checked
+    a = StubOllama(["m1:latest"])
+    b = StubOllama(["m1:latest", "m2:latest", "m3:latest"])
+    provider = OllamaProvider("ollama", {"type": "ollama", "local": True, "timeout": 5, "nodes": [
+        {"url": a.url, "models": ["m1", "m2"], "max_loaded_models": 1},
+        {"url": b.url, "max_loaded_models": 1},
+    ]})
+    pool = provider.pool
+    node_a, node_b = pool.nodes
+    results = []
+
+    def check(description, passed):
+        results.append(passed)
+        print(f"{'ok' if passed else 'FAILED'}  {description}")
+
+    try:
+        check("the first call goes to the first of two idle nodes", _ask(provider, "m1") == f"{a.url} answered")
+        check("the next call for the same model stays on the node that has it loaded", _ask(provider, "m1") == f"{a.url} answered")
+
+        held = [pool.acquire("m1"), pool.acquire("m1")]
+        check("a call for a loaded model joins its node while that node isn't busier by more than AFFINITY",
+              held == [node_a, node_a])
+        third = pool.acquire("m1")
+        check("once it is, the call goes to the least busy node", third is node_b)
+        for node in held + [third]:
+            pool.release(node, "m1")
+
+        check("a model the node's server doesn't have fails with 404 there", _ask(provider, "m2") == "HTTPStatusError")
+        check("and is marked missing on that node", "m2:latest" in node_a.missing)
+        check("so the next call for it goes to a node that has it", _ask(provider, "m2") == f"{b.url} answered")
+        check("a node without a models list serves what it listed at its first health check",
+              _ask(provider, "m3") == f"{b.url} answered" and node_b.pulled is not None)
+
+        port = a.server.server_address[1]
+        a.stop()
+        check("a call to a node that went away fails", _ask(provider, "m1") == "ConnectError")
+        check("and takes that node out of rotation", not node_a.up and node_a.check_at > 0)
+        check("while it is down its calls go to another node", _ask(provider, "m1") == f"{b.url} answered")
+
+        a = StubOllama(["m1:latest"], port)
+        node_a.check_at = 0.0  # its next health check is due
+        pool.release(pool.acquire("m1"), "m1")
+        check("a node that answers its health check again is back in rotation", node_a.up and node_a.failures == 0)
+    finally:
+        a.stop()
+        b.stop()
+        provider.close()
+    return all(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check the Ollama pool's balancing and health checks against stub servers on local ports.")
+    parser.parse_args()
+    sys.exit(0 if run_checks() else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import os
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+# Ollama unloads a model when another one needs the memory, so firing every advisor at the
+# local server at once makes it swap models back and forth. The scheduler only lets requests
+# for `max_loaded_models` different models run at the same time, lets requests for a model
+# that is already running join it, and when a slot frees up it gives it to the model that
+# is still loaded or has the most requests waiting.
+class OllamaScheduler:
+    def __init__(self, max_loaded_models=1):
+        self.max_loaded_models = max(1, max_loaded_models)
+        self._condition = threading.Condition()
+        self._running = {}  # model -> requests in flight
+        self._waiting = {}  # model -> requests waiting for a slot
+        self._resident = OrderedDict()  # most recently used models, oldest first
+        self.swaps = 0
+
+    def acquire(self, model):
+        with self._condition:
+            self._waiting[model] = self._waiting.get(model, 0) + 1
+            while not self._can_start(model):
+                self._condition.wait()
+            self._waiting[model] -= 1
+            if not self._waiting[model]:
+                del self._waiting[model]
+            if model not in self._resident:
+                self.swaps += 1
+            self._running[model] = self._running.get(model, 0) + 1
+            self._mark_resident(model)
+
+    def release(self, model):
+        with self._condition:
+            self._running[model] -= 1
+            if not self._running[model]:
+                del self._running[model]
+            self._condition.notify_all()
+
+    @contextmanager
+    def slot(self, model):
+        self.acquire(model)
+        try:
+            yield
+        finally:
+            self.release(model)
+
+    # Whether the model is loaded, running or about to be, so another request for it won't swap
+    def holds(self, model):
+        with self._condition:
+            return model in self._resident or model in self._running or model in self._waiting
+
+    def loaded(self):
+        with self._condition:
+            return list(self._resident)
+
+    def _can_start(self, model):
+        if model in self._running:
+            return True
+        free_slots = self.max_loaded_models - len(self._running)
+        if free_slots <= 0:
+            return False
+        candidates = [m for m in self._waiting if m not in self._running]
+        candidates.sort(key=lambda m: (m not in self._resident, -self._waiting[m]))
+        return model in candidates[:free_slots]
+
+    def _mark_resident(self, model):
+        self._resident.pop(model, None)
+        self._resident[model] = True
+        while len(self._resident) > self.max_loaded_models:
+            self._resident.popitem(last=False)
+
+
+def max_loaded_models_from_env():
+    return int(os.getenv("OLLAMA_MAX_LOADED_MODELS", 1))
+
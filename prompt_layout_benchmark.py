@@ -0,0 +1,71 @@
+import argparse
+
+from answer_clusters import cluster_answers, format_clusters
+from backends import architecture_models, get_registry
+from democracy import voting_prompt
+from run_metrics import CallSpan, active_call
+
+
+# How much of the voting prompt each local model has to evaluate, with the ballot laid out the old
+# way (the options first, the problem last) and the way the_democracy lays it out now (the problem
+# first, as the advisors were asked it). The numbers are Ollama's own prompt_eval_count and
+# prompt_eval_duration; each vote is sent right after the model answered the problem, as in a run.
+
+
+def legacy_voting_prompt(model_answers, user_message):
+    return (f"Voting Options = {model_answers}\n\nGive your vote to the answer above that you think will have the best chance of solving the following problem: {user_message}\n\nEnd your reply with one line of the form VOTE: <option number>")
+
+
+LAYOUTS = {
+    "options first": legacy_voting_prompt,
+    "problem first": voting_prompt,
+}
+
+
+# Function to send one prompt straight to the model (no cache) and read Ollama's timings
+def evaluate(advisor, prompt):
+    provider = get_registry().provider(advisor.backend)
+    span = CallSpan(advisor.backend, advisor.model, 0)
+    with active_call(span):
+        answer = provider.complete(advisor, advisor.system_message, [{"role": "user", "content": prompt}])
+    return answer, span.record["prompt_eval_tokens"] or 0, span.record["prompt_eval_seconds"] or 0.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the prompt evaluation of the voting stage for both prompt layouts.")
+    parser.add_argument("problem", nargs="?", default="problem.txt")
+    parser.add_argument("--models", nargs="+", help="advisor names from models.json, by default the local advisors of the democracy")
+    args = parser.parse_args()
+
+    with open(args.problem, 'r', encoding='utf-8') as infile:
+        user_message = infile.read()
+    advisors = [advisor for advisor in architecture_models("democracy")["advisors"] if advisor.local]
+    if args.models:
+        advisors = [get_registry().model(name) for name in args.models]
+
+    answers = {}
+    for advisor in advisors:
+        answers[advisor.name], _, _ = evaluate(advisor, user_message)
+    model_answers = format_clusters(cluster_answers(answers), numbered=True)
+
+    totals = {layout: [0, 0.0] for layout in LAYOUTS}
+    print(f"{'advisor':<14}" + "".join(f"{layout + ' tokens':>22}{layout + ' s':>18}" for layout in LAYOUTS))
+    for advisor in advisors:
+        row = f"{advisor.name:<14}"
+        for layout, build in LAYOUTS.items():
+            evaluate(advisor, user_message)  # the model has just answered the problem, as in a run
+            _, tokens, seconds = evaluate(advisor, build(model_answers, user_message))
+            totals[layout][0] += tokens
+            totals[layout][1] += seconds
+            row += f"{tokens:>22}{seconds:>18.2f}"
+        print(row)
+    print(f"{'total':<14}" + "".join(f"{tokens:>22}{seconds:>18.2f}" for tokens, seconds in totals.values()))
+
+    before, after = totals["options first"], totals["problem first"]
+    if before[1]:
+        print(f"Prompt evaluation of the votes: {before[1]:.2f}s -> {after[1]:.2f}s ({1 - after[1] / before[1]:.0%} less), "
+              f"{before[0]} -> {after[0]} tokens evaluated")
+
+
+if __name__ == "__main__":
+    main()
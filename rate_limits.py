@@ -0,0 +1,218 @@
+import email.utils
+import random
+import threading
+import time
+
+from run_metrics import report_timings
+
+
+# Pacing and retries for the backends. A backend can declare requests_per_minute and
+# tokens_per_minute in models.json; every call takes its share from a token bucket before it is
+# sent, so a batch run stays under the provider's limits instead of running into them. A call
+# that still fails with a rate limit, an overloaded server or a dropped connection is retried
+# with exponential backoff and jitter, waiting at least the server's Retry-After, and after a rate
+# limit the whole backend holds off that long so the other calls don't hit the same wall.
+# A local backend doesn't retry timeouts: its timeout is long enough for the slowest model, so a
+# call that runs into it is a hung server, which the Ollama pool takes out of rotation instead.
+DEFAULT_MAX_RETRIES = 4
+DEFAULT_BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}  # 529 is Anthropic's "overloaded"
+# Connection failures of the SDKs (and their subclasses such as timeouts) and of httpx
+RETRYABLE_ERRORS = {"APIConnectionError", "TimeoutException", "NetworkError", "RemoteProtocolError"}
+TIMEOUT_ERRORS = {"APITimeoutError", "TimeoutException"}
+
+
+# Holds up to `per_minute` units and refills at that rate. A reservation may overdraw it and the
+# caller waits until the debt is paid back, so calls go out in the order they asked.
+class TokenBucket:
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+        self.level -= min(amount, self.capacity)  # a single call larger than the bucket waits for a full one
+        return max(0.0, -self.level / self.rate)
+
+
+class RateLimiter:
+    def __init__(self, requests_per_minute=None, tokens_per_minute=None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    # Takes one request and `tokens` tokens, returns the seconds to wait before sending the call
+    def reserve(self, tokens):
+        with self._lock:
+            now = time.monotonic()
+            delay = max(0.0, self.paused_until - now)
+            if self.requests is not None:
+                delay = max(delay, self.requests.reserve(1, now))
+            if self.tokens is not None:
+                delay = max(delay, self.tokens.reserve(tokens, now))
+            return delay
+
+    # Nothing is sent to the backend for `seconds`, e.g. after it answered with a rate limit
+    def pause(self, seconds):
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+def status_code(error):
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    return status
+
+
+def is_retryable(error, retry_timeouts=True):
+    if not retry_timeouts and any(cls.__name__ in TIMEOUT_ERRORS for cls in type(error).__mro__):
+        return False
+    if status_code(error) in RETRYABLE_STATUS:
+        return True
+    return any(cls.__name__ in RETRYABLE_ERRORS for cls in type(error).__mro__)
+
+
+# Function to read how long the server asked to wait: Retry-After in seconds or as a date, or
+# the retry-after-ms header of OpenAI. Returns None when the response doesn't say.
+def retry_after_seconds(error):
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    milliseconds = headers.get("retry-after-ms")
+    if milliseconds:
+        try:
+            return max(0.0, float(milliseconds) / 1000)
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+# Exponential backoff with full jitter, or the server's Retry-After plus a little jitter so the
+# calls that were waiting don't all come back at the same moment
+def backoff_seconds(attempt, retry_after=None, base=DEFAULT_BACKOFF_SECONDS):
+    if retry_after is not None:
+        return retry_after + random.uniform(0, base)
+    return random.uniform(0, min(MAX_BACKOFF_SECONDS, base * 2 ** attempt))
+
+
+# The attempts of one call: how long to wait before each one and whether a failure is retried.
+# The retries and the time spent waiting for the rate limits end up in the call's span.
+class Attempts:
+    def __init__(self, limiter, tokens, max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF_SECONDS, retry_timeouts=True):
+        self.limiter = limiter
+        self.tokens = tokens
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.retry_timeouts = retry_timeouts
+        self.retries = 0
+        self.throttle_seconds = 0.0
+
+    def delay(self):
+        delay = self.limiter.reserve(self.tokens)
+        self.throttle_seconds += delay
+        return delay
+
+    # Returns the seconds to wait before trying again, or None when the error should be raised
+    def after_failure(self, error):
+        if self.retries >= self.max_retries or not is_retryable(error, self.retry_timeouts):
+            return None
+        retry_after = retry_after_seconds(error)
+        wait = backoff_seconds(self.retries, retry_after, self.backoff)
+        self.retries += 1
+        if retry_after is not None or status_code(error) == 429:
+            self.limiter.pause(wait)
+            return 0.0  # the next delay() waits out the pause with everyone else
+        return wait
+
+    def report(self):
+        report_timings(retries=self.retries, throttle_seconds=round(self.throttle_seconds, 3))
+
+
+def call_with_retries(call, attempts):
+    try:
+        while True:
+            time.sleep(attempts.delay())
+            try:
+                return call()
+            except Exception as error:
+                wait = attempts.after_failure(error)
+                if wait is None:
+                    raise
+                time.sleep(wait)
+    finally:
+        attempts.report()
+
+
+# A stream is only tried again when it failed before its first chunk, the chunks already
+# passed on can't be taken back
+def stream_with_retries(call_stream, attempts):
+    try:
+        while True:
+            time.sleep(attempts.delay())
+            started = False
+            try:
+                for chunk in call_stream():
+                    started = True
+                    yield chunk
+                return
+            except Exception as error:
+                wait = None if started else attempts.after_failure(error)
+                if wait is None:
+                    raise
+                time.sleep(wait)
+    finally:
+        attempts.report()
+
+
+async def acall_with_retries(acall, attempts):
+    import asyncio  # only the async path needs it
+
+    try:
+        while True:
+            await asyncio.sleep(attempts.delay())
+            try:
+                return await acall()
+            except Exception as error:
+                wait = attempts.after_failure(error)
+                if wait is None:
+                    raise
+                await asyncio.sleep(wait)
+    finally:
+        attempts.report()
+
+
+async def astream_with_retries(acall_stream, attempts):
+    import asyncio
+
+    try:
+        while True:
+            await asyncio.sleep(attempts.delay())
+            started = False
+            try:
+                async for chunk in acall_stream():
+                    started = True
+                    yield chunk
+                return
+            except Exception as error:
+                wait = None if started else attempts.after_failure(error)
+                if wait is None:
+                    raise
+                await asyncio.sleep(wait)
+    finally:
+        attempts.report()
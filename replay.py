@@ -0,0 +1,275 @@
+import argparse
+import contextvars
+import cProfile
+import json
+import os
+import pstats
+import queue
+import statistics
+import threading
+import time
+from contextlib import nullcontext
+
+import model_stats
+import response_cache
+from answer_store import AnswerStore
+from backends import Provider, get_registry
+from batch import ARCHITECTURES, load_architecture
+from model_stats import ModelStats
+from ollama_scheduler import OllamaScheduler, max_loaded_models_from_env
+from rate_limits import RateLimiter
+from response_cache import ResponseCache, cache_key
+from run_log import read_log
+from run_metrics import collect_metrics, report_usage
+
+
+# Runs the architectures again on the problems of a run log (see run_log.py), with every backend
+# answering from the log instead of a model: a call gets the response logged for the same
+# backend, model, system message, prompt, temperature and max_tokens, after its logged latency
+# scaled by --speed. Nothing is sent anywhere, so the orchestration can be profiled, or load
+# tested with --workers and --repeat, at full speed. A call that failed in the logged run fails
+# the same way. A request logged by several runs is answered as in the run being replayed, or
+# else as it was answered last. Only the responses and timings are kept, in an AnswerStore that
+# --spill moves to a memory-mapped file, so a log of thousands of runs fits in little memory.
+
+# The logged run being replayed, fan_out passes it on to the threads of the calls
+_replayed_run = contextvars.ContextVar("replayed_run", default=None)
+
+
+class LoggedResponses:
+    def __init__(self, records=(), spill_path=None):
+        self.store = AnswerStore(spill_path)
+        self.missing = 0
+        self._lock = threading.Lock()
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        if record.get("type") == "call" and (record.get("response") is not None or record.get("error")):
+            self.store.add(record["key"], record, record.get("run"))
+
+    def lookup(self, key, run=None):
+        record = self.store.get(key, run)
+        if record is None:
+            with self._lock:
+                self.missing += 1
+        return record
+
+
+class ReplayProvider(Provider):
+    # missing: "placeholder" answers calls that were never logged with a fixed text, "error" raises
+    def __init__(self, name, settings, responses, speed=0.0, missing="placeholder"):
+        super().__init__(name, settings)
+        self.limiter = RateLimiter()  # nothing reaches the provider, so its limits don't apply
+        self.responses = responses
+        self.speed = speed
+        self.missing = missing
+        # Local calls still take turns on the loaded models, as on a single Ollama server
+        self.scheduler = OllamaScheduler(max_loaded_models_from_env()) if self.local else None
+
+    def _slot(self, spec):
+        return self.scheduler.slot(spec.model) if self.scheduler is not None else nullcontext()
+
+    def _record(self, spec, system_message, messages):
+        key = cache_key(self.name, spec.model, system_message, messages, spec.temperature, spec.max_tokens)
+        record = self.responses.lookup(key, _replayed_run.get())
+        if record is None:
+            if self.missing == "error":
+                raise LookupError(f"No logged {self.name} response for model {spec.model}")
+            return {"response": f"[no logged {self.name} response for {spec.model}]", "seconds": 0.0, "ttft_seconds": 0.0}
+        if record.get("response") is None:
+            raise RuntimeError(f"Logged call failed: {record['error']}")
+        if record.get("completion_tokens") is not None:
+            report_usage(record["prompt_tokens"], record["completion_tokens"])
+        return record
+
+    def complete(self, spec, system_message, messages, schema=None):
+        record = self._record(spec, system_message, messages)
+        with self._slot(spec):
+            if self.speed:
+                time.sleep(record["seconds"] * self.speed)
+        return record["response"]
+
+    # The first chunk comes after the logged time to first token, the rest spread over the remaining time
+    def stream(self, spec, system_message, messages):
+        record = self._record(spec, system_message, messages)
+        chunks = _chunks(record["response"])
+        with self._slot(spec):
+            if self.speed:
+                time.sleep((record.get("ttft_seconds") or 0.0) * self.speed)
+            pause = max(0.0, record["seconds"] - (record.get("ttft_seconds") or 0.0)) * self.speed / max(1, len(chunks))
+            for chunk in chunks:
+                yield chunk
+                if pause:
+                    time.sleep(pause)
+
+    async def acomplete(self, spec, system_message, messages, schema=None):
+        import asyncio  # only the async path needs it
+
+        record = self._record(spec, system_message, messages)
+        if self.speed:
+            await asyncio.sleep(record["seconds"] * self.speed)
+        return record["response"]
+
+    async def astream(self, spec, system_message, messages):
+        yield await self.acomplete(spec, system_message, messages)
+
+
+def _chunks(text, size=16):
+    return [text[start:start + size] for start in range(0, len(text), size)]
+
+
+# Function to put a replay provider in place of every backend of the registry
+def install_replay(responses, speed=0.0, missing="placeholder"):
+    registry = get_registry()
+    for provider in registry.providers():
+        registry.replace_provider(ReplayProvider(provider.name, provider.settings, responses, speed, missing))
+
+
+def replay_run(run):
+    solve = load_architecture(run["architecture"])
+    error = None
+    start = time.monotonic()
+    token = _replayed_run.set(run["run"])
+    with collect_metrics() as metrics:
+        try:
+            answer = solve(run["problem"])
+        except Exception as exception:
+            answer = None
+            error = f"{type(exception).__name__}: {exception}"
+    _replayed_run.reset(token)
+    result = {
+        "run": run["run"],
+        "architecture": run["architecture"],
+        "seconds": round(time.monotonic() - start, 3),
+        "same_answer": answer is not None and answer.strip() == (run.get("answer") or "").strip(),
+        "calls": len(metrics.calls),
+        "stages": metrics.summary()["stages"],
+    }
+    if error:
+        result["error"] = error
+    return result
+
+
+# Function to replay every run `repeat` times, `workers` at the same time. With one worker the
+# runs are replayed in the calling thread, so a profiler running there sees them.
+def replay_runs(runs, workers=1, repeat=1):
+    work = queue.Queue()
+    for _ in range(repeat):
+        for run in runs:
+            work.put(run)
+    results = []
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            try:
+                run = work.get_nowait()
+            except queue.Empty:
+                return
+            result = replay_run(run)
+            with lock:
+                results.append(result)
+
+    if workers <= 1:
+        worker()
+        return results
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def summarize(results):
+    summary = {}
+    for name in ARCHITECTURES:
+        runs = [result for result in results if result["architecture"] == name]
+        if not runs:
+            continue
+        seconds = sorted(result["seconds"] for result in runs)
+        stages = {}
+        for result in runs:
+            for stage, stage_seconds in result["stages"].items():
+                stages[stage] = round(stages.get(stage, 0.0) + stage_seconds, 3)
+        summary[name] = {
+            "runs": len(runs),
+            "errors": sum("error" in result for result in runs),
+            "same_answer": sum(result["same_answer"] for result in runs),
+            "mean_seconds": round(statistics.mean(seconds), 4),
+            "p95_seconds": seconds[min(len(seconds) - 1, int(0.95 * len(seconds)))],
+            "calls": sum(result["calls"] for result in runs),
+            "stage_seconds": stages,
+        }
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the architectures again on the problems of a run log, answered from the log.")
+    parser.add_argument("log", help="run log written with MOM_RUN_LOG")
+    parser.add_argument("--arch", nargs="+", choices=ARCHITECTURES, default=list(ARCHITECTURES))
+    parser.add_argument("--speed", type=float, default=0.0, help="1 replays the logged latency of every call, 0 answers at once")
+    parser.add_argument("--workers", type=int, default=1, help="runs replayed at the same time")
+    parser.add_argument("--repeat", type=int, default=1, help="replay every run this many times")
+    parser.add_argument("--missing", choices=("placeholder", "error"), default="placeholder",
+                        help="answer calls that aren't in the log with a placeholder or fail them")
+    parser.add_argument("--profile", type=int, nargs="?", const=25, metavar="ROWS",
+                        help="profile the replay with one worker and list the functions with the most cumulative time "
+                             "(the advisor calls run in fan_out's threads and are left out)")
+    parser.add_argument("--report", default=None, help="also write the results as JSON here")
+    parser.add_argument("--spill", default=None, metavar="PATH",
+                        help="keep the logged responses in this scratch file, memory-mapped, instead of in memory")
+    args = parser.parse_args()
+
+    # The log is read once, keeping of each run only what the replay needs
+    runs = []
+    responses = LoggedResponses(spill_path=args.spill)
+    for record in read_log(args.log):
+        if record.get("type") == "run":
+            if record["architecture"] in args.arch and not record.get("error"):
+                runs.append({key: record.get(key) for key in ("run", "architecture", "problem", "answer")})
+        else:
+            responses.add(record)
+    if not runs:
+        responses.store.close()
+        parser.error(f"{args.log} has no finished runs of {', '.join(args.arch)}")
+    install_replay(responses, speed=args.speed, missing=args.missing)
+    # The replay neither reads nor fills the response cache, keeps its latencies out of the
+    # advisors' stats and isn't logged itself
+    response_cache.response_cache = ResponseCache(None, mode="off")
+    model_stats.model_stats = ModelStats(None)
+    os.environ["MOM_RUN_LOG"] = ""
+
+    # Imported up front so neither the timings nor the profile include it
+    for name in {run["architecture"] for run in runs}:
+        load_architecture(name)
+
+    start = time.monotonic()
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+        results = replay_runs(runs, workers=1, repeat=args.repeat)
+        profiler.disable()
+    else:
+        results = replay_runs(runs, workers=args.workers, repeat=args.repeat)
+    seconds = time.monotonic() - start
+
+    summary = summarize(results)
+    for name, architecture in summary.items():
+        print(f"{name}: {architecture['runs']} runs, {architecture['same_answer']} with the logged answer, "
+              f"{architecture['errors']} failed, mean {architecture['mean_seconds']}s, p95 {architecture['p95_seconds']}s, "
+              f"{architecture['calls']} model calls")
+    print(f"Replayed {len(results)} runs in {seconds:.2f}s ({len(results) / seconds:.1f} runs/s)")
+    if responses.missing:
+        print(f"{responses.missing} calls weren't in the log")
+    if args.profile:
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(args.profile)
+    if args.report:
+        with open(args.report, 'w', encoding='utf-8') as outfile:
+            json.dump({"log": args.log, "seconds": round(seconds, 3), "summary": summary, "results": results}, outfile, indent=2)
+    responses.store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from run_log import log_call
+from run_metrics import CallSpan, active_call
+from token_count import estimate_prompt_tokens, estimate_tokens
+
+
+# Cache modes (set MOM_CACHE in .env):
+#   on      - reuse a stored answer when the exact same call was made before (default)
+#   off     - don't read or write the cache
+#   refresh - always call the model and overwrite the stored answer
+CACHE_MODES = ("on", "off", "refresh")
+
+# The size of the cache is kept as a running total, so a write only evicts once the cache is too
+# big; every this many writes it is counted again (another process may share the file) and the
+# answers that got too old are dropped
+EVICT_EVERY = 500
+EVICT_TO = 0.9  # a full cache is cut down to this share of its max size, so the next writes fit
+
+
+# Function to build the cache key from everything that changes a model's answer
+def cache_key(backend, model, system_message, messages, temperature, max_tokens):
+    payload = json.dumps(
+        [backend, model, system_message, messages, temperature, max_tokens],
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    def __init__(self, path, mode="on", max_bytes=200 * 1024 * 1024, max_age_seconds=30 * 24 * 3600):
+        if mode not in CACHE_MODES:
+            raise ValueError(f"MOM_CACHE must be one of {', '.join(CACHE_MODES)}, got {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.hits = 0
+        self.misses = 0
+        self._size = 0  # bytes of answers stored, as of the last eviction and the writes since
+        self._writes = 0
+        self._lock = threading.Lock()
+        self._connection = None
+        if mode != "off":
+            self._connection = sqlite3.connect(path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, backend TEXT, model TEXT, response TEXT, "
+                "size INTEGER, created REAL, last_used REAL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)")
+            self._connection.commit()
+            self.evict()
+
+    def get(self, key):
+        if self.mode != "on":
+            return None
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT response, created FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None or time.time() - row[1] > self.max_age_seconds:
+                self.misses += 1
+                return None
+            self._connection.execute("UPDATE responses SET last_used = ? WHERE key = ?", (time.time(), key))
+            self._connection.commit()
+            self.hits += 1
+            return row[0]
+
+    def put(self, key, backend, model, response):
+        if self.mode == "off":
+            return
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            replaced = self._connection.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, backend, model, response, size, now, now),
+            )
+            self._connection.commit()
+            self._size += size - (replaced[0] if replaced else 0)
+            self._writes += 1
+            due = self._size > self.max_bytes or self._writes % EVICT_EVERY == 0
+        if due:
+            self.evict()
+
+    # Drop answers older than max_age_seconds, then when over max_bytes the least recently used
+    # ones until under EVICT_TO of it
+    def evict(self):
+        with self._lock:
+            self._connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.max_age_seconds,))
+            total = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+            if total > self.max_bytes:
+                rows = self._connection.execute("SELECT key, size FROM responses ORDER BY last_used").fetchall()
+                stale = []
+                for key, size in rows:
+                    if total <= self.max_bytes * EVICT_TO:
+                        break
+                    stale.append((key,))
+                    total -= size
+                self._connection.executemany("DELETE FROM responses WHERE key = ?", stale)
+            self._connection.commit()
+            self._size = total
+
+    # The provider's stream is read with the span as the active call, so the usage, timings and
+    # retries the backend reports while streaming reach it, but not the caller's code between chunks
+    @staticmethod
+    def _read_stream(span, call_stream):
+        with active_call(span):
+            stream = call_stream()
+        while True:
+            with active_call(span):
+                try:
+                    chunk = next(stream)
+                except StopIteration:
+                    return
+            yield chunk
+
+    @staticmethod
+    async def _read_stream_async(span, acall_stream):
+        with active_call(span):
+            stream = acall_stream()
+        while True:
+            with active_call(span):
+                try:
+                    chunk = await stream.__anext__()
+                except StopAsyncIteration:
+                    return
+            yield chunk
+
+    # Close the call's span and add the call to the run log, when one is kept
+    @staticmethod
+    def _finish(span, key, system_message, messages, temperature, max_tokens, response=None, cached=False, error=None):
+        span.finish(estimate_tokens(response) if response is not None else 0, cached=cached, error=error)
+        log_call(span, key, system_message, messages, temperature, max_tokens, response)
+
+    # Read-through / write-through: return the stored answer or run `call` and store what it returns
+    def through(self, backend, model, system_message, messages, temperature, max_tokens, call):
+        key = cache_key(backend, model, system_message, messages, temperature, max_tokens)
+        span = CallSpan(backend, model, estimate_prompt_tokens(system_message, messages))
+        response = self.get(key)
+        if response is not None:
+            self._finish(span, key, system_message, messages, temperature, max_tokens, response, cached=True)
+            return response
+        try:
+            with active_call(span):
+                response = call()
+        except Exception as error:
+            self._finish(span, key, system_message, messages, temperature, max_tokens, error=f"{type(error).__name__}: {error}")
+            raise
+        self._finish(span, key, system_message, messages, temperature, max_tokens, response)
+        self.put(key, backend, model, response)
+        return response
+
+    # Same as through() for streaming calls: a stored answer comes back as a single chunk,
+    # otherwise the chunks of `call_stream()` are passed on and stored once the stream ends
+    def stream_through(self, backend, model, system_message, messages, temperature, max_tokens, call_stream):
+        key = cache_key(backend, model, system_message, messages, temperature, max_tokens)
+        span = CallSpan(backend, model, estimate_prompt_tokens(system_message, messages))
+        response = self.get(key)
+        if response is not None:
+            self._finish(span, key, system_message, messages, temperature, max_tokens, response, cached=True)
+            yield response
+            return
+        parts = []
+        try:
+            for chunk in self._read_stream(span, call_stream):
+                span.first_token()
+                parts.append(chunk)
+                yield chunk
+        except Exception as error:
+            self._finish(span, key, system_message, messages, temperature, max_tokens, error=f"{type(error).__name__}: {error}")
+            raise
+        response = "".join(parts).strip()
+        self._finish(span, key, system_message, messages, temperature, max_tokens, response)
+        self.put(key, backend, model, response)
+
+    # Same as through() and stream_through() for the async methods of the backends, `acall()`
+    # returns an awaitable and `acall_stream()` an async iterator
+    async def through_async(self, backend, model, system_message, messages, temperature, max_tokens, acall):
+        key = cache_key(backend, model, system_message, messages, temperature, max_tokens)
+        span = CallSpan(backend, model, estimate_prompt_tokens(system_message, messages))
+        response = self.get(key)
+        if response is not None:
+            self._finish(span, key, system_message, messages, temperature, max_tokens, response, cached=True)
+            return response
+        try:
+            with active_call(span):
+                response = await acall()
+        except Exception as error:
+            self._finish(span, key, system_message, messages, temperature, max_tokens, error=f"{type(error).__name__}: {error}")
+            raise
+        self._finish(span, key, system_message, messages, temperature, max_tokens, response)
+        self.put(key, backend, model, response)
+        return response
+
+    async def stream_through_async(self, backend, model, system_message, messages, temperature, max_tokens, acall_stream):
+        key = cache_key(backend, model, system_message, messages, temperature, max_tokens)
+        span = CallSpan(backend, model, estimate_prompt_tokens(system_message, messages))
+        response = self.get(key)
+        if response is not None:
+            self._finish(span, key, system_message, messages, temperature, max_tokens, response, cached=True)
+            yield response
+            return
+        parts = []
+        try:
+            async for chunk in self._read_stream_async(span, acall_stream):
+                span.first_token()
+                parts.append(chunk)
+                yield chunk
+        except Exception as error:
+            self._finish(span, key, system_message, messages, temperature, max_tokens, error=f"{type(error).__name__}: {error}")
+            raise
+        response = "".join(parts).strip()
+        self._finish(span, key, system_message, messages, temperature, max_tokens, response)
+        self.put(key, backend, model, response)
+
+
+response_cache = None
+_cache_lock = threading.Lock()
+
+
+# The cache is opened on first use so the scripts' load_dotenv() has already run
+def get_response_cache():
+    global response_cache
+    with _cache_lock:
+        if response_cache is None:
+            response_cache = ResponseCache(
+                os.getenv("MOM_CACHE_PATH", "mom_cache.sqlite3"),
+                mode=os.getenv("MOM_CACHE", "on").lower(),
+                max_bytes=int(float(os.getenv("MOM_CACHE_MAX_MB", 200)) * 1024 * 1024),
+                max_age_seconds=int(float(os.getenv("MOM_CACHE_MAX_AGE_DAYS", 30)) * 24 * 3600),
+            )
+        return response_cache
+
+
+def cached(backend, model, system_message, messages, temperature, max_tokens, call):
+    return get_response_cache().through(backend, model, system_message, messages, temperature, max_tokens, call)
+
+
+def cached_stream(backend, model, system_message, messages, temperature, max_tokens, call_stream):
+    return get_response_cache().stream_through(backend, model, system_message, messages, temperature, max_tokens, call_stream)
+
+
+async def cached_async(backend, model, system_message, messages, temperature, max_tokens, acall):
+    return await get_response_cache().through_async(backend, model, system_message, messages, temperature, max_tokens, acall)
+
+
+def cached_stream_async(backend, model, system_message, messages, temperature, max_tokens, acall_stream):
+    return get_response_cache().stream_through_async(backend, model, system_message, messages, temperature, max_tokens, acall_stream)
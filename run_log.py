@@ -0,0 +1,106 @@
+import gzip
+import json
+import os
+import threading
+
+
+# Append-only log of what the runs asked and got (MOM_RUN_LOG, not set by default): one JSON
+# record per model call with its request, its response and its timings, and one per run with
+# the architecture, the problem and the final answer. A path ending in .gz is compressed, every
+# record as its own gzip member, so the file is only ever appended to and a crash can cut off at
+# most the record being written. replay.py answers the architectures from such a log.
+
+
+class RunLog:
+    def __init__(self, path):
+        self.path = path
+        self.compressed = path.endswith(".gz")
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        data = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+        if self.compressed:
+            data = gzip.compress(data, compresslevel=6)
+        with self._lock:
+            with open(self.path, 'ab') as outfile:
+                outfile.write(data)
+
+
+# Function to read the records of a log, leaving out a last record that was cut short
+def read_log(path):
+    opener = gzip.open if path.endswith(".gz") else open
+    with opener(path, 'rt', encoding='utf-8') as infile:
+        try:
+            for line in infile:
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    continue
+        except (EOFError, gzip.BadGzipFile):
+            return
+
+
+run_log = None
+_run_log_lock = threading.Lock()
+
+
+# The log is opened on first use so the scripts' load_dotenv() has already run
+def get_run_log():
+    global run_log
+    with _run_log_lock:
+        path = os.getenv("MOM_RUN_LOG")
+        if not path:
+            return None
+        if run_log is None or run_log.path != path:
+            run_log = RunLog(path)
+        return run_log
+
+
+# Called by the response cache for every model call, answered by the model or from the cache
+def log_call(span, key, system_message, messages, temperature, max_tokens, response):
+    log = get_run_log()
+    if log is None:
+        return
+    call = span.record
+    log.write({
+        "type": "call",
+        "run": span.metrics.trace_id if span.metrics is not None else None,
+        "key": key,
+        "backend": call["backend"],
+        "model": call["model"],
+        "stage": call["stage"],
+        "system": system_message,
+        "messages": messages,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "response": response,
+        "error": call["error"],
+        "cached": call["cached"],
+        "start": call["start"],
+        "queue_seconds": call["queue_seconds"],
+        "ttft_seconds": call["ttft_seconds"],
+        "seconds": call["seconds"],
+        "prompt_tokens": call["prompt_tokens"],
+        "completion_tokens": call["completion_tokens"],
+        "retries": call["retries"],
+    })
+
+
+# Called by whatever ran an architecture once its answer is complete
+def log_run(architecture, problem, answer, metrics, error=None):
+    log = get_run_log()
+    if log is None:
+        return
+    log.write({
+        "type": "run",
+        "run": metrics.trace_id,
+        "architecture": architecture,
+        "problem": problem,
+        "answer": answer,
+        "error": error,
+        "start": metrics.start,
+        "seconds": round((metrics.end or metrics.start) - metrics.start, 3),
+        "stages": metrics.summary()["stages"],
+    })
@@ -0,0 +1,255 @@
+import contextvars
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+
+# The metrics of the run in progress, the architecture stage being executed, the model call in
+# progress and when that call was queued. They are context variables so batch workers each collect
+# their own run, and fan_out copies them into its threads.
+_current_run = contextvars.ContextVar("current_run", default=None)
+_current_stage = contextvars.ContextVar("current_stage", default=None)
+_current_call = contextvars.ContextVar("current_call", default=None)
+_queued_at = contextvars.ContextVar("queued_at", default=None)
+_call_outcome = contextvars.ContextVar("call_outcome", default=None)
+
+
+def new_id(size):
+    return os.urandom(size).hex()
+
+
+class RunMetrics:
+    def __init__(self):
+        self.trace_id = new_id(16)
+        self.span_id = new_id(8)
+        self.start = time.time()
+        self.end = None
+        self.calls = []
+        self.stages = {}  # stage name -> seconds
+        self.stage_spans = []
+        self.advisors = {}  # advisor name -> its answer and how long it took, for grading per advisor
+        self._lock = threading.Lock()
+
+    def record_call(self, call):
+        with self._lock:
+            self.calls.append(call)
+
+    def add_stage(self, span):
+        with self._lock:
+            self.stage_spans.append(span)
+            seconds = span["end"] - span["start"]
+            self.stages[span["name"]] = self.stages.get(span["name"], 0.0) + seconds
+
+    # Per-backend calls, tokens and seconds (cached answers cost no tokens) and the cache hit rate
+    def summary(self):
+        backends = {}
+        hits = 0
+        for call in self.calls:
+            backend = backends.setdefault(call["backend"], {"calls": 0, "cached": 0, "errors": 0, "prompt_tokens": 0, "completion_tokens": 0, "seconds": 0.0,
+                                                            "prompt_eval_seconds": 0.0, "retries": 0, "throttle_seconds": 0.0})
+            backend["calls"] += 1
+            backend["seconds"] += call["seconds"]
+            backend["retries"] += call["retries"]
+            backend["throttle_seconds"] += call["throttle_seconds"]
+            if call["error"]:
+                backend["errors"] += 1
+            if call["cached"]:
+                backend["cached"] += 1
+                hits += 1
+            else:
+                backend["prompt_tokens"] += call["prompt_tokens"]
+                backend["completion_tokens"] += call["completion_tokens"] or 0
+                backend["prompt_eval_seconds"] += call["prompt_eval_seconds"] or 0.0
+        return {
+            "stages": {name: round(seconds, 3) for name, seconds in self.stages.items()},
+            "backends": backends,
+            "cache_hits": hits,
+            "cache_hit_rate": hits / len(self.calls) if self.calls else 0.0,
+        }
+
+
+# One model call. The timings are unix timestamps, the token counts are estimates until the
+# backend reports its real usage.
+class CallSpan:
+    def __init__(self, backend, model, prompt_tokens):
+        now = time.time()
+        queued_at = _queued_at.get()
+        stage = _current_stage.get()
+        self.metrics = _current_run.get()
+        self.record = {
+            "span_id": new_id(8),
+            "parent_span_id": stage["span_id"] if stage else (self.metrics.span_id if self.metrics else None),
+            "backend": backend,
+            "model": model,
+            "stage": stage["name"] if stage else None,
+            "queued": queued_at if queued_at is not None else now,
+            "start": now,
+            "first_token": None,
+            "end": None,
+            "queue_seconds": round(now - queued_at, 4) if queued_at is not None else 0.0,
+            "ttft_seconds": None,
+            "seconds": None,
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": None,
+            "usage_reported": False,
+            "load_seconds": None,  # the timings below are only reported by Ollama
+            "prompt_eval_seconds": None,
+            "prompt_eval_tokens": None,
+            "retries": 0,  # attempts that failed and were tried again
+            "throttle_seconds": 0.0,  # waited for the backend's rate limits
+            "cached": False,
+            "error": None,
+        }
+
+    # The call waited inside the backend before it was sent (for a slot on an Ollama node), which
+    # is queueing rather than the model's latency
+    def started(self):
+        now = time.time()
+        self.record["start"] = now
+        self.record["queue_seconds"] = round(now - self.record["queued"], 4)
+
+    def first_token(self):
+        if self.record["first_token"] is None:
+            self.record["first_token"] = time.time()
+
+    def report_usage(self, prompt_tokens, completion_tokens):
+        self.record["prompt_tokens"] = prompt_tokens
+        self.record["completion_tokens"] = completion_tokens
+        self.record["usage_reported"] = True
+
+    def report_timings(self, **timings):
+        self.record.update(timings)
+
+    def finish(self, completion_tokens=0, cached=False, error=None):
+        record = self.record
+        record["end"] = time.time()
+        if record["first_token"] is None:
+            record["first_token"] = record["end"]
+        record["ttft_seconds"] = round(record["first_token"] - record["start"], 4)
+        record["seconds"] = round(record["end"] - record["start"], 4)
+        if not record["usage_reported"]:
+            record["completion_tokens"] = completion_tokens
+        record["cached"] = cached
+        record["error"] = error
+        outcome = _call_outcome.get()
+        if outcome is not None:
+            outcome["cached"] = cached
+        if self.metrics is not None:
+            self.metrics.record_call(record)
+
+
+# Make `span` the call that report_usage() inside the block refers to
+@contextmanager
+def active_call(span):
+    token = _current_call.set(span)
+    try:
+        yield span
+    finally:
+        _current_call.reset(token)
+
+
+# Called by a backend wrapper with the token usage its response reports
+def report_usage(prompt_tokens, completion_tokens):
+    span = _current_call.get()
+    if span is not None:
+        span.report_usage(prompt_tokens, completion_tokens)
+
+
+# Called by a backend when the call it waited to send goes out
+def report_call_started():
+    span = _current_call.get()
+    if span is not None:
+        span.started()
+
+
+# Called by a backend wrapper with the load and prompt evaluation timings its response reports,
+# and by rate_limits with the retries and the rate limit waits of the call
+def report_timings(**timings):
+    span = _current_call.get()
+    if span is not None:
+        span.report_timings(**timings)
+
+
+# Same as report_usage() for the usage object of an openai / groq / ollama or anthropic response
+def report_response_usage(usage):
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_tokens", None)
+    if prompt_tokens is None:
+        prompt_tokens = getattr(usage, "input_tokens", None)
+    completion_tokens = getattr(usage, "completion_tokens", None)
+    if completion_tokens is None:
+        completion_tokens = getattr(usage, "output_tokens", None)
+    if prompt_tokens is not None and completion_tokens is not None:
+        report_usage(prompt_tokens, completion_tokens)
+
+
+# Called by an architecture with the answers of its advisors stage and the report of fan_out,
+# so a graded run can tell which advisors were right. Answers of a backup model are left out.
+def record_advisors(answers, report):
+    metrics = _current_run.get()
+    if metrics is None:
+        return
+    hedged = set(report.get("hedged", []))
+    seconds = report.get("seconds", {})
+    for name, answer in answers.items():
+        if name not in hedged:
+            metrics.advisors[name] = {"answer": answer, "seconds": seconds.get(name)}
+
+
+# Remember when a call was queued so its span can tell the waiting time apart from the call itself
+def mark_queued(queued_at):
+    _queued_at.set(queued_at)
+
+
+# Let the caller see whether the model call made in this context was answered from the cache
+def track_call_outcome():
+    outcome = {}
+    _call_outcome.set(outcome)
+    return outcome
+
+
+def current_stage_name():
+    stage = _current_stage.get()
+    return stage["name"] if stage else None
+
+
+# Collect the metrics of every model call made inside the block
+@contextmanager
+def collect_metrics():
+    metrics = RunMetrics()
+    token = _current_run.set(metrics)
+    try:
+        yield metrics
+    finally:
+        metrics.end = time.time()
+        _current_run.reset(token)
+
+
+# Tag the model calls made inside the block with an architecture stage and time the stage
+@contextmanager
+def stage(name):
+    metrics = _current_run.get()
+    parent = _current_stage.get()
+    span = {
+        "span_id": new_id(8),
+        "parent_span_id": parent["span_id"] if parent else (metrics.span_id if metrics else None),
+        "name": name,
+        "start": time.time(),
+        "end": None,
+    }
+    token = _current_stage.set(span)
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+        span["end"] = time.time()
+        if metrics is not None:
+            metrics.add_stage(span)
+
+
+# Same as stage() for a token stream that is read after the architecture function has returned
+def staged_stream(name, tokens):
+    with stage(name):
+        yield from tokens
@@ -0,0 +1,229 @@
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from backends import OllamaProvider, get_registry
+from batch import ARCHITECTURES, load_architecture
+from fanout import set_global_concurrency
+from response_cache import get_response_cache
+from run_log import log_run
+from run_metrics import collect_metrics
+from tracing import write_trace
+
+
+# Long-running service mode: the architectures are imported, the backend clients built and the
+# response cache opened once, then every problem posted to /king, /duopoly or /democracy is
+# answered as JSON, or streamed back as server-sent events. Requests for a problem that is
+# already being solved by the same architecture join that run instead of starting another one.
+
+
+# One run of an architecture on a problem, shared by every request that asks for it
+class Computation:
+    def __init__(self, architecture, problem):
+        self.architecture = architecture
+        self.problem = problem
+        self.start = time.monotonic()
+        self.tokens = []
+        self.done = False
+        self.error = None
+        self.metrics = None
+        self.seconds = None
+        self._condition = threading.Condition()
+
+    def add_token(self, token):
+        with self._condition:
+            self.tokens.append(token)
+            self._condition.notify_all()
+
+    def finish(self, error=None, metrics=None):
+        with self._condition:
+            self.done = True
+            self.error = error
+            self.metrics = metrics
+            self.seconds = round(time.monotonic() - self.start, 3)
+            self._condition.notify_all()
+
+    # Yields every token from the first one, so a request that joins late still gets the whole answer
+    def follow(self):
+        position = 0
+        while True:
+            with self._condition:
+                while position == len(self.tokens) and not self.done:
+                    self._condition.wait()
+                tokens = self.tokens[position:]
+                done = self.done
+            position += len(tokens)
+            yield from tokens
+            if done and position == len(self.tokens):
+                return
+
+    def result(self):
+        with self._condition:
+            while not self.done:
+                self._condition.wait()
+            return "".join(self.tokens).strip()
+
+
+class Coalescer:
+    def __init__(self, trace_dir=None):
+        self.trace_dir = trace_dir
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    # Returns the computation for the problem and whether it was already running
+    def join(self, architecture, problem):
+        key = hashlib.sha256(f"{architecture}\n{problem}".encode("utf-8")).hexdigest()
+        with self._lock:
+            computation = self._in_flight.get(key)
+            if computation is not None:
+                return computation, True
+            computation = self._in_flight[key] = Computation(architecture, problem)
+        # The run doesn't belong to the request that started it, so it goes on if that client leaves
+        threading.Thread(target=self._run, args=(key, computation), daemon=True).start()
+        return computation, False
+
+    def _run(self, key, computation):
+        solve = load_architecture(computation.architecture)
+        error = None
+        with collect_metrics() as metrics:
+            try:
+                for token in solve(computation.problem, stream=True):
+                    computation.add_token(token)
+            except Exception as exception:
+                error = f"{type(exception).__name__}: {exception}"
+                traceback.print_exc()
+        # Later requests for the same problem start a new run, which the response cache answers
+        with self._lock:
+            del self._in_flight[key]
+        computation.finish(error, metrics.summary())
+        log_run(computation.architecture, computation.problem, computation.result(), metrics, error)
+        if self.trace_dir:
+            write_trace(metrics, os.path.join(self.trace_dir, f"{computation.architecture}-{metrics.trace_id[:8]}.json"),
+                        run_name=computation.architecture)
+
+
+class MoMHandler(BaseHTTPRequestHandler):
+    coalescer = None  # set by serve()
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, {"status": "ok", "architectures": list(ARCHITECTURES), "in_flight": self.coalescer.in_flight()})
+        else:
+            self._send_json(404, {"error": f"Unknown path {self.path}"})
+
+    # POST /king, /duopoly or /democracy with {"problem": "...", "stream": false}
+    def do_POST(self):
+        architecture = self.path.strip("/")
+        if architecture not in ARCHITECTURES:
+            self._send_json(404, {"error": f"Unknown architecture {architecture!r}, pick one of {', '.join(ARCHITECTURES)}"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as error:
+            self._send_json(400, {"error": f"Invalid JSON: {error}"})
+            return
+        problem = body.get("problem") if isinstance(body, dict) else None
+        if not isinstance(problem, str) or not problem.strip():
+            self._send_json(400, {"error": "The body needs a non-empty \"problem\""})
+            return
+        stream = body.get("stream", "text/event-stream" in self.headers.get("Accept", ""))
+
+        computation, coalesced = self.coalescer.join(architecture, problem)
+        if stream:
+            self._send_events(computation, coalesced)
+            return
+        answer = computation.result()
+        payload = {"architecture": architecture, "answer": answer, "coalesced": coalesced,
+                   "seconds": computation.seconds, "metrics": computation.metrics}
+        if computation.error:
+            payload["error"] = computation.error
+        self._send_json(500 if computation.error else 200, payload)
+
+    def _send_json(self, status, payload):
+        data = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # Server-sent events: one `data` event per chunk of the answer, then a `done` (or `error`)
+    # event with the run's metrics
+    def _send_events(self, computation, coalesced):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream; charset=utf-8")
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        try:
+            for token in computation.follow():
+                self._send_event(None, {"token": token})
+            final = {"coalesced": coalesced, "seconds": computation.seconds, "metrics": computation.metrics}
+            if computation.error:
+                final["error"] = computation.error
+            self._send_event("error" if computation.error else "done", final)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # The client left, the run goes on for anyone else following it
+
+    def _send_event(self, event, payload):
+        message = f"event: {event}\n" if event else ""
+        message += f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+        self.wfile.write(message.encode("utf-8"))
+        self.wfile.flush()
+
+
+# Function to load everything a request needs before the first one comes in
+def warm_up():
+    for architecture in ARCHITECTURES:
+        load_architecture(architecture)
+    get_response_cache()
+    for provider in get_registry().providers():
+        try:
+            provider.client
+        except Exception as error:
+            print(f"Backend {provider.name} is not available yet: {type(error).__name__}: {error}")
+            continue
+        if isinstance(provider, OllamaProvider):
+            for url, up in provider.pool.check_all().items():
+                if not up:
+                    print(f"Ollama node {url} is down, it gets calls once it answers a health check")
+
+
+def serve(host="127.0.0.1", port=8000, max_calls=None, trace_dir=None):
+    warm_up()
+    set_global_concurrency(max_calls)
+    MoMHandler.coalescer = Coalescer(trace_dir)
+    server = ThreadingHTTPServer((host, port), MoMHandler)
+    server.daemon_threads = True
+    print(f"Serving {', '.join('/' + name for name in ARCHITECTURES)} on http://{host}:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        get_registry().close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the architectures over HTTP.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--max-calls", type=int, default=None, help="advisor calls in flight across all requests")
+    parser.add_argument("--trace-dir", default=None, help="write an OpenTelemetry (OTLP/JSON) trace of every run here")
+    args = parser.parse_args()
+
+    serve(args.host, args.port, max_calls=args.max_calls, trace_dir=args.trace_dir)
+
+
+if __name__ == "__main__":
+    main()
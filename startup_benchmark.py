@@ -0,0 +1,110 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+
+
+# Cold-start time of the scripts: each module is imported in a fresh `python -X importtime`
+# process, so the numbers are what every batch or CLI invocation pays before doing any work.
+# With --compare the same is measured for another git revision, to see a change before and after.
+DEFAULT_MODULES = ("theking2", "duop", "democracy", "batch", "benchmark")
+DEFAULT_RUNS = 5
+
+# A tree that builds its clients at import fails without API keys, these only let it be imported
+PLACEHOLDER_KEYS = {"OPENAI_API_KEY": "placeholder", "ANTHROPIC_API_KEY": "placeholder", "GROQ_API_KEY": "placeholder"}
+
+
+# Function to read the `-X importtime` report: the self and cumulative microseconds of each
+# import, in the order they finished, with their nesting level (0 for the imports of `-c`)
+def parse_importtime(stderr):
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        level = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append({"module": name.strip(), "self_us": int(self_us), "cumulative_us": int(cumulative_us), "level": level})
+    return imports
+
+
+def measure_module(module, tree, runs):
+    env = dict(os.environ)
+    for key, value in PLACEHOLDER_KEYS.items():
+        env.setdefault(key, value)
+    wall = []
+    imports = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                                 cwd=tree, env=env, capture_output=True, text=True)
+        wall.append(time.perf_counter() - start)
+        if process.returncode != 0:
+            return {"module": module, "error": process.stderr.strip().splitlines()[-1]}
+        imports = parse_importtime(process.stderr)
+    # A module's own imports are listed right before it, one level deeper
+    position = next(i for i, entry in enumerate(imports) if entry["module"] == module and entry["level"] == 0)
+    start = max((i + 1 for i in range(position) if imports[i]["level"] == 0), default=0)
+    own = imports[position]
+    slowest = sorted((entry for entry in imports[start:position] if entry["level"] == 1), key=lambda entry: -entry["cumulative_us"])
+    return {
+        "module": module,
+        "wall_seconds": round(statistics.median(wall), 4),
+        "import_seconds": round(own["cumulative_us"] / 1e6, 4),
+        "slowest": [(entry["module"], round(entry["cumulative_us"] / 1e6, 4)) for entry in slowest],
+    }
+
+
+# Function to unpack a git revision of the repository in a temporary directory
+def export_revision(revision, directory):
+    archive = subprocess.run(["git", "archive", "--format=tar", revision], capture_output=True, check=True,
+                             cwd=os.path.dirname(os.path.abspath(__file__)))
+    archive_path = os.path.join(directory, "tree.tar")
+    with open(archive_path, 'wb') as outfile:
+        outfile.write(archive.stdout)
+    tree = os.path.join(directory, "tree")
+    with tarfile.open(archive_path) as tar:
+        tar.extractall(tree)
+    return tree
+
+
+def format_seconds(value):
+    return "-" if value is None else f"{value * 1000:.0f} ms"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure how long the scripts take to start.")
+    parser.add_argument("--modules", nargs="+", default=list(DEFAULT_MODULES))
+    parser.add_argument("--runs", type=int, default=DEFAULT_RUNS, help="processes started per module, the median is reported")
+    parser.add_argument("--top", type=int, default=5, help="slowest imports listed per module")
+    parser.add_argument("--compare", metavar="REVISION", help="also measure this git revision, e.g. HEAD~1")
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as directory:
+        before = {}
+        if args.compare:
+            tree = export_revision(args.compare, directory)
+            before = {module: measure_module(module, tree, args.runs) for module in args.modules}
+        for module in args.modules:
+            after = measure_module(module, here, args.runs)
+            if "error" in after:
+                print(f"{module}: failed to import, {after['error']}")
+                continue
+            line = f"{module}: {format_seconds(after['wall_seconds'])} to start, {format_seconds(after['import_seconds'])} importing"
+            if module in before:
+                if "error" in before[module]:
+                    line += f" ({args.compare}: failed to import)"
+                else:
+                    line += f" ({args.compare}: {format_seconds(before[module]['wall_seconds'])} to start, " \
+                            f"{format_seconds(before[module]['import_seconds'])} importing)"
+            print(line)
+            for name, seconds in after["slowest"][:args.top]:
+                print(f"    {format_seconds(seconds):>8}  {name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import json
+import os
+import re
+
+
+# JSON reply formats for the stages whose answer is read by code rather than by a person: a vote
+# names an option by number, an answer keeps the final result apart from the reasoning. ask()
+# puts the schema in the prompt and switches the backend to its JSON mode, the reply is checked
+# here and, when it doesn't fit, the model is asked once more to fix it (see ask_structured).
+DEFAULT_RETRIES = 1
+STRUCTURED_STAGES = ("votes", "answers")
+
+ANSWER_SCHEMA = {
+    "title": "answer",
+    "description": "The solution to the problem",
+    "type": "object",
+    "properties": {
+        "final_answer": {"type": "string", "minLength": 1, "description": "the final answer to the problem on its own, e.g. the number, the word or the code"},
+        "rationale": {"type": "string", "description": "the reasoning and the steps that lead to the final answer"},
+    },
+    "required": ["final_answer", "rationale"],
+    "additionalProperties": False,
+}
+
+_CODE_FENCE = re.compile(r"```(?:json)?\s*\n?(.*?)```", re.DOTALL | re.IGNORECASE)
+
+
+def vote_schema(options):
+    return {
+        "title": "vote",
+        "description": "A vote for one of the numbered options",
+        "type": "object",
+        "properties": {
+            "choice_id": {"type": "integer", "minimum": 1, "maximum": options, "description": "the number of the option you vote for"},
+            "confidence": {"type": "number", "minimum": 0, "maximum": 1, "description": "how sure you are that this option solves the problem, from 0 to 1"},
+        },
+        "required": ["choice_id", "confidence"],
+        "additionalProperties": False,
+    }
+
+
+# Which stages reply in JSON (MOM_STRUCTURED_OUTPUT, a comma separated list of votes and answers, or off)
+def structured_stages_from_env():
+    value = os.getenv("MOM_STRUCTURED_OUTPUT", "votes").strip().lower()
+    if value in ("", "off", "none"):
+        return set()
+    if value == "all":
+        return set(STRUCTURED_STAGES)
+    stages = {stage.strip() for stage in value.split(",") if stage.strip()}
+    unknown = stages - set(STRUCTURED_STAGES)
+    if unknown:
+        raise ValueError(f"MOM_STRUCTURED_OUTPUT takes {', '.join(STRUCTURED_STAGES)}, all or off, got {', '.join(sorted(unknown))}")
+    return stages
+
+
+def structured_retries_from_env():
+    return int(os.getenv("MOM_STRUCTURED_RETRIES", DEFAULT_RETRIES))
+
+
+def schema_instruction(schema):
+    return f"Reply with only a JSON object, no other text, that matches this JSON schema:\n{json.dumps(schema, ensure_ascii=False)}"
+
+
+def repair_prompt(errors):
+    return "Your reply didn't match the JSON schema: " + "; ".join(errors)
+
+
+# Function to check a value against the parts of JSON schema the formats above use. Returns the
+# list of problems, empty when the value fits.
+def validate(value, schema, path="reply"):
+    expected = schema.get("type")
+    if expected == "object":
+        if not isinstance(value, dict):
+            return [f"{path} must be an object"]
+        errors = [f"{path} is missing {key}" for key in schema.get("required", []) if key not in value]
+        properties = schema.get("properties", {})
+        for key, item in value.items():
+            if key in properties:
+                errors += validate(item, properties[key], f"{path}.{key}" if path != "reply" else key)
+            elif schema.get("additionalProperties", True) is False:
+                errors.append(f"{path} has an unexpected field {key}")
+        return errors
+    if expected == "string" and not isinstance(value, str):
+        return [f"{path} must be a string"]
+    if expected == "integer" and (isinstance(value, bool) or not isinstance(value, int)):
+        return [f"{path} must be an integer"]
+    if expected == "number" and (isinstance(value, bool) or not isinstance(value, (int, float))):
+        return [f"{path} must be a number"]
+    if expected == "boolean" and not isinstance(value, bool):
+        return [f"{path} must be true or false"]
+    errors = []
+    if "enum" in schema and value not in schema["enum"]:
+        errors.append(f"{path} must be one of {', '.join(map(json.dumps, schema['enum']))}")
+    if "minimum" in schema and value < schema["minimum"]:
+        errors.append(f"{path} must be at least {schema['minimum']}")
+    if "maximum" in schema and value > schema["maximum"]:
+        errors.append(f"{path} must be at most {schema['maximum']}")
+    if "minLength" in schema and len(value) < schema["minLength"]:
+        errors.append(f"{path} must not be empty")
+    return errors
+
+
+# Function to find the JSON object in a reply: the whole reply, a ```json block or the first
+# object in the text around it. Returns None when there is none.
+def extract_json(reply):
+    candidates = [reply.strip()] + [block.strip() for block in _CODE_FENCE.findall(reply)]
+    for candidate in candidates:
+        try:
+            value = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(value, dict):
+            return value
+    decoder = json.JSONDecoder()
+    for match in re.finditer(r"\{", reply):
+        try:
+            value, _ = decoder.raw_decode(reply, match.start())
+        except ValueError:
+            continue
+        if isinstance(value, dict):
+            return value
+    return None
+
+
+# Numbers sent as strings ("3", "0.8") and whole floats for integers are taken as they were meant
+def _coerce(value, schema):
+    expected = schema.get("type")
+    if expected == "object" and isinstance(value, dict):
+        properties = schema.get("properties", {})
+        return {key: _coerce(item, properties[key]) if key in properties else item for key, item in value.items()}
+    if expected in ("integer", "number") and isinstance(value, str):
+        try:
+            value = float(value.strip())
+        except ValueError:
+            return value
+    if expected == "integer" and isinstance(value, float) and value.is_integer():
+        return int(value)
+    if expected == "string" and isinstance(value, str):
+        return value.strip()
+    return value
+
+
+# Function to read a reply in the given format. Returns the value and no errors, or None and
+# what is wrong with the reply.
+def parse_reply(reply, schema):
+    value = extract_json(reply)
+    if value is None:
+        return None, ["the reply is not a JSON object"]
+    value = _coerce(value, schema)
+    errors = validate(value, schema)
+    if errors:
+        return None, errors
+    return value, []
+
+
+# Function to write a structured answer as text, with the final answer on its own last line
+def format_answer(answer):
+    return f"{answer['rationale'].strip()}\n\nFinal answer: {answer['final_answer']}".strip()
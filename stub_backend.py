@@ -0,0 +1,245 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from types import SimpleNamespace
+
+from answer_store import AnswerStore
+from backends import AnthropicProvider, OllamaProvider, get_registry
+from rate_limits import RateLimiter
+from token_count import estimate_prompt_tokens, estimate_tokens
+
+
+# Clients that look like the openai / groq / anthropic SDK clients of the backends, but answer from
+# a recordings file instead of calling a model. Recordings are made by wrapping the real clients
+# with the Recording* clients below, so a benchmark can be replayed offline as often as needed.
+# The recorded responses are kept in an AnswerStore, each distinct text once.
+
+
+def request_key(backend, request):
+    payload = json.dumps(
+        [backend, request.get("model"), request.get("system"), request.get("messages"),
+         request.get("temperature"), request.get("max_tokens"), request.get("options")],
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class Recordings:
+    def __init__(self, path):
+        self.path = path
+        self.missing = 0
+        self._records = AnswerStore()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as infile:
+                for line in infile:
+                    if line.strip():
+                        record = json.loads(line)
+                        self._records.add(record["key"], record)
+
+    def lookup(self, key):
+        return self._records.get(key)
+
+    def add(self, record):
+        with self._lock:
+            self._records.add(record["key"], record)
+            with open(self.path, 'a', encoding='utf-8') as outfile:
+                outfile.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+class _StubClient:
+    # missing: "placeholder" answers calls that were never recorded with a fixed text, "error" raises
+    def __init__(self, backend, recordings, speed=0.0, missing="placeholder"):
+        self.backend = backend
+        self.recordings = recordings
+        self.speed = speed
+        self.missing = missing
+
+    def _replay(self, request):
+        record = self.recordings.lookup(request_key(self.backend, request))
+        if record is None:
+            with self.recordings._lock:
+                self.recordings.missing += 1
+            if self.missing == "error":
+                raise LookupError(f"No recorded {self.backend} response for model {request.get('model')}")
+            return f"[no recorded {self.backend} response for {request.get('model')}]", 0.0
+        # Replay the recorded latency, scaled by `speed` (0 answers at once)
+        if self.speed:
+            time.sleep((record["seconds"] or 0.0) * self.speed)
+        return record["response"], record["seconds"] or 0.0
+
+    @staticmethod
+    def _chunks(text, size=16):
+        for start in range(0, len(text), size):
+            yield text[start:start + size]
+
+
+class StubChatClient(_StubClient):
+    # Shape of OpenAI() / Groq(): client.chat.completions.create(...)
+    def __init__(self, backend, recordings, speed=0.0, missing="placeholder"):
+        super().__init__(backend, recordings, speed, missing)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, stream=False, stream_options=None, **request):
+        text, _ = self._replay(request)
+        usage = SimpleNamespace(
+            prompt_tokens=estimate_prompt_tokens(None, request.get("messages", [])),
+            completion_tokens=estimate_tokens(text),
+        )
+        if stream:
+            chunks = [SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=chunk))], usage=None)
+                      for chunk in self._chunks(text)]
+            # As the API, the usage comes in a last chunk without choices when it is asked for
+            if (stream_options or {}).get("include_usage"):
+                chunks.append(SimpleNamespace(choices=[], usage=usage))
+            return iter(chunks)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=usage)
+
+
+class StubAnthropicClient(_StubClient):
+    # Shape of anthropic.Anthropic(): client.messages.create(...) and client.messages.stream(...)
+    def __init__(self, backend, recordings, speed=0.0, missing="placeholder"):
+        super().__init__(backend, recordings, speed, missing)
+        self.messages = SimpleNamespace(create=self._create, stream=self._stream)
+
+    def _create(self, **request):
+        text, _ = self._replay(request)
+        usage = SimpleNamespace(
+            input_tokens=estimate_prompt_tokens(request.get("system"), request.get("messages", [])),
+            output_tokens=estimate_tokens(text),
+        )
+        return SimpleNamespace(content=[SimpleNamespace(text=text)], usage=usage)
+
+    @contextmanager
+    def _stream(self, **request):
+        text, _ = self._replay(request)
+        usage = SimpleNamespace(
+            input_tokens=estimate_prompt_tokens(request.get("system"), request.get("messages", [])),
+            output_tokens=estimate_tokens(text),
+        )
+        yield SimpleNamespace(text_stream=self._chunks(text), get_final_message=lambda: SimpleNamespace(usage=usage))
+
+
+def _ndjson_lines(records):
+    for record in records:
+        yield json.dumps(record)
+
+
+class StubOllamaClient(_StubClient):
+    # Shape of the HTTP client of an Ollama backend: client.post(f"{node}/api/chat", json=...) and client.stream(...)
+    def _answer(self, request, text):
+        return {
+            "message": {"role": "assistant", "content": text},
+            "done": True,
+            "prompt_eval_count": estimate_prompt_tokens(None, request.get("messages", [])),
+            "eval_count": estimate_tokens(text),
+        }
+
+    def post(self, path, json):
+        text, _ = self._replay(json)
+        return SimpleNamespace(raise_for_status=lambda: None, json=lambda: self._answer(json, text))
+
+    # The health checks of the Ollama pool find every model models.json has on this backend pulled
+    def get(self, url, timeout=None):
+        config = get_registry().config
+        models = [{"name": settings["model"]} for settings in config["models"].values() if settings["backend"] == self.backend]
+        return SimpleNamespace(raise_for_status=lambda: None, json=lambda: {"models": models})
+
+    @contextmanager
+    def stream(self, method, path, json):
+        text, _ = self._replay(json)
+        records = [{"message": {"content": chunk}, "done": False} for chunk in self._chunks(text)]
+        records.append(self._answer(json, ""))
+        yield SimpleNamespace(raise_for_status=lambda: None, iter_lines=lambda: _ndjson_lines(records))
+
+
+class RecordingChatClient:
+    # Wraps a real OpenAI() / Groq() client and records every non-streaming answer
+    def __init__(self, backend, client, recordings):
+        self.backend = backend
+        self.client = client
+        self.recordings = recordings
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **request):
+        start = time.monotonic()
+        response = self.client.chat.completions.create(**request)
+        if not request.get("stream"):
+            self.recordings.add({
+                "key": request_key(self.backend, request),
+                "backend": self.backend,
+                "model": request.get("model"),
+                "response": response.choices[0].message.content.strip(),
+                "seconds": round(time.monotonic() - start, 3),
+            })
+        return response
+
+
+class RecordingAnthropicClient:
+    def __init__(self, backend, client, recordings):
+        self.backend = backend
+        self.client = client
+        self.recordings = recordings
+        self.messages = SimpleNamespace(create=self._create, stream=self.client.messages.stream)
+
+    def _create(self, **request):
+        start = time.monotonic()
+        response = self.client.messages.create(**request)
+        self.recordings.add({
+            "key": request_key(self.backend, request),
+            "backend": self.backend,
+            "model": request.get("model"),
+            "response": AnthropicProvider._text(response),
+            "seconds": round(time.monotonic() - start, 3),
+        })
+        return response
+
+
+class RecordingOllamaClient:
+    def __init__(self, backend, client, recordings):
+        self.backend = backend
+        self.client = client
+        self.recordings = recordings
+        self.stream = self.client.stream
+        self.get = self.client.get
+
+    def post(self, path, json):
+        start = time.monotonic()
+        response = self.client.post(path, json=json)
+        if response.status_code == 200:
+            self.recordings.add({
+                "key": request_key(self.backend, json),
+                "backend": self.backend,
+                "model": json.get("model"),
+                "response": response.json()["message"]["content"].strip(),
+                "seconds": round(time.monotonic() - start, 3),
+            })
+        return response
+
+
+# Function to swap the client of every backend in the registry for a stub. A replay doesn't
+# reach the providers, so it isn't held to their rate limits.
+def install_stubs(recordings, speed=0.0, missing="placeholder"):
+    for provider in get_registry().providers():
+        provider.limiter = RateLimiter()
+        if isinstance(provider, AnthropicProvider):
+            provider.client = StubAnthropicClient(provider.name, recordings, speed, missing)
+        elif isinstance(provider, OllamaProvider):
+            provider.client = StubOllamaClient(provider.name, recordings, speed, missing)
+        else:
+            provider.client = StubChatClient(provider.name, recordings, speed, missing)
+
+
+# Function to wrap the real client of every backend in the registry so its answers are recorded
+def install_recorders(recordings):
+    for provider in get_registry().providers():
+        if isinstance(provider, AnthropicProvider):
+            provider.client = RecordingAnthropicClient(provider.name, provider.client, recordings)
+        elif isinstance(provider, OllamaProvider):
+            provider.client = RecordingOllamaClient(provider.name, provider.client, recordings)
+        else:
+            provider.client = RecordingChatClient(provider.name, provider.client, recordings)
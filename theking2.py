@@ -1,31 +1,21 @@
-import anthropic
-from openai import OpenAI
-import os
 from dotenv import load_dotenv
-import re
-import requests
-import markdown
-import webbrowser
-import tempfile
 from tqdm import tqdm
-import time
-from groq import Groq
+from fanout import AnswerFeed, fan_out, advisor_notes, advisor_stage, pipeline_first_from_env
+from backends import ask, ask_structured, architecture_models
+from live_html import stream_to_html
+from answer_clusters import cluster_answers, extract_final_answer, format_clusters
+from advisor_router import route, describe_plan, router_settings_from_env
+from token_count import estimate_tokens
+from king_rounds import disagrees, king_rounds_from_env, king_update_prompt, review_messages
+from token_budget import first_round_budget, fit_clusters, fit_to_budget, stage_budget
+from run_metrics import stage, staged_stream, collect_metrics, record_advisors
+from structured_output import ANSWER_SCHEMA, format_answer, structured_stages_from_env
+from tracing import report_run
+from run_log import log_run
 
 
 load_dotenv()
 
-# API keys
-openai_api_key = os.getenv("OPENAI_API_KEY")
-anthropic_api_key = os.getenv("ANTHROPIC_API_KEY")
-groq_api_key = os.getenv("GROQ_API_KEY")
-
-# Clients
-anthropic_client = anthropic.Anthropic(api_key=anthropic_api_key)
-ollama_client = OpenAI(base_url='http://localhost:11434/v1', api_key='llama3')
-openai_client = OpenAI(api_key=openai_api_key)
-groq_client = client = Groq(api_key=groq_api_key)
-
-client = Groq()
 
 # Colors (unused in HTML output, kept for possible console outputs or further expansions)
 PINK = '\033[95m'
@@ -39,121 +29,7 @@ def open_file(filepath):
     with open(filepath, 'r', encoding='utf-8') as infile:
         return infile.read()
 
-def groq_llama70B(messages):
-    system_message3="You are a coder and problem solver expert"
-    response = groq_client.chat.completions.create(
-        messages=[
-            {"role": "system", "content": system_message3},
-            {"role": "user", "content": messages}
-        ],
-        model="llama3-70b-8192",
-        temperature=0.3,
-        max_tokens=1024,
-    )
-    message_content = response.choices[0].message.content.strip()
-    return message_content
-
-def ollamacpp(model, messages):
-    system_message = {"role": "system", "content": "You are a coder and problem solver expert"}
-
-    # Ensure messages is a list and each element is properly formatted
-    if not isinstance(messages, list):
-        messages = [{"role": "user", "content": messages}]
-    else:
-        messages = [{"role": "user", "content": msg} if not isinstance(msg, dict) else msg for msg in messages]
-    messages.insert(0, system_message)
-
-    response = ollama_client.chat.completions.create(
-        model=model,
-        messages=messages,
-        temperature=0.3
-    )
-
-    message_content = response.choices[0].message.content.strip()
-    return message_content  
-
-
-def claude3(messages):
-    response = anthropic_client.messages.create(
-        model="claude-3-sonnet-20240229",
-        messages=[{"role": "user", "content": messages}],
-        max_tokens=700,
-        system="You are a coder and problem solver expert",
-        temperature=0.3,
-    )
-
-    message_content = response.content
-    message_content = message_content[0].text.strip()
-    return message_content
-
-def openai(messages, system_message):
-    response = openai_client.chat.completions.create(
-        model="gpt-4-turbo",
-        messages=[
-            {"role": "system", "content": system_message},
-            {"role": "user", "content": messages}
-        ],
-        temperature=0.3,
-    )
-
-    message_content = response.choices[0].message.content.strip()
-    return message_content
-
-def generate_html_response(full_response):
-    html_content = f'''
-    <!DOCTYPE html>
-    <html lang="en">
-    <head>
-        <meta charset="UTF-8">
-        <meta name="viewport" content="width=device-width, initial-scale=1.0">
-        <title>Interactive AI Response</title>
-        <style>
-            body {{
-                font-family: 'Arial', sans-serif;
-                background-color: #f4f4f4;
-                margin: 40px;
-                color: #333;
-            }}
-            .container {{
-                background-color: white;
-                border: 1px solid #ccc;
-                border-radius: 8px;
-                padding: 20px;
-                box-shadow: 0 4px 8px rgba(0,0,0,0.1);
-            }}
-            pre {{
-                background-color: #282a36;
-                color: #f8f8f2;
-                border-radius: 5px;
-                border: 1px solid #ccc;
-                padding: 10px;
-                font-family: 'Consolas', 'Courier New', Courier, monospace;
-                overflow: auto;
-                white-space: pre-wrap;
-            }}
-            h1 {{
-                color: #2c3e50;
-            }}
-            p, ol {{
-                line-height: 1.6;
-            }}
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>Response from AI Advisors</h1>
-            <p>This section contains dynamically generated responses from various AI models processed by the <code>the_king</code> function.</p>
-            <pre>{full_response}</pre>
-        </div>
-    </body>
-    </html>
-    '''
-
-    with tempfile.NamedTemporaryFile(mode='w', delete=False, suffix='.html') as temp_file:
-        temp_file.write(html_content)
-        webbrowser.open('file://' + temp_file.name)
-
-def the_king(user_message):
+def the_king(user_message, stream=False, cluster=True, category=None, structured=None, rounds=None, pipeline_first=None):
     system_message = """You are a wise and knowledgeable coder and problem solver king who provides thoughtful answers to questions.
     
     You have 10 advisors, who offer their insights to assist you.
@@ -162,50 +38,141 @@ def the_king(user_message):
     problem based on all context and advice. If you find their input helpful, feel free to acknowledge their
     contributions in your answer."""
 
-    models = {
-        "wizardlm2:7b": "Wizardlm2",
-        "llama3": "Llama3 8B",
-        "mistral": "Mistral 7B",
-        "qwen:14b": "Qwen 14B",
-        "phi3": "Phi3",
-        "gemma:7b": "Gemma 7B",
-        "codeqwen": "CodeQwen",
-        "openchat": "OpenChat",
-        "magicoder": "Magicoder"
-    }
-    answers = {}
-    tasks = [f"Consulting {name}" for name in models.values()]
-    progress_bar = tqdm(tasks, desc="Gathering insights", unit="task")
-
-    for model, name in models.items():
-        progress_bar.set_description(f"Consulting {name}")
-        answers[name] = ollamacpp(model, user_message)
-        progress_bar.update()
-
-    # Adding Llama3 70B and Claude3 responses
-    progress_bar.set_description("Consulting Llama3 70B Pessant")
-    answers["Llama3 70B"] = groq_llama70B(user_message)
-    progress_bar.update()
-
-    progress_bar.set_description("Consulting Claude3 Pessant")
-    answers["Claude3"] = claude3(user_message)
-    progress_bar.update()
-
-    # Construct the peasant_answers string
-    peasant_answers = "\n\n".join(f"{name}'s advice: {advice}" for name, advice in answers.items())
+    # The advisors, the backup model and the King are declared in models.json
+    models = architecture_models("king")
+    advisors = models["advisors"]
+    # For a problem of a known category only the advisors that do well enough on it are consulted
+    if category:
+        advisors, plan = route(advisors, category, estimate_tokens(user_message), **router_settings_from_env())
+        if plan:
+            print(describe_plan(plan, len(models["advisors"])))
+    if rounds is None:
+        rounds = king_rounds_from_env()
+    rounds = max(1, rounds)
+    # Send every advisor request at once, the answers come back in the order of `calls`
+    calls, policy = advisor_stage("king", user_message, models, advisors, system_message=system_message, rounds=rounds)
+    report = policy["report"]
+
+    progress_bar = tqdm(total=len(calls) + 1, desc="Gathering insights", unit="task")
+    if pipeline_first is None:
+        pipeline_first = pipeline_first_from_env()
+    if pipeline_first and rounds > 1:
+        # The first round starts on the first answers, the later ones are brought in at the next
+        # round; with a single round the King waits for every advisor
+        feed = AnswerFeed(calls, progress_bar, **policy)
+        answers = feed.take(pipeline_first)
+        notes = ""
+    else:
+        feed = None
+        with stage("advisors"):
+            answers = fan_out(calls, progress_bar, **policy)
+        record_advisors(answers, report)
+        notes = advisor_notes(report)
+        if notes:
+            print(notes)
+
+    # The fixed instructions and the problem come first and the advice last, so the part of the
+    # prompt that is the same from run to run stays a prefix the backend can reuse
+    king_instructions = f"Use the insights from the advisors below to create a step-by-step plan to solve the given {{problem}}, then solve the problem your way. Also, include footnotes to the best advisor contributions.\n\n{{Problem}}: {user_message}\n\nPessants Advice:"
+
+    # Construct the peasant_answers string, advisors that reached the same result are passed on once with their support count.
+    # The advice is cut down evenly when it doesn't fit the King's context window, less the room
+    # the later rounds need.
+    budget, count = stage_budget("king", [models["king"]], system_message, king_instructions + (f"\n\n{notes}" if notes else ""))
+    budget = first_round_budget(budget, rounds)
+    if cluster:
+        peasant_answers = format_clusters(fit_clusters(cluster_answers(answers), budget, count, "king"))
+    else:
+        advice = fit_to_budget(answers, budget, count, "king")
+        peasant_answers = "\n\n".join(f"{name}'s advice: {advice}" for name, advice in advice.items())
+    if notes:
+        peasant_answers += f"\n\n{notes}"
 
     progress_bar.set_description("Compiling advice from Peasants")
     
     # Final processing and output
-    king_prompt = f"Pessants Advice:{peasant_answers}\n\n{{Problem}}: {user_message}\n\nUse the insights from the advisors to create a step-by-step plan to solve the given {{problem}}, then solve the problem your way. Also, include footnotes to the best advisor contributions."
+    king_prompt = f"{king_instructions}{peasant_answers}"
     progress_bar.set_description("The King is solving the problem")
-    king_answer = openai(king_prompt, system_message)
+    if structured is None:
+        structured = "answers" in structured_stages_from_env()
+
+    # After each round only the advisors that disagree with the King are asked again, and the
+    # King only sees the answers that changed (see king_rounds)
+    specs = {advisor.name: advisor for advisor in advisors}
+    hedged = set(report.get("hedged", []))
+    conversation = [{"role": "user", "content": king_prompt}]
+    reviewed = {}  # advisor -> the King's result it was last shown
+    for round_number in range(1, rounds + 1):
+        stage_name = "king" if round_number == 1 else f"king round {round_number}"
+        last_round = round_number == rounds
+        if stream and last_round and not structured:
+            # Hand the King's tokens back as they are written
+            progress_bar.update()
+            progress_bar.close()
+            return staged_stream(stage_name, ask(models["king"], conversation, system_message, stream=True))
+        with stage(stage_name):
+            if structured:
+                # The final answer and the reasoning come back apart, a reply that can't be read is passed on as it is
+                answer, king_reply = ask_structured(models["king"], conversation, ANSWER_SCHEMA, system_message)
+                king_answer = format_answer(answer) if answer is not None else king_reply
+            else:
+                king_reply = king_answer = ask(models["king"], conversation, system_message)
+        if last_round:
+            break
+        late = {}
+        if feed is not None:
+            late = feed.rest()
+            feed = None
+            answers.update(late)
+            record_advisors(answers, report)
+            hedged = set(report.get("hedged", []))
+            notes = advisor_notes(report)
+            if notes:
+                print(notes)
+        king_result = extract_final_answer(king_answer)
+        if king_result is None and not late:
+            print(f"The King's answer of round {round_number} states no result the advisors can be checked against")
+            break
+        # An advisor that kept its answer against this result already isn't asked again, the
+        # late ones haven't been seen by the King yet
+        disagreeing = [name for name, answer in answers.items()
+                       if name not in late and disagrees(answer, king_answer) and reviewed.get(name) != king_result]
+        if not disagreeing and not late:
+            print(f"No advisor left to convince after round {round_number}")
+            break
+        reviewed.update(dict.fromkeys(disagreeing, king_result))
+        calls = {name: (ask, models["hedge"] if name in hedged else specs[name], review_messages(user_message, answers[name], king_answer))
+                 for name in disagreeing}
+        with stage(f"advisors round {round_number + 1}"):
+            revised = fan_out(calls, skip_failures=True) if calls else {}
+        changed = {name: answer for name, answer in revised.items() if extract_final_answer(answer) != extract_final_answer(answers[name])}
+        answers.update(revised)
+        print(f"Round {round_number + 1}: {len(disagreeing)} of {len(answers)} advisors disagreed with the King, {len(changed)} changed their answer"
+              + (f", {len(late)} answered after the King started" if late else ""))
+        if not changed and not late:
+            break
+        # The answers shown to the King are cut down to what is left of its context
+        conversation_text = "\n".join(message["content"] for message in conversation) + king_reply
+        left, _ = stage_budget("king", [models["king"]], system_message, conversation_text + king_update_prompt({}, answers, king_answer))
+        try:
+            shown = fit_to_budget({**late, **changed}, left, count, "king")
+        except ValueError:
+            print(f"No room left in the King's context for round {round_number + 1}")
+            break
+        update = king_update_prompt({name: shown[name] for name in changed}, answers, king_answer, {name: shown[name] for name in late})
+        conversation += [{"role": "assistant", "content": king_reply}, {"role": "user", "content": update}]
     progress_bar.update()
 
     progress_bar.close()
-    return king_answer
-
-question = open_file("problem.txt")
-html_response1 = the_king(question)  #First Run
-#html_response2 = the_king(html_response1)  # Run it twice
-generate_html_response(html_response1)
+    return iter([king_answer]) if stream else king_answer
+
+if __name__ == "__main__":
+    question = open_file("problem.txt")
+    with collect_metrics() as metrics:
+        html_response1 = stream_to_html(  #First Run, streamed into the console and a live HTML page
+            the_king(question, stream=True),
+            "Response from AI Advisors",
+            "This section contains dynamically generated responses from various AI models processed by the <code>the_king</code> function.",
+        )
+    report_run(metrics, "king")
+    log_run("king", question, html_response1, metrics)
@@ -0,0 +1,242 @@
+import os
+
+from advisor_router import estimated_cost, estimated_latency
+from backends import get_registry, local_capacity
+from debate_context import DEFAULT_INSIGHT_TOKENS, context_budget_from_env, debate_turns_from_env
+from model_stats import get_model_stats
+
+
+# Every prompt built from the advisors' answers has to fit the models it goes to. Each backend
+# counts tokens with its own tokenizer (token_count.Tokenizer) and each model has a context
+# window ("context_window" in models.json, the backend's num_ctx for Ollama). A stage gets the
+# smallest window of its models, less their longest reply, the system message and the fixed
+# part of its prompt, capped by MOM_STAGE_TOKEN_BUDGETS, and when the answers don't fit they are
+# cut down to an even share, start and end kept, leaving the ones under that share whole.
+# Before a run its cost and duration are estimated from the prices in models.json and the
+# advisors' latencies in MOM_STATS_PATH, and a run over MOM_RUN_COST_BUDGET or
+# MOM_RUN_LATENCY_BUDGET, or a problem too long for one of its models, fails before any call.
+DEFAULT_CONTEXT_WINDOW = 8192
+DEFAULT_REPLY_TOKENS = 1024  # kept free for the reply of a model without max_tokens
+DEFAULT_ANSWER_TOKENS = 500  # expected length of an answer, for the estimate
+DEFAULT_TOKENS_PER_SECOND = 30.0  # a backend without "tokens_per_second" or latency history
+VOTE_TOKENS = 100
+OPTION_TOKENS = 30  # the line that introduces an answer ("Option 3 - Phi3's advice (given by 2 advisors):")
+MIN_ANSWER_TOKENS = 50  # an answer cut shorter than this says nothing anymore
+SAFETY_MARGIN = 0.05  # a backend's own tokenizer may count more than ours
+
+
+# MOM_STAGE_TOKEN_BUDGETS caps the prompt of a stage, e.g. king=20000,votes=6000
+def stage_budgets_from_env():
+    budgets = {}
+    for item in os.getenv("MOM_STAGE_TOKEN_BUDGETS", "").split(","):
+        if item.strip():
+            stage, _, tokens = item.partition("=")
+            budgets[stage.strip()] = int(tokens)
+    return budgets
+
+
+def run_budgets_from_env():
+    cost_budget = os.getenv("MOM_RUN_COST_BUDGET")
+    latency_budget = os.getenv("MOM_RUN_LATENCY_BUDGET")
+    return {
+        "cost_budget": float(cost_budget) if cost_budget else None,
+        "latency_budget": float(latency_budget) if latency_budget else None,
+    }
+
+
+def tokenizer(spec):
+    return get_registry().provider(spec.backend).tokenizer
+
+
+def count_tokens(spec, text):
+    return tokenizer(spec).count(text)
+
+
+def context_window(spec):
+    return spec.context_window or DEFAULT_CONTEXT_WINDOW
+
+
+def reply_tokens(spec):
+    return spec.max_tokens or DEFAULT_REPLY_TOKENS
+
+
+# Function to work out how many tokens of answers the prompt of a stage can take. Returns them
+# with the count of the model that leaves the least room, which is the one they are cut for.
+def stage_budget(stage, specs, system_message="", fixed=""):
+    cap = stage_budgets_from_env().get(stage)
+    budgets = []
+    for spec in specs:
+        count = tokenizer(spec).count
+        prompt = context_window(spec) - reply_tokens(spec)
+        if cap is not None:
+            prompt = min(prompt, cap)
+        budgets.append((int(prompt * (1 - SAFETY_MARGIN)) - count(system_message or "") - count(fixed), count))
+    return min(budgets, key=lambda budget: budget[0])
+
+
+# Function to shorten a text to max_tokens of `count`, keeping its start and its end
+def trim(text, max_tokens, count):
+    tokens = count(text)
+    if tokens <= max_tokens:
+        return text
+    keep = int(len(text) * max_tokens / tokens)
+    while True:
+        head = text[: keep * 2 // 3].rstrip()
+        tail = text[len(text) - keep // 3:].lstrip()
+        trimmed = f"{head}\n[...]\n{tail}"
+        if count(trimmed) <= max_tokens or keep <= 0:
+            return trimmed
+        keep = int(keep * 0.9)
+
+
+# Every answer gets an even share of the budget, and what the shorter ones don't use is shared by
+# the others
+def fair_shares(lengths, budget):
+    shares = dict(lengths)
+    pending = sorted(lengths, key=lengths.get)
+    while pending:
+        share = budget // len(pending)
+        if lengths[pending[0]] > share:
+            shares.update(dict.fromkeys(pending, share))
+            break
+        budget -= lengths[pending.pop(0)]
+    return shares
+
+
+# Function to cut the answers (name -> text) down until they fit `budget` tokens of `count`
+def fit_to_budget(answers, budget, count, stage):
+    lengths = {name: count(text) + OPTION_TOKENS for name, text in answers.items()}
+    if sum(lengths.values()) <= budget:
+        return answers
+    if budget < len(answers) * (MIN_ANSWER_TOKENS + OPTION_TOKENS):
+        raise ValueError(f"The {stage} prompt has room for {max(0, budget)} tokens of advisor answers, too few for {len(answers)} answers; "
+                         "shorten the problem or give the stage's models a larger context window")
+    shares = fair_shares(lengths, budget)
+    fitted = {name: trim(text, shares[name] - OPTION_TOKENS, count) for name, text in answers.items()}
+    cut = [name for name in answers if lengths[name] > shares[name]]
+    print(f"Cut {len(cut)} of {len(answers)} advisor answers to about {max(shares.values()) - OPTION_TOKENS} tokens "
+          f"so the {stage} prompt fits in {budget} tokens: {', '.join(cut)}")
+    return fitted
+
+
+# With more than one round the King's conversation grows by its reply and the answers shown to it
+# after each round, so the first round's advice only gets its share of the budget
+def first_round_budget(budget, rounds):
+    return budget // max(1, rounds)
+
+
+# The same for answer clusters, whose representatives' answers are cut in place
+def fit_clusters(clusters, budget, count, stage):
+    fitted = fit_to_budget({cluster["representative"]: cluster["answer"] for cluster in clusters}, budget, count, stage)
+    for cluster in clusters:
+        cluster["answer"] = fitted[cluster["representative"]]
+    return clusters
+
+
+def expected_answer_tokens(spec):
+    return min(spec.max_tokens or DEFAULT_ANSWER_TOKENS, DEFAULT_ANSWER_TOKENS)
+
+
+# The median of the latencies fan_out recorded for the model in that stage, else its reply at
+# the backend's generation speed
+def expected_seconds(spec, stage, completion_tokens, stats):
+    seconds = stats.percentile(f"{stage}/{spec.name}", 0.5, min_samples=1)
+    if seconds is not None:
+        return seconds
+    speed = get_registry().provider(spec.backend).settings.get("tokens_per_second", DEFAULT_TOKENS_PER_SECOND)
+    return completion_tokens / speed
+
+
+# Function to estimate the tokens, the cost in USD and the seconds of a run before it starts.
+# The advisors answer side by side (and take turns on the local models), the later stages one
+# call after the other. Only the calls every run makes are counted: the King's rounds beyond the
+# first re-ask just the advisors that disagree, and the democracy's counter is only asked when no
+# vote could be read, so neither is included.
+def estimate_run(architecture, user_message, roles, advisors=None, stats=None):
+    stats = stats or get_model_stats()
+    advisors = roles["advisors"] if advisors is None else advisors
+    calls = []
+
+    def call(spec, stage, prompt_tokens, completion_tokens):
+        calls.append((spec, prompt_tokens, completion_tokens))
+        return expected_seconds(spec, stage, completion_tokens, stats)
+
+    def problem_tokens(spec):
+        return count_tokens(spec, (spec.system_message or "") + user_message)
+
+    answers = {advisor.name: expected_answer_tokens(advisor) for advisor in advisors}
+    advice = sum(answers.values()) + OPTION_TOKENS * len(answers)
+    capacity = local_capacity()
+    seconds = estimated_latency(advisors, {advisor.name: call(advisor, "advisors", problem_tokens(advisor), answers[advisor.name])
+                                           for advisor in advisors}, capacity)
+    if architecture == "king":
+        king = roles["king"]
+        seconds += call(king, "king", problem_tokens(king) + advice, expected_answer_tokens(king))
+    elif architecture == "democracy":
+        votes = {advisor.name: call(advisor, "votes", problem_tokens(advisor) + min(advice, context_window(advisor) - reply_tokens(advisor)),
+                                    VOTE_TOKENS)
+                 for advisor in advisors}
+        seconds += estimated_latency(advisors, votes, capacity)
+    elif architecture == "duopoly":
+        opening = sum(min(tokens, DEFAULT_INSIGHT_TOKENS) for tokens in answers.values())
+        context = problem_tokens(roles["claude_oracle"]) + opening
+        for turn in range(debate_turns_from_env()):
+            oracle = roles["claude_oracle"] if turn % 2 == 0 else roles["openai_oracle"]
+            reply = expected_answer_tokens(oracle)
+            seconds += call(oracle, f"debate turn {turn + 1}", min(context, context_budget_from_env()), reply)
+            context += reply
+        summary = roles["summary"]
+        seconds += call(summary, "summary", min(context, context_budget_from_env()) + problem_tokens(summary), expected_answer_tokens(summary))
+    return {
+        "calls": len(calls),
+        "prompt_tokens": sum(prompt for _, prompt, _ in calls),
+        "completion_tokens": sum(completion for _, _, completion in calls),
+        "cost": round(sum(estimated_cost(spec, prompt, completion) for spec, prompt, completion in calls), 4),
+        "seconds": round(seconds, 1),
+    }
+
+
+# Tokens of advisor answers the stage after the advisors has room for with this problem, by stage
+def answer_budgets(architecture, user_message, roles, advisors, system_message="", rounds=1):
+    if architecture == "king":
+        budget, _ = stage_budget("king", [roles["king"]], system_message, user_message)
+        return {"king": first_round_budget(budget, rounds)}
+    if architecture == "democracy":
+        voters_message = max((advisor.system_message or "" for advisor in advisors), key=len)
+        return {"votes": stage_budget("votes", advisors, voters_message, user_message)[0]}
+    if architecture == "duopoly":
+        # The problem is in the opening and in the summary's instructions, the insights get half
+        budget, count = stage_budget("debate", [roles["claude_oracle"], roles["openai_oracle"], roles["summary"]], system_message, user_message)
+        return {"debate": min(budget, context_budget_from_env()) // 2 - count(user_message)}
+    return {}
+
+
+# Function to fail a run before it sends anything: when the problem doesn't leave one of its
+# models room to answer, or the next stage room for the advisors' answers, or when its estimate
+# is over the cost or latency budget. `system_message` and `rounds` are the architecture's own.
+def check_run(architecture, user_message, roles, advisors=None, cost_budget=None, latency_budget=None, system_message="", rounds=1):
+    advisors = roles["advisors"] if advisors is None else advisors
+    if cost_budget is None and latency_budget is None:
+        budgets = run_budgets_from_env()
+        cost_budget, latency_budget = budgets["cost_budget"], budgets["latency_budget"]
+    specs = {spec.name: spec for spec in advisors}
+    specs.update((spec.name, spec) for role, spec in roles.items() if role not in ("advisors", "hedge"))
+    too_long = [name for name, spec in specs.items()
+                if count_tokens(spec, (spec.system_message or "") + user_message) + reply_tokens(spec) > context_window(spec)]
+    if too_long:
+        raise ValueError(f"The problem leaves no room to answer in the context window of {', '.join(too_long)}; "
+                         "shorten it or raise their context_window (num_ctx for Ollama) in models.json")
+    for stage, budget in answer_budgets(architecture, user_message, roles, advisors, system_message, rounds).items():
+        if budget < len(advisors) * (MIN_ANSWER_TOKENS + OPTION_TOKENS):
+            raise ValueError(f"The {stage} prompt would have room for {max(0, budget)} tokens of advisor answers, too few for {len(advisors)} advisors; "
+                             "shorten the problem or give the stage's models a larger context window")
+    if cost_budget is None and latency_budget is None:
+        return None
+    estimate = estimate_run(architecture, user_message, roles, advisors)
+    print(f"Estimated {architecture} run: {estimate['calls']} calls, {estimate['prompt_tokens']} prompt and "
+          f"{estimate['completion_tokens']} completion tokens, about ${estimate['cost']} and {estimate['seconds']}s")
+    if cost_budget is not None and estimate["cost"] > cost_budget:
+        raise ValueError(f"The {architecture} run would cost about ${estimate['cost']}, over MOM_RUN_COST_BUDGET=${cost_budget}")
+    if latency_budget is not None and estimate["seconds"] > latency_budget:
+        raise ValueError(f"The {architecture} run would take about {estimate['seconds']}s, over MOM_RUN_LATENCY_BUDGET={latency_budget}s")
+    return estimate
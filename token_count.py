@@ -0,0 +1,50 @@
+# Rough token count (about four characters per token for English text and code)
+def estimate_tokens(text):
+    return (len(text) + 3) // 4
+
+
+# Function to count the tokens of a prompt given as a string or a list of chat messages
+def estimate_prompt_tokens(system_message, messages):
+    if isinstance(messages, str):
+        text = messages
+    else:
+        text = "\n".join(message["content"] if isinstance(message, dict) else str(message) for message in messages)
+    return estimate_tokens(system_message or "") + estimate_tokens(text)
+
+
+DEFAULT_CHARS_PER_TOKEN = 4
+_encodings = {}
+
+
+# The tiktoken encoding of that name, or None when tiktoken isn't installed (or can't load it)
+def _tiktoken_encoding(name):
+    if name not in _encodings:
+        try:
+            import tiktoken  # optional, only the backends that name an encoding use it
+
+            _encodings[name] = tiktoken.get_encoding(name)
+        except Exception:
+            _encodings[name] = None
+    return _encodings[name]
+
+
+# Counts tokens the way one backend does: with the tiktoken encoding its "tokenizer" in
+# models.json names when tiktoken is installed, else from the length of the text at the
+# backend's chars_per_token
+class Tokenizer:
+    def __init__(self, encoding=None, chars_per_token=DEFAULT_CHARS_PER_TOKEN):
+        self.encoding = encoding
+        self.chars_per_token = chars_per_token
+
+    def count(self, text):
+        encoding = _tiktoken_encoding(self.encoding) if self.encoding else None
+        if encoding is not None:
+            return len(encoding.encode(text, disallowed_special=()))
+        return int((len(text) + self.chars_per_token - 1) // self.chars_per_token)
+
+    def count_prompt(self, system_message, messages):
+        if isinstance(messages, str):
+            text = messages
+        else:
+            text = "\n".join(message["content"] if isinstance(message, dict) else str(message) for message in messages)
+        return self.count(system_message or "") + self.count(text)
@@ -0,0 +1,136 @@
+import json
+import os
+import statistics
+
+
+# Export of the spans collected by run_metrics: an OpenTelemetry (OTLP/JSON) trace file that
+# Jaeger, Tempo or any OTLP collector can load, and a per-model summary table for the console.
+
+
+def _attribute(key, value):
+    if isinstance(value, bool):
+        return {"key": key, "value": {"boolValue": value}}
+    if isinstance(value, int):
+        return {"key": key, "value": {"intValue": str(value)}}
+    if isinstance(value, float):
+        return {"key": key, "value": {"doubleValue": value}}
+    return {"key": key, "value": {"stringValue": str(value)}}
+
+
+def _nanos(timestamp):
+    return str(int(timestamp * 1_000_000_000))
+
+
+def _span(trace_id, span_id, parent_span_id, name, start, end, attributes, error=None):
+    span = {
+        "traceId": trace_id,
+        "spanId": span_id,
+        "name": name,
+        "kind": 1,  # SPAN_KIND_INTERNAL
+        "startTimeUnixNano": _nanos(start),
+        "endTimeUnixNano": _nanos(end),
+        "attributes": [_attribute(key, value) for key, value in attributes.items() if value is not None],
+        "status": {"code": 2, "message": error} if error else {"code": 1},
+    }
+    if parent_span_id:
+        span["parentSpanId"] = parent_span_id
+    return span
+
+
+# Function to turn the run, its stages and its model calls into OTLP/JSON spans
+def to_otlp(metrics, service_name="mom", run_name="run"):
+    spans = [_span(metrics.trace_id, metrics.span_id, None, run_name, metrics.start, metrics.end or metrics.start, {})]
+    for stage in metrics.stage_spans:
+        spans.append(_span(metrics.trace_id, stage["span_id"], stage["parent_span_id"], stage["name"],
+                           stage["start"], stage["end"], {"mom.stage": stage["name"]}))
+    for call in metrics.calls:
+        spans.append(_span(
+            metrics.trace_id, call["span_id"], call["parent_span_id"], f"{call['backend']} {call['model']}",
+            call["start"], call["end"],
+            {
+                "gen_ai.system": call["backend"],
+                "gen_ai.request.model": call["model"],
+                "gen_ai.usage.input_tokens": call["prompt_tokens"],
+                "gen_ai.usage.output_tokens": call["completion_tokens"],
+                "mom.stage": call["stage"],
+                "mom.cached": call["cached"],
+                "mom.usage_reported": call["usage_reported"],
+                "mom.queue_seconds": call["queue_seconds"],
+                "mom.ttft_seconds": call["ttft_seconds"],
+                "mom.seconds": call["seconds"],
+                "mom.load_seconds": call["load_seconds"],
+                "mom.prompt_eval_seconds": call["prompt_eval_seconds"],
+                "mom.prompt_eval_tokens": call["prompt_eval_tokens"],
+                "mom.retries": call["retries"],
+                "mom.throttle_seconds": call["throttle_seconds"],
+            },
+            call["error"],
+        ))
+    return {
+        "resourceSpans": [{
+            "resource": {"attributes": [_attribute("service.name", service_name)]},
+            "scopeSpans": [{"scope": {"name": "mom.run_metrics"}, "spans": spans}],
+        }]
+    }
+
+
+def write_trace(metrics, path, run_name="run"):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as outfile:
+        json.dump(to_otlp(metrics, run_name=run_name), outfile, indent=1)
+
+
+# Function to summarize the calls of a run per backend and model, slowest first so the
+# straggler is on top
+def summary_rows(metrics):
+    groups = {}
+    for call in metrics.calls:
+        groups.setdefault((call["backend"], call["model"]), []).append(call)
+    rows = []
+    for (backend, model), calls in groups.items():
+        live = [call for call in calls if not call["cached"]] or calls
+        rows.append({
+            "backend": backend,
+            "model": model,
+            "stages": ", ".join(sorted({call["stage"] or "-" for call in calls})),
+            "calls": len(calls),
+            "cached": sum(call["cached"] for call in calls),
+            "errors": sum(bool(call["error"]) for call in calls),
+            "queue_seconds": round(statistics.mean(call["queue_seconds"] for call in calls), 2),
+            "ttft_seconds": round(statistics.mean(call["ttft_seconds"] for call in live), 2),
+            "max_seconds": round(max(call["seconds"] for call in live), 2),
+            "prompt_tokens": sum(call["prompt_tokens"] for call in calls if not call["cached"]),
+            "completion_tokens": sum(call["completion_tokens"] or 0 for call in calls if not call["cached"]),
+            "prompt_eval_seconds": round(sum(call["prompt_eval_seconds"] or 0.0 for call in calls if not call["cached"]), 2),
+            "retries": sum(call["retries"] for call in calls),
+            "throttle_seconds": round(sum(call["throttle_seconds"] for call in calls), 2),
+        })
+    rows.sort(key=lambda row: -row["max_seconds"])
+    return rows
+
+
+def summary_table(metrics):
+    columns = ["backend", "model", "stages", "calls", "cached", "errors", "retries", "queue_seconds", "throttle_seconds", "ttft_seconds", "max_seconds",
+               "prompt_tokens", "completion_tokens", "prompt_eval_seconds"]
+    headers = ["backend", "model", "stages", "calls", "cached", "errors", "retries", "queue s", "throttled s", "ttft s", "max s",
+               "tokens in", "tokens out", "prompt eval s"]
+    rows = [[str(row[column]) for column in columns] for row in summary_rows(metrics)]
+    widths = [max([len(header)] + [len(row[i]) for row in rows]) for i, header in enumerate(headers)]
+    lines = ["  ".join(header.ljust(width) for header, width in zip(headers, widths))]
+    lines.append("  ".join("-" * width for width in widths))
+    lines.extend("  ".join(cell.ljust(width) for cell, width in zip(row, widths)) for row in rows)
+    if metrics.end:
+        lines.append(f"Run took {metrics.end - metrics.start:.1f}s")
+    return "\n".join(lines)
+
+
+# Function for the scripts: print the summary table and write the trace when MOM_TRACE_DIR is set
+def report_run(metrics, run_name):
+    print(summary_table(metrics))
+    trace_dir = os.getenv("MOM_TRACE_DIR")
+    if trace_dir:
+        path = os.path.join(trace_dir, f"{run_name}-{metrics.trace_id[:8]}.json")
+        write_trace(metrics, path, run_name=run_name)
+        print(f"Trace written to {path}")